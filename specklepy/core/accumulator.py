@@ -0,0 +1,219 @@
+import numpy as np
+import os
+
+from specklepy.core import alignment
+from specklepy.exceptions import SpecklepyTypeError, SpecklepyValueError
+from specklepy.logging import logger
+
+
+class SSAAccumulator(object):
+
+    """Running sums of aligned SSA reconstructions, that can be extended cube by cube.
+
+    The accumulator stores the sum of the interim SSA reconstructions of all included cubes, and of their variances,
+    on the 'full' field, together with the Fourier transformed reference image and the extents of the shifts. Adding a
+    new cube therefore only requires the alignment of its own reconstruction. The 'same' field is cropped from the
+    'full' field on request, such that the result is identical to aligning all cubes at once.
+
+    Attributes:
+        f_reference_image (np.ndarray, dtype=complex):
+            Real Fourier transform of the reference image, relative to which the shifts are computed.
+        frame_shape (tuple):
+            Shape of the individual reconstructions.
+        upsample_factor (int):
+            Precision of the sub-pixel shifts in units of 1 / pixel, None for integer shifts.
+        files (list of str):
+            List of files that are included in the sums.
+        shifts (list of tuple):
+            Shifts of the included files relative to the reference image. The integer parts are applied on the
+            'full' field and the remaining fractions via phase ramps in Fourier space.
+        frame_selections (list of np.ndarray):
+            Indizes of the frames that were co-added from each file.
+        sum (np.ndarray):
+            Sum of the shifted reconstructions on the 'full' field.
+        var_sum (np.ndarray):
+            Sum of the shifted variances on the 'full' field, None if no variances were provided.
+        extents (np.ndarray):
+            Minimum and maximum shifts along both axes, as [xmin, xmax, ymin, ymax].
+    """
+
+    def __init__(self, reference_image, upsample_factor=None):
+        """Create an empty SSAAccumulator instance.
+
+        Args:
+            reference_image (np.ndarray):
+                Reference image or cube, relative to which the shifts are computed. Cubes are integrated along the
+                time axis.
+            upsample_factor (int, optional):
+                Align reconstructions on sub-pixel shifts with a precision of 1 / `upsample_factor` pixels. See
+                specklepy.core.alignment.get_shift() for details. Integer shifts are used if not provided.
+        """
+
+        if not isinstance(reference_image, np.ndarray):
+            raise SpecklepyTypeError('SSAAccumulator', argname='reference_image', argtype=type(reference_image),
+                                     expected='np.ndarray')
+        self.f_reference_image, self.frame_shape = alignment.get_reference_transform(reference_image)
+        self.upsample_factor = upsample_factor
+        self.files = []
+        self.shifts = []
+        self.frame_selections = []
+        self.sum = None
+        self.var_sum = None
+        self.extents = None
+
+    @classmethod
+    def from_file(cls, path):
+        """Load the state of an SSAAccumulator from a file.
+
+        Args:
+            path (str):
+                Path to the file that was written by the save() method.
+
+        Returns:
+            accumulator (SSAAccumulator):
+                Accumulator in the stored state.
+        """
+        logger.info(f"Loading SSA accumulator from {path}")
+        with np.load(path, allow_pickle=False) as state:
+            accumulator = cls.__new__(cls)
+            accumulator.f_reference_image = state['f_reference_image']
+            accumulator.frame_shape = tuple(state['frame_shape'])
+            accumulator.upsample_factor = int(state['upsample_factor']) if 'upsample_factor' in state else None
+            accumulator.files = list(state['files'])
+            accumulator.shifts = [tuple(shift.tolist()) for shift in state['shifts']]
+            accumulator.frame_selections = np.split(state['frame_selections'],
+                                                    np.cumsum(state['selection_counts'])[:-1])
+            accumulator.sum = state['sum']
+            accumulator.var_sum = state['var_sum'] if 'var_sum' in state else None
+            accumulator.extents = state['extents']
+        return accumulator
+
+    def save(self, path):
+        """Store the state of the accumulator to a file.
+
+        Args:
+            path (str):
+                Path to the file, that is overwritten if existing.
+        """
+        if self.sum is None:
+            raise RuntimeError("SSAAccumulator does not contain any file to save!")
+        logger.info(f"Saving SSA accumulator with {len(self.files)} files to {path}")
+        state = {'f_reference_image': self.f_reference_image,
+                 'frame_shape': np.array(self.frame_shape),
+                 'files': np.array(self.files),
+                 'shifts': np.array(self.shifts),
+                 'frame_selections': np.concatenate(self.frame_selections).astype(int),
+                 'selection_counts': np.array([len(selection) for selection in self.frame_selections]),
+                 'sum': self.sum,
+                 'extents': self.extents}
+        if self.var_sum is not None:
+            state['var_sum'] = self.var_sum
+        if self.upsample_factor is not None:
+            state['upsample_factor'] = self.upsample_factor
+        with open(path, 'wb') as file:
+            np.savez(file, **state)
+
+    def __contains__(self, file):
+        return os.path.normpath(file) in [os.path.normpath(f) for f in self.files]
+
+    def add(self, image, file, image_var=None, frame_selection=None):
+        """Align an interim SSA reconstruction and add it to the running sums.
+
+        Args:
+            image (np.ndarray, ndim=2):
+                Interim SSA reconstruction of a cube.
+            file (str):
+                Name of the file that the reconstruction was computed from.
+            image_var (np.ndarray, ndim=2, optional):
+                Variance of the reconstruction.
+            frame_selection (array_like, optional):
+                Indizes of the frames that were co-added in the reconstruction.
+        """
+
+        if image.shape != self.frame_shape:
+            raise SpecklepyValueError('SSAAccumulator.add()', argname='image.shape', argvalue=image.shape,
+                                      expected=str(self.frame_shape))
+
+        # Estimate the shift relative to the reference image
+        shift = alignment.get_shift(image, reference_image=self.f_reference_image, is_fourier_transformed=True,
+                                    upsample_factor=self.upsample_factor)
+        logger.info(f"Identified a shift of {shift} for file {file}")
+
+        # Apply the sub-pixel fraction of the shift
+        integer_shift = np.round(shift).astype(int)
+        fraction = np.array(shift) - integer_shift
+        if np.any(fraction != 0):
+            image = alignment.fourier_shift(image, fraction)
+            if image_var is not None:
+                image_var = alignment.fourier_shift(image_var, fraction)
+
+        # Expand the 'full' field to cover the shifted image
+        extents = np.array([integer_shift[0], integer_shift[0], integer_shift[1], integer_shift[1]])
+        if self.extents is not None:
+            extents[0::2] = np.minimum(extents[0::2], self.extents[0::2])
+            extents[1::2] = np.maximum(extents[1::2], self.extents[1::2])
+        self.sum = self._expand(self.sum, extents)
+        if image_var is not None or self.var_sum is not None:
+            self.var_sum = self._expand(self.var_sum, extents)
+        self.extents = extents
+
+        # Add the image and variance in place
+        dx = integer_shift[0] - self.extents[0]
+        dy = integer_shift[1] - self.extents[2]
+        self.sum[dx: dx + self.frame_shape[0], dy: dy + self.frame_shape[1]] += image
+        if image_var is not None:
+            self.var_sum[dx: dx + self.frame_shape[0], dy: dy + self.frame_shape[1]] += image_var
+
+        # Book-keeping
+        self.files.append(file)
+        self.shifts.append(shift)
+        if frame_selection is None:
+            frame_selection = []
+        self.frame_selections.append(np.array(frame_selection, dtype=int))
+
+    def _expand(self, array, extents):
+        """Pad an array on the 'full' field of the current extents to the 'full' field of new extents."""
+        shape = (self.frame_shape[0] + extents[1] - extents[0], self.frame_shape[1] + extents[3] - extents[2])
+        expanded = np.zeros(shape)
+        if array is not None:
+            dx = self.extents[0] - extents[0]
+            dy = self.extents[2] - extents[2]
+            expanded[dx: dx + array.shape[0], dy: dy + array.shape[1]] = array
+        return expanded
+
+    def get_image(self, mode='same'):
+        """Return the reconstruction of all included files.
+
+        Args:
+            mode (str, optional):
+                Define the size of the output image as 'same' to the reference image, expanding to include the
+                'full' covered field or reducing to the 'valid' field that is covered by all images. Default is
+                'same'.
+
+        Returns:
+            image (np.ndarray):
+                Reconstruction image.
+            image_var (np.ndarray):
+                Variance of the reconstruction, None if no variances were provided.
+        """
+
+        if self.sum is None:
+            raise RuntimeError("SSAAccumulator does not contain any file yet!")
+
+        if mode == 'full':
+            crop = (slice(None), slice(None))
+        elif mode == 'same':
+            # Crop like specklepy.core.alignment.pad_array() with the reference image pad vector
+            xmin, xmax, ymin, ymax = np.abs(self.extents)
+            crop = (slice(xmin, self.sum.shape[0] - xmax), slice(ymin, self.sum.shape[1] - ymax))
+        elif mode == 'valid':
+            # The field covered by all images starts at the extent of the shifts within the 'full' field
+            crop = (slice(self.extents[1] - self.extents[0], self.frame_shape[0]),
+                    slice(self.extents[3] - self.extents[2], self.frame_shape[1]))
+        else:
+            raise SpecklepyValueError('SSAAccumulator.get_image()', argname='mode', argvalue=mode,
+                                      expected="'same', 'full' or 'valid'")
+
+        image = self.sum[crop].copy()
+        image_var = self.var_sum[crop].copy() if self.var_sum is not None else None
+        return image, image_var
@@ -1,15 +1,18 @@
+from functools import lru_cache
 import numpy as np
 import os
+import scipy.fft
 
 from astropy.io import fits
 
 from specklepy.exceptions import SpecklepyTypeError, SpecklepyValueError
 from specklepy.logging import logger
 from specklepy.plotting.plots import imshow
+from specklepy.utils.chunks import chunk_slices, get_chunk_size
 
 
 def get_shifts(files, reference_file=None, mode='correlation', lazy_mode=True, return_image_shape=False, in_dir=None,
-               debug=False):
+               upsample_factor=None, cache=None, debug=False, **kwargs):
     """Computes the the relative shift of data cubes relative to a reference
     image.
 
@@ -18,27 +21,39 @@ def get_shifts(files, reference_file=None, mode='correlation', lazy_mode=True, r
 
     Args:
         files (list or array_like):
-            List of files to align.
-        reference_file (str, int, optional):
-            Path to a reference file or index of the file in files, relative to which the shifts are computed. Default
-            is 0.
+            List of files to align. The list may also contain images or cubes as np.ndarray instances, which are then
+            aligned without reading from disk.
+        reference_file (str, int or np.ndarray, optional):
+            Path to a reference file or index of the file in files, relative to which the shifts are computed. A
+            reference image or cube may also be provided as np.ndarray. Default is 0.
         mode (str, optional):
             Mode of the shift estimate. In 'correlation' mode, a 2D correlation is used to estimate the shift of the
             array. This is computationally much more expensive than the identical 'maximum' or 'peak' modes, which
             simply identify the coordinates of the emission peaks and return the difference. Though these modes may be
-            fooled by reference sources of similar brightness. Passed to get_shift() function. Default is 'correlation'.
+            fooled by reference sources of similar brightness. The 'pyramid' mode correlates binned images and refines
+            the shift on a full-resolution window, which is much cheaper for large frames. Passed to get_shift()
+            function. Default is 'correlation'.
         lazy_mode (bool, optional):
             Set to False, to enforce the alignment of a single file with respect to the reference file. Default is True.
         return_image_shape (bool, optional):
             Set to True for for returning the shape of the anticipated output image. Default is False.
         in_dir (str, optional):
             Path to the files. `None` is substituted by an empty string.
+        upsample_factor (int, optional):
+            Refine the shifts in 'correlation' mode to a precision of 1 / `upsample_factor` pixels. See get_shift()
+            for details. Integer shifts are computed if not provided.
+        cache (specklepy.io.cache.Cache, optional):
+            Cache that is consulted for shifts of the same files and parameters before computing them, and that the
+            shifts are stored in otherwise.
         debug (bool, optional):
             If set to True, it shows the 2D correlation.
+        **kwargs:
+            Passed to get_shift(), e.g. the `binning` and `window_size` of the 'pyramid' mode.
 
     Returns:
         shifts (list):
-            List of shifts for each file relative to the reference file.
+            List of shifts for each file relative to the reference file. The shifts are floats if `upsample_factor` is
+            provided.
     """
 
     # Check input parameters
@@ -52,13 +67,14 @@ def get_shifts(files, reference_file=None, mode='correlation', lazy_mode=True, r
         reference_file = files[0]
     elif isinstance(reference_file, int):
         reference_file = files[reference_file]
-    elif not isinstance(reference_file, str):
-        raise SpecklepyTypeError('get_shifts()', argname='reference_file', argtype=type(reference_file), expected='str')
+    elif not isinstance(reference_file, (str, np.ndarray)):
+        raise SpecklepyTypeError('get_shifts()', argname='reference_file', argtype=type(reference_file),
+                                 expected='str, int or np.ndarray')
 
     if isinstance(mode, str):
-        if mode not in ['correlation', 'maximum', 'peak']:
+        if mode not in ['correlation', 'pyramid', 'maximum', 'peak']:
             raise SpecklepyValueError('get_shifts()', argname='mode', argvalue=mode,
-                                      expected="'correlation', 'maximum' or 'peak'")
+                                      expected="'correlation', 'pyramid', 'maximum' or 'peak'")
     else:
         raise SpecklepyTypeError('get_shifts()', argname='mode', argtype=type(mode), expected='str')
 
@@ -76,68 +92,169 @@ def get_shifts(files, reference_file=None, mode='correlation', lazy_mode=True, r
     if lazy_mode and len(files) == 1:
         logger.info("Only one data cube is provided, nothing to align.")
         shifts = [(0, 0)]
-        image_shape = fits.getdata(os.path.join(in_dir, files[0])).shape
+        image_shape = _get_image(files[0], in_dir=in_dir, collapse=False).shape
         image_shape = (image_shape[-2], image_shape[-1])
 
-    # Otherwise estimate shifts
+    # Otherwise estimate shifts, if not cached
     else:
+        if cache is not None:
+            key = cache.key(files=list(files) + [reference_file], in_dir=in_dir, function='get_shifts', mode=mode,
+                            upsample_factor=upsample_factor, kwargs=kwargs)
+            entry = cache.load(key)
+            if entry is not None:
+                logger.info(f"Using cached shifts from entry {key}")
+                shifts = [tuple(shift.tolist()) for shift in entry['shifts']]
+                if return_image_shape:
+                    return shifts, tuple(entry['image_shape'].tolist())
+                return shifts
+
         shifts = []
 
         # Identify reference file and Fourier transform the integrated image
-        logger.info(f"Computing relative shifts between data cubes. Reference file is {reference_file}")
-        reference_image = fits.getdata(os.path.join(in_dir, reference_file))
-        if reference_image.ndim == 3:
-            # Integrating over time axis if reference image is a cube
-            reference_image = np.sum(reference_image, axis=0)
-        f_reference_image = np.fft.fft2(reference_image)
-        image_shape = reference_image.shape
-        del reference_image
+        logger.info(f"Computing relative shifts between data cubes. Reference file is {_get_name(reference_file)}")
+        if mode == 'correlation':
+            f_reference_image, image_shape = get_reference_transform(reference_file, in_dir=in_dir)
+        else:
+            f_reference_image = _get_image(reference_file, in_dir=in_dir)
+            image_shape = f_reference_image.shape
 
         # Iterate over files and estimate shift via 2D correlation of the integrated cubes
         for index, file in enumerate(files):
-            if file == reference_file:
-                shift = (0, 0)
+            if file is reference_file or (isinstance(file, str) and isinstance(reference_file, str) and
+                                          file == reference_file):
+                shift = (0., 0.) if upsample_factor is not None else (0, 0)
             else:
-                image = fits.getdata(os.path.join(in_dir, file))
-                if image.ndim == 3:
-                    image = np.sum(image, axis=0)
-                shift = get_shift(image, reference_image=f_reference_image, is_fourier_transformed=True, mode=mode,
-                                  debug=debug)
+                image = _get_image(file, in_dir=in_dir)
+                shift = get_shift(image, reference_image=f_reference_image,
+                                  is_fourier_transformed=(mode == 'correlation'), mode=mode,
+                                  upsample_factor=upsample_factor, debug=debug, **kwargs)
             shifts.append(shift)
-            logger.info(f"Identified a shift of {shift} for file {file}")
+            logger.info(f"Identified a shift of {shift} for file {_get_name(file, index=index)}")
         logger.info(f"Identified the following shifts:\n\t{shifts}")
 
+        if cache is not None:
+            cache.store(key, shifts=np.array(shifts), image_shape=np.array(image_shape))
+
     if return_image_shape:
         return shifts, image_shape
     else:
         return shifts
 
 
-def get_shift(image, reference_image=None, is_fourier_transformed=False, mode='correlation', debug=False):
+def get_reference_transform(reference, in_dir=None):
+    """Compute the real Fourier transform of a reference image for the correlation with other images.
+
+    The transforms of reference files are cached, such that repeated alignments relative to the same file, e.g. by
+    ssa() and Reconstruction, transform the reference only once. The cache is invalidated if the file is modified.
+
+    Args:
+        reference (str or np.ndarray):
+            Name of a FITS file or the reference image or cube itself. Cubes are integrated along the time axis.
+        in_dir (str, optional):
+            Path to the file.
+
+    Returns:
+        f_reference (np.ndarray, dtype=complex):
+            Real Fourier transform of the reference image. This array is read-only.
+        image_shape (tuple):
+            Shape of the reference image.
+    """
+    if isinstance(reference, np.ndarray):
+        image = _get_image(reference)
+        return _rfft2(image), image.shape
+    path = os.path.abspath(os.path.join(in_dir if in_dir is not None else '', reference))
+    stat = os.stat(path)
+    return _get_file_transform(path, stat.st_mtime_ns, stat.st_size)
+
+
+@lru_cache(maxsize=8)
+def _get_file_transform(path, mtime, size):
+    """Read and Fourier transform a reference file. The modification time and size serve as cache keys only."""
+    image = _get_image(path)
+    f_image = _rfft2(image)
+    f_image.flags.writeable = False
+    return f_image, image.shape
+
+
+def _rfft2(array):
+    """Compute the real Fourier transform along the last two axes with all available threads."""
+    return scipy.fft.rfft2(array, workers=-1)
+
+
+def _get_image(file, in_dir='', collapse=True):
+    """Read an image from a file or take it from an array, integrating cubes along the time axis.
+
+    Args:
+        file (str or np.ndarray):
+            Name of a FITS file or the image or cube itself.
+        in_dir (str, optional):
+            Path to the file.
+        collapse (bool, optional):
+            Integrate cubes along the time axis. Default is True.
+
+    Returns:
+        image (np.ndarray):
+            Image or, if not collapsed, the cube.
+    """
+    if isinstance(file, np.ndarray):
+        image = file
+    else:
+        image = fits.getdata(os.path.join(in_dir, file))
+    if collapse and image.ndim == 3:
+        # Integrating over time axis if image is a cube
+        image = np.sum(image, axis=0)
+    return image
+
+
+def _get_name(file, index=None):
+    """Return a name of a file or array for logging."""
+    if isinstance(file, np.ndarray):
+        return 'in-memory image' if index is None else f"in-memory image {index}"
+    return file
+
+
+def get_shift(image, reference_image=None, is_fourier_transformed=False, mode='correlation', upsample_factor=None,
+              binning=None, window_size=128, debug=False):
     """Estimate the shift between an image and a reference image.
 
     Estimate the relative shift between an image and a reference image by means of a 2D correlation
     ('correlation' mode) or by comparison of the emission peaks ('peak' or 'maximum' modes).
 
+    The 'pyramid' mode is a coarse-to-fine variant of the 'correlation' mode for large frames. It correlates binned
+    images to obtain a coarse shift, which is then refined by correlating a full-resolution window around the brightest
+    region of the reference image with the correspondingly shifted window of the image. The cost of the refinement
+    scales with the window size instead of the frame size.
+
     Args:
         image (np.ndarray):
             2D array of the image to be shifted.
         reference_image (np.ndarray):
             2D array of the reference image of the shift.
         is_fourier_transformed (bool):
-            Indicate whether the reference image is already Fourier transformed. This is implemented to save
+            Indicate whether the reference image is already Fourier transformed, either by the real Fourier transform
+            as obtained from get_reference_transform() or by the full complex transform. This is implemented to save
             computation by computing that transform only once.
         mode (str, optional):
             Mode of the shift estimate. In 'correlation' mode, a 2D correlation is used to estimate the shift of the
             array. This is computationally much more expensive than the identical 'maximum' or 'peak' modes, which
             simply identify the coordinates of the emission peaks and return the difference. Though these modes may be
             fooled by reference sources of similar brightness. Default is 'correlation'.
+        upsample_factor (int, optional):
+            If provided in 'correlation' or 'pyramid' mode, the integer peak of the correlation is refined to a
+            precision of 1 / `upsample_factor` pixels. The correlation is evaluated on an upsampled grid of 1.5 x 1.5
+            pixels around the integer peak by a matrix-multiply discrete Fourier transform (Guizar-Sicairos et al.
+            2008), which is much cheaper than upsampling the full correlation.
+        binning (int, optional):
+            Binning factor of the coarse correlation in 'pyramid' mode. Chosen such that the binned images have about
+            256 pixels along the shorter axis if not provided.
+        window_size (int, optional):
+            Size of the full-resolution window of the refinement in 'pyramid' mode. Default is 128.
         debug (bool, optional):
             Set to True to inspect intermediate results. Default is False.
 
     Returns:
         shift (tuple):
-            Tuple of shift indices for each axis.
+            Tuple of shift indices for each axis, or of float shifts if `upsample_factor` is provided.
     """
 
     # Check input parameters
@@ -149,11 +266,18 @@ def get_shift(image, reference_image=None, is_fourier_transformed=False, mode='c
         raise SpecklepyTypeError('get_shift()', argname='is_Fourier_transformed', argtype=type(is_fourier_transformed),
                                  expected='bool')
     if isinstance(mode, str):
-        if mode not in ['correlation', 'maximum', 'peak']:
+        if mode not in ['correlation', 'pyramid', 'maximum', 'peak']:
             raise SpecklepyValueError('get_shift()', argname='mode', argvalue=mode,
-                                      expected="'correlation', 'maximum' or 'peak'")
+                                      expected="'correlation', 'pyramid', 'maximum' or 'peak'")
     else:
         raise SpecklepyTypeError('get_shift()', argname='mode', argtype=type(mode), expected='str')
+    if upsample_factor is not None:
+        if not isinstance(upsample_factor, int):
+            raise SpecklepyTypeError('get_shift()', argname='upsample_factor', argtype=type(upsample_factor),
+                                     expected='int')
+        if upsample_factor < 1:
+            raise SpecklepyValueError('get_shift()', argname='upsample_factor', argvalue=upsample_factor,
+                                      expected='>= 1')
 
     # Simple comparison of the peaks in the images
     if mode == 'maximum' or mode == 'peak':
@@ -161,35 +285,260 @@ def get_shift(image, reference_image=None, is_fourier_transformed=False, mode='c
         peak_ref_image = np.unravel_index(np.argmax(reference_image, axis=None), reference_image.shape)
         return peak_ref_image[0] - peak_image[0], peak_ref_image[1] - peak_image[1]
 
+    # Using correlation of binned images and refining on a full-resolution window
+    elif mode == 'pyramid':
+        if is_fourier_transformed:
+            raise SpecklepyValueError('get_shift()', argname='is_fourier_transformed', argvalue=is_fourier_transformed,
+                                      expected="False in 'pyramid' mode")
+        return _get_pyramid_shift(image, reference_image, binning=binning, window_size=window_size,
+                                  upsample_factor=upsample_factor, debug=debug)
+
     # Using correlation of the two images
     elif mode == 'correlation':
-        # Get the Fourier transformed reference image for cross-correlation
+        # Get the real Fourier transformed reference image for cross-correlation
         if not is_fourier_transformed:
-            f_reference_image = np.fft.fft2(reference_image)
+            f_reference_image = _rfft2(reference_image)
+        elif reference_image.shape == image.shape:
+            # The real transform is the first half of the full complex transform along the last axis
+            f_reference_image = reference_image[:, :image.shape[1] // 2 + 1]
         else:
             f_reference_image = reference_image
 
         # Fourier transform the image
-        f_image = np.conjugate(np.fft.fft2(image))
+        f_image = _rfft2(image)
+        np.conjugate(f_image, out=f_image)
 
         # Compute the 2-dimensional correlation
-        correlation = np.fft.ifft2(np.multiply(f_reference_image, f_image))
-        correlation = np.fft.fftshift(correlation)
+        f_image *= f_reference_image
+        correlation = scipy.fft.irfft2(f_image, s=image.shape, workers=-1)
         if debug:
-            imshow(np.abs(correlation), title='FFT shifted correlation')
+            imshow(np.fft.fftshift(correlation), title='FFT shifted correlation')
 
-        # Derive the shift from the correlation
+        # Derive the shift from the correlation, where indizes beyond the center correspond to negative shifts
         shift = np.unravel_index(np.argmax(correlation), correlation.shape)
-        shift = tuple(x - int(correlation.shape[i] / 2) for i, x in enumerate(shift))
+        shift = tuple(x - n if x >= n - n // 2 else x for x, n in zip(shift, correlation.shape))
+        del correlation
+
+        # Refine the shift on an upsampled grid around the integer peak
+        if upsample_factor is not None and upsample_factor > 1:
+            shift = _refine_correlation_peak(f_image, image.shape, shift, upsample_factor)
         return shift
 
 
+def _get_pyramid_shift(image, reference_image, binning=None, window_size=128, upsample_factor=None, debug=False):
+    """Estimate the shift between two images by a coarse correlation of binned images and a refinement on a window.
+
+    See get_shift() for details on the arguments.
+    """
+
+    if binning is None:
+        binning = max(min(image.shape) // 256, 1)
+    window_size = min(window_size, *image.shape)
+    if binning == 1 or window_size == min(image.shape):
+        logger.debug("Frames are too small for the pyramid alignment, using full correlation instead")
+        return get_shift(image, reference_image=reference_image, upsample_factor=upsample_factor, debug=debug)
+
+    # Coarse shift from the correlation of the binned images
+    binned_reference = _bin_image(reference_image, binning)
+    coarse_shift = get_shift(_bin_image(image, binning), reference_image=binned_reference, debug=debug)
+    coarse_shift = np.array(coarse_shift) * binning
+
+    # Place the window on the brightest region of the reference image, such that the shifted window of the image is
+    # contained within the image, i.e. image[window - shift] corresponds to reference_image[window]
+    center = (np.array(np.unravel_index(np.argmax(binned_reference), binned_reference.shape)) + 0.5) * binning
+    lower = np.maximum(coarse_shift, 0)
+    upper = np.array(image.shape) - window_size + np.minimum(coarse_shift, 0)
+    if np.any(upper < lower):
+        logger.warning(f"Coarse shift {tuple(coarse_shift)} is too large for refining on a window of size "
+                       f"{window_size}, returning the coarse shift")
+        return tuple(int(x) for x in coarse_shift)
+    start = np.clip(center.astype(int) - window_size // 2, lower, upper)
+    reference_window = reference_image[start[0]: start[0] + window_size, start[1]: start[1] + window_size]
+    start -= coarse_shift
+    image_window = image[start[0]: start[0] + window_size, start[1]: start[1] + window_size]
+
+    # Refine the shift by the correlation of the windows
+    residual = get_shift(image_window, reference_image=reference_window, upsample_factor=upsample_factor, debug=debug)
+    return tuple(type(x)(c + x) for c, x in zip(coarse_shift, residual))
+
+
+def _bin_image(image, binning):
+    """Sum blocks of binning x binning pixels, dropping the incomplete blocks at the upper edges."""
+    nx, ny = image.shape[0] // binning, image.shape[1] // binning
+    return image[:nx * binning, :ny * binning].reshape((nx, binning, ny, binning)).sum(axis=(1, 3))
+
+
+def _refine_correlation_peak(f_correlation, image_shape, shift, upsample_factor):
+    """Refine the peak of a correlation by a matrix-multiply DFT on an upsampled grid around an integer peak.
+
+    Args:
+        f_correlation (np.ndarray):
+            Real Fourier transform of the correlation, i.e. the half spectrum along the last axis.
+        image_shape (tuple):
+            Shape of the correlation in image space.
+        shift (tuple):
+            Integer peak coordinates of the correlation, which may be negative.
+        upsample_factor (int):
+            Number of grid points per pixel.
+
+    Returns:
+        shift (tuple):
+            Refined float peak coordinates.
+    """
+    nx, ny = image_shape
+    size = int(np.ceil(1.5 * upsample_factor))
+    offsets = (np.arange(size) - size // 2) / upsample_factor
+
+    # Weight the half spectrum, such that the real part of its DFT matches the DFT of the full spectrum
+    weights = np.full(f_correlation.shape[1], 2.)
+    weights[0] = 1.
+    if ny % 2 == 0:
+        weights[-1] = 1.
+
+    # Evaluate the correlation on the upsampled grid
+    kernel_x = np.exp(2j * np.pi * np.outer(shift[0] + offsets, np.fft.fftfreq(nx)))
+    kernel_y = np.exp(2j * np.pi * np.outer(np.fft.rfftfreq(ny), shift[1] + offsets))
+    upsampled = np.real(kernel_x @ (f_correlation * weights) @ kernel_y)
+
+    peak = np.unravel_index(np.argmax(upsampled), upsampled.shape)
+    return float(shift[0] + offsets[peak[0]]), float(shift[1] + offsets[peak[1]])
+
+
+def get_frame_shifts(cube, reference_image=None, block_size=1, memory_limit=None):
+    """Estimate the drift of the frames within a cube relative to a reference image.
+
+    The shifts are estimated per frame or per block of consecutive frames, by correlating the (integrated) blocks with
+    the reference image in 'correlation' mode, see get_shift(). The correlations are computed in batches of blocks,
+    applying the Fourier transforms to stacks of frames at once. If no reference image is provided, the shifts are
+    first estimated relative to the integrated cube, which is smeared by the drift, and then refined relative to the
+    drift-corrected integrated cube.
+
+    Args:
+        cube (np.ndarray, ndim=3):
+            Data cube, which may be memory-mapped.
+        reference_image (np.ndarray, optional):
+            Reference image, relative to which the shifts are computed. The integrated cube is used if not provided.
+        block_size (int, optional):
+            Number of consecutive frames that share a shift. Default is 1, i.e. shifts per frame.
+        memory_limit (float, optional):
+            Upper limit of memory in units of MB for the batches of blocks. All blocks are correlated at once if not
+            provided.
+
+    Returns:
+        frame_shifts (np.ndarray, shape=(n_frames, 2)):
+            Integer shift of each frame, relative to the reference image.
+    """
+
+    # Check input parameters
+    if not isinstance(cube, np.ndarray):
+        raise SpecklepyTypeError('get_frame_shifts()', argname='cube', argtype=type(cube), expected='np.ndarray')
+    if cube.ndim != 3:
+        raise SpecklepyValueError('get_frame_shifts()', argname='cube.ndim', argvalue=cube.ndim, expected='3')
+    if not isinstance(block_size, int):
+        raise SpecklepyTypeError('get_frame_shifts()', argname='block_size', argtype=type(block_size), expected='int')
+    if block_size < 1:
+        raise SpecklepyValueError('get_frame_shifts()', argname='block_size', argvalue=block_size, expected='>= 1')
+
+    # Derive the number of blocks per batch, accounting for the frames of the blocks, their sum, Fourier transform and
+    # correlation
+    n_blocks = -(-cube.shape[0] // block_size)
+    batch_size = get_chunk_size(cube.shape[1:], np.float64, n_frames=n_blocks, memory_limit=memory_limit,
+                                n_cubes=block_size + 3)
+
+    if reference_image is not None:
+        frame_shifts = _correlate_blocks(cube, reference_image, block_size=block_size, batch_size=batch_size)
+    else:
+        frame_shifts = _correlate_blocks(cube, cube, block_size=block_size, batch_size=batch_size)
+        reference_image = np.zeros(cube.shape[1:])
+        for chunk in chunk_slices(cube.shape[0], batch_size * block_size):
+            for shift, frame in zip(frame_shifts[chunk], cube[chunk]):
+                place_into_canvas(reference_image, frame, shift)
+        frame_shifts = _correlate_blocks(cube, reference_image, block_size=block_size, batch_size=batch_size)
+
+    logger.debug(f"Identified frame shifts within a range of {np.min(frame_shifts, axis=0)} to "
+                 f"{np.max(frame_shifts, axis=0)}")
+    return frame_shifts
+
+
+def _correlate_blocks(cube, reference_image, block_size, batch_size):
+    """Estimate the shifts of blocks of frames by batched correlations with a reference image or cube."""
+
+    n_frames = cube.shape[0]
+    frame_shape = cube.shape[1:]
+    f_reference_image, _ = get_reference_transform(reference_image)
+
+    n_blocks = -(-n_frames // block_size)
+    block_shifts = np.zeros((n_blocks, 2), dtype=int)
+    for batch in chunk_slices(n_blocks, batch_size):
+        frames = cube[batch.start * block_size: min(batch.stop * block_size, n_frames)]
+        if block_size > 1:
+            frames = np.add.reduceat(frames, np.arange(0, frames.shape[0], block_size), axis=0, dtype=float)
+
+        # Batched correlation with the reference image
+        f_frames = _rfft2(frames)
+        np.conjugate(f_frames, out=f_frames)
+        f_frames *= f_reference_image
+        correlations = scipy.fft.irfft2(f_frames, s=frame_shape, workers=-1)
+        del f_frames
+
+        # Derive shifts from the correlation peaks, where indizes beyond the center correspond to negative shifts
+        peaks = np.argmax(correlations.reshape((correlations.shape[0], -1)), axis=1)
+        for axis, indizes in enumerate(np.unravel_index(peaks, frame_shape)):
+            n = frame_shape[axis]
+            block_shifts[batch, axis] = np.where(indizes >= n - n // 2, indizes - n, indizes)
+
+    return np.repeat(block_shifts, block_size, axis=0)[:n_frames]
+
+
+def fourier_shift(frames, shifts):
+    """Shift frames by sub-pixel shifts, applying phase ramps in Fourier space.
+
+    The phase ramps are applied separably along both axes to the real Fourier transforms of all frames at once. Note
+    that the shift is cyclic, i.e. flux that is shifted beyond one edge re-enters the frame on the opposite edge. This
+    is negligible for shifts of a fraction of a pixel.
+
+    Args:
+        frames (np.ndarray, ndim=2 or 3):
+            Single frame or stack of frames with the zero-th axis being the time axis.
+        shifts (array_like):
+            Shift along both axes, either a single shift for a single frame or of shape (n_frames, 2) for a stack.
+
+    Returns:
+        shifted (np.ndarray):
+            Shifted frames of the same shape as the input frames.
+    """
+
+    # Check input parameters
+    if not isinstance(frames, np.ndarray):
+        raise SpecklepyTypeError('fourier_shift()', argname='frames', argtype=type(frames), expected='np.ndarray')
+    if frames.ndim not in [2, 3]:
+        raise SpecklepyValueError('fourier_shift()', argname='frames.ndim', argvalue=frames.ndim, expected='2 or 3')
+    shifts = np.array(shifts, dtype=float).reshape((-1, 2))
+    if frames.ndim == 3 and shifts.shape[0] != frames.shape[0]:
+        raise SpecklepyValueError('fourier_shift()', argname='shifts.shape', argvalue=shifts.shape,
+                                  expected=f"({frames.shape[0]}, 2)")
+
+    # Apply phase ramps along both axes
+    frame_shape = frames.shape[-2:]
+    f_frames = np.fft.rfft2(frames)
+    if frames.ndim == 2:
+        f_frames = f_frames[np.newaxis]
+    f_frames *= np.exp(-2j * np.pi * np.outer(shifts[:, 0], np.fft.fftfreq(frame_shape[0])))[:, :, np.newaxis]
+    f_frames *= np.exp(-2j * np.pi * np.outer(shifts[:, 1], np.fft.rfftfreq(frame_shape[1])))[:, np.newaxis, :]
+    shifted = np.fft.irfft2(f_frames, s=frame_shape)
+
+    if frames.ndim == 2:
+        return shifted[0]
+    return shifted
+
+
 def get_pad_vectors(shifts, cube_mode=False, return_reference_image_pad_vector=False):
     """Computes padding vectors from the relative shifts between files.
 
     Args:
         shifts (list or np.ndarray):
-            Shifts between files, relative to a reference image. See get_shifts function for details.
+            Shifts between files, relative to a reference image. See get_shifts function for details. Non-integer
+            shifts are rounded to the nearest pixel.
         cube_mode (bool, optional):
             If image is a cube, the estimated pad vectors will obtain pad_vector entries of (0, 0) for the zeroth axis.
             Default is False.
@@ -216,6 +565,10 @@ def get_pad_vectors(shifts, cube_mode=False, return_reference_image_pad_vector=F
         raise SpecklepyTypeError('get_pad_vectors()', argname='return_reference_image_pad_vector',
                                  argtype=type(return_reference_image_pad_vector), expected='bool')
 
+    # Round sub-pixel shifts
+    if not np.issubdtype(np.array(shifts).dtype, np.integer):
+        shifts = np.round(shifts).astype(int)
+
     # Initialize list
     pad_vectors = []
 
@@ -249,7 +602,8 @@ def pad_array(array, pad_vector, mode='same', reference_image_pad_vector=None):
     mode.
 
     Pads an array with zeros to match a desired field size. Intermediately, it always creates a 'full' image and only
-    in 'same' mode it crops the edges such that the returned array covers only the field of the reference image.
+    in 'same' mode it crops the edges such that the returned array covers only the field of the reference image. In
+    'valid' mode, it crops the field that is covered by all images, which is derived from the pad vector itself.
 
     Args:
         array (np.ndarray):
@@ -257,8 +611,8 @@ def pad_array(array, pad_vector, mode='same', reference_image_pad_vector=None):
         pad_vector (list):
             List of padding vectors, as obtained from get_pad_vectors().
         mode (str, optional):
-            Define the size of the output image as 'same' to the reference image or expanding to include the 'full'
-            covered field.
+            Define the size of the output image as 'same' to the reference image, expanding to include the 'full'
+            covered field or reducing to the 'valid' field that is covered by all images.
         reference_image_pad_vector (tuple or list, optional):
             Used in `same` mode to estimate the position of the reference image and crop beyond.
 
@@ -293,11 +647,136 @@ def pad_array(array, pad_vector, mode='same', reference_image_pad_vector=None):
         pass
 
     elif mode == 'valid':
-        raise NotImplementedError("specklepy.core.alignment.pad_array does not support the 'valid' mode yet!")
+        # The sum of the pad widths is the extent of the shifts along the axis, by which the valid field is smaller
+        # than the array, starting at that extent within the 'full' field
+        crop = [slice(sum(pad_vector[axis]), array.shape[axis]) for axis in (-2, -1)]
+        padded = padded[(Ellipsis, *crop)]
 
     return padded
 
 
+def get_canvas_shape(image_shape, shifts, mode='same'):
+    """Compute the shape of the field that is covered by shifted images.
+
+    Args:
+        image_shape (tuple):
+            Shape of the individual images.
+        shifts (list or np.ndarray):
+            Shifts between files, relative to a reference image. See get_shifts function for details.
+        mode (str, optional):
+            Define the size of the field as 'same' to the reference image, expanding to include the 'full' covered
+            field or reducing to the 'valid' field that is covered by all images. The fields match those of
+            pad_array(). Default is 'same'.
+
+    Returns:
+        canvas_shape (tuple):
+            Shape of the field.
+    """
+    shifts = np.round(shifts).astype(int)
+    shift_min = np.min(shifts, axis=0)
+    shift_max = np.max(shifts, axis=0)
+    if mode == 'same':
+        extent = shift_max - shift_min - np.abs(shift_min) - np.abs(shift_max)
+    elif mode == 'full':
+        extent = shift_max - shift_min
+    elif mode == 'valid':
+        extent = shift_min - shift_max
+        if np.any(-extent >= np.array(image_shape[-2:])):
+            raise RuntimeError(f"The shifts {shift_min} to {shift_max} are too large for a field that is covered by "
+                               f"all images of shape {image_shape}!")
+    else:
+        raise SpecklepyValueError('get_canvas_shape()', argname='mode', argvalue=mode,
+                                  expected="'same', 'full' or 'valid'")
+    return image_shape[-2] + int(extent[0]), image_shape[-1] + int(extent[1])
+
+
+def place_into_canvas(canvas, array, shift, mode='same', shifts=None, add=True):
+    """Add or write a shifted array into a canvas in place.
+
+    This is the in-place counterpart of pad_array(): Instead of padding and cropping a copy of the array, only the
+    region that overlaps with the canvas is added to or written into the canvas, through slices along the last two
+    axes. The canvas is typically initialized with the shape from get_canvas_shape(). Pixels of the array that are
+    shifted beyond the canvas edges are dropped.
+
+    Args:
+        canvas (np.ndarray):
+            Destination array, which is modified in place.
+        array (np.ndarray):
+            Array that is placed into the canvas. Leading axes, e.g. the time axis of cubes, have to match the canvas.
+        shift (tuple):
+            Shift of the array relative to the reference image. Non-integer shifts are rounded to the nearest pixel.
+        mode (str, optional):
+            Field that is covered by the canvas, either 'same' to the reference image, the 'full' field covered by any
+            of the `shifts` or the 'valid' field covered by all of them. Default is 'same'.
+        shifts (list or np.ndarray, optional):
+            Shifts of all arrays, which locate the origin of the canvas as in pad_array(). Required in 'full' and
+            'valid' modes. In
+            'same' mode, the origin is the origin of the reference image if not provided, which is identical if the
+            shifts range from negative to positive values, e.g. if they contain the (0, 0) shift of the reference.
+        add (bool, optional):
+            Set to False for writing the array into the canvas instead of adding to it. Default is True.
+
+    Returns:
+        canvas (np.ndarray):
+            The modified canvas.
+    """
+
+    # Derive the position of the array within the canvas
+    offset = get_canvas_offset(shift, mode=mode, shifts=shifts)
+
+    # Compute the slices of the overlapping region
+    canvas_slices = [Ellipsis]
+    array_slices = [Ellipsis]
+    for o, n_array, n_canvas in zip(offset, array.shape[-2:], canvas.shape[-2:]):
+        start = max(o, 0)
+        stop = min(o + n_array, n_canvas)
+        if stop <= start:
+            # No overlap between the array and the canvas
+            return canvas
+        canvas_slices.append(slice(start, stop))
+        array_slices.append(slice(start - o, stop - o))
+
+    if add:
+        canvas[tuple(canvas_slices)] += array[tuple(array_slices)]
+    else:
+        canvas[tuple(canvas_slices)] = array[tuple(array_slices)]
+    return canvas
+
+
+def get_canvas_offset(shift, mode='same', shifts=None):
+    """Compute the position of a shifted array within a canvas, see place_into_canvas().
+
+    Args:
+        shift (tuple):
+            Shift of the array relative to the reference image. Non-integer shifts are rounded to the nearest pixel.
+        mode (str, optional):
+            Field that is covered by the canvas, see place_into_canvas(). Default is 'same'.
+        shifts (list or np.ndarray, optional):
+            Shifts of all arrays, which locate the origin of the canvas. Required in 'full' and 'valid' modes.
+
+    Returns:
+        offset (np.ndarray):
+            Index of the array origin within the canvas along both axes, which may be negative or exceed the canvas.
+    """
+    offset = np.round(shift).astype(int)
+    if mode == 'same':
+        if shifts is not None:
+            shift_min = np.min(np.round(shifts).astype(int), axis=0)
+            offset = offset - shift_min - np.abs(shift_min)
+    elif mode in ['full', 'valid']:
+        if shifts is None:
+            raise SpecklepyValueError('get_canvas_offset()', argname='shifts', argvalue=shifts,
+                                      expected=f"list of shifts in '{mode}' mode")
+        if mode == 'full':
+            offset = offset - np.min(np.round(shifts).astype(int), axis=0)
+        else:
+            offset = offset - np.max(np.round(shifts).astype(int), axis=0)
+    else:
+        raise SpecklepyValueError('get_canvas_offset()', argname='mode', argvalue=mode,
+                                  expected="'same', 'full' or 'valid'")
+    return offset
+
+
 def _adapt_max_coordinate(index):
     """Cast the upper interval border, such that indexing returns the correct
     entries.
@@ -1,13 +1,18 @@
+import glob
 import numpy as np
-from numpy.fft import fft2, ifft2, fftshift
+from numpy.fft import ifft2, fftshift
 import os
-from tqdm import trange
+import scipy.fft
+from tqdm import tqdm, trange
 
 from astropy.io import fits
 
-from specklepy.core.alignment import get_pad_vectors, pad_array
+from specklepy.core.alignment import get_canvas_offset, get_canvas_shape, place_into_canvas
 from specklepy.core.psfmodel import PSFModel
+from specklepy.core.ssa import get_frame_quality, select_frames
 from specklepy.exceptions import SpecklepyValueError
+from specklepy.io.cache import get_key
+from specklepy.io.psffile import read_psf_file
 from specklepy.logging import logger
 from specklepy.utils.transferfunctions import otf
 
@@ -20,14 +25,18 @@ class FourierObject(object):
     Therefore it estimates the padding of the PSF and image frames.
     """
 
-    def __init__(self, in_files, psf_files, shifts, mode='same', in_dir=None):
+    def __init__(self, in_files, psf_files, shifts, mode='same', in_dir=None, frame_shifts=None, cache=None,
+                 spectrum_dir=None, region=None, psf_shape=None, checkpoint_dir=None, psf_generation=None,
+                 frame_weights=None, weight_fraction=None, weight_threshold=None, subpixel=False):
         """ Initialize a FourierObject instance.
 
         Args:
             in_files (list):
                 List of paths of the input files.
             psf_files (list):
-                List of paths of the PSF files.
+                List of paths of the PSF files. May be None, if the PSF frames are passed to coadd_fft() instead. PSF
+                files that are compressed by specklepy.io.psffile.compress_psf_file() are transformed by their basis
+                images only.
             shifts (list):
                 List of integer shifts between the files.
             mode (str, optional):
@@ -35,16 +44,84 @@ class FourierObject(object):
                 covered field. Default is 'same'.
             in_dir (str, optional):
                 Path to the input files.
+            frame_shifts (list of np.ndarray, optional):
+                List of the integer shifts of the individual frames within each file, relative to the file, see
+                specklepy.core.alignment.get_frame_shifts. These are added to the file shifts, such that the drift
+                within the files is corrected. The PSFs need to be extracted on the drift-corrected positions then.
+            cache (specklepy.io.cache.Cache, optional):
+                Cache that is consulted for the contributions of each file to the enumerator and denominator before
+                computing them. The contributions are identified by the image file and the content of the PSF file,
+                such that only files with modified PSFs are Fourier transformed again.
+            spectrum_dir (str, optional):
+                Directory for storing the Fourier transforms of the padded image frames as memory-mapped half-spectrum
+                cubes of complex64 type. The transforms are computed once and read from there afterwards, e.g. by the
+                FourierObject instances of later holography iterations, which then only need to transform the PSFs.
+                The cubes are identified by the input file, shifts and mode. Image frames are transformed on the fly
+                if not provided.
+            region (tuple of slice, optional):
+                Slices of the canvas along both axes, to which the reconstruction is restricted. The image frames are
+                placed directly into a canvas of the size of this region, such that all Fourier transforms are computed
+                on this smaller canvas, e.g. for segments of the field of view with their own PSFs. The full canvas is
+                reconstructed if not provided.
+            psf_shape (tuple, optional):
+                Shape of the PSF frames, which is required if no PSF files are provided.
+            checkpoint_dir (str, optional):
+                Directory for storing the contributions of each file to the enumerator and denominator as
+                memory-mapped complex arrays. A checkpoint is identified by the image file, its position in the canvas
+                and the PSF generation, such that resumed or extended reconstructions only process new or modified
+                files. Checkpoints of other PSF generations of the same file are removed, so the directory should not
+                be shared between reconstructions of different regions. No checkpoints are stored if not provided.
+            psf_generation (str, optional):
+                Tag of the PSF estimates, e.g. a key of the reference stars and extraction parameters. This is required
+                for checkpoints if no PSF files are provided, and the content of the PSF files is used otherwise.
+            frame_weights (str or list of np.ndarray, optional):
+                Weights of the frames in the enumerator and denominator. Can be 'strehl' for weighting the frames by the
+                peak-to-flux ratio of their PSFs as a Strehl proxy, which is computed from the PSF cube of each file,
+                or a list of arrays with the weights of the frames of each file. All frames are weighted equally if
+                not provided, or by the Strehl proxy if a weight cutoff is provided.
+            weight_fraction (float, optional):
+                Fraction of the frames with the highest weights within each file to co-add. The other frames are
+                skipped without Fourier transforming them.
+            weight_threshold (float, optional):
+                Minimum weight of co-added frames, see `weight_fraction`.
+            subpixel (bool, optional):
+                Align the files on sub-pixel shifts. The image frames are placed into the canvas on the rounded shifts
+                and the remaining fractions are applied as phase ramps to their Fourier transforms, which are computed
+                once per file. Note that the phase ramps shift cyclically. The shifts are rounded if False, which is
+                the default.
         """
 
         # Assert that there are the same number of inFiles and psfFiles, which should be the case after running the
         # holography function.
-        if not len(in_files) == len(psf_files):
+        if psf_files is None:
+            if psf_shape is None:
+                raise ValueError("FourierObject requires the psf_shape argument if no PSF files are provided!")
+            if checkpoint_dir is not None and psf_generation is None:
+                raise ValueError("FourierObject requires the psf_generation argument for checkpoints if no PSF files "
+                                 "are provided!")
+        elif not len(in_files) == len(psf_files):
             raise ValueError(f"The number of input files ({len(in_files)}) and PSF files ({len(psf_files)}) do not "
                              f"match!")
         self.in_files = in_files
         self.psf_files = psf_files
         self.shifts = shifts
+        self.frame_shifts = frame_shifts
+        self.cache = cache
+        self.spectrum_dir = spectrum_dir
+        self.checkpoint_dir = checkpoint_dir
+        self.psf_generation = psf_generation
+        if frame_weights is None and (weight_fraction is not None or weight_threshold is not None):
+            frame_weights = 'strehl'
+        if isinstance(frame_weights, str) and frame_weights.lower() != 'strehl':
+            raise SpecklepyValueError('FourierObject', argname='frame_weights', argvalue=frame_weights,
+                                      expected="'strehl' or a list of arrays")
+        if isinstance(frame_weights, str) and psf_files is None:
+            raise ValueError("FourierObject requires PSF files for computing frame weights from the PSFs!")
+        self.frame_weights = frame_weights
+        self.weight_fraction = weight_fraction
+        self.weight_threshold = weight_threshold
+        self.subpixel = subpixel
+        self.phase_ramps = {}
 
         # Check whether mode is supported
         if mode not in ['same', 'full', 'valid']:
@@ -56,51 +133,62 @@ class FourierObject(object):
         else:
             self.in_dir = in_dir
 
-        # Extract padding vectors for images and reference image
-        logger.info("Initializing padding vectors")
-        # files_contain_data_cubes = fits.getdata(in_files[0]).ndim == 3
-        self.pad_vectors, self.reference_image_pad_vector = get_pad_vectors(shifts=shifts,
-                                                                            cube_mode=False,
-                                                                            return_reference_image_pad_vector=True)
+        # Get example image frame and derive the final image size
         file_index = 0
-        image_pad_vector = self.pad_vectors[file_index]
-
-        # Get example image frame, used as final image size
         image_file = in_files[file_index]
         logger.info(f"\tUsing example image frame from {image_file}")
-        img = fits.getdata(os.path.join(self.in_dir, image_file))[0]  # Remove time axis padding
-        img = pad_array(array=img, pad_vector=image_pad_vector, mode=mode,
-                        reference_image_pad_vector=self.reference_image_pad_vector)
+        frame_shape = fits.getdata(os.path.join(self.in_dir, image_file))[0].shape  # Remove time axis
+        image_shape = get_canvas_shape(frame_shape, shifts, mode=mode)
+        if region is not None:
+            region = tuple(slice(*axis_slice.indices(n)[:2]) for axis_slice, n in zip(region, image_shape))
+            image_shape = (region[0].stop - region[0].start, region[1].stop - region[1].start)
+        self.region = region
         logger.info(f"\tShift: {shifts[file_index]}")
-        logger.info(f"\tShape: {img.shape}")
+        logger.info(f"\tShape: {image_shape}")
 
         # Get example PSF frame
-        psf_file = psf_files[file_index]
-        logger.info(f"\tUsing example PSF frame from {psf_file}")
-        psf = fits.getdata(psf_file)[0]
+        if psf_files is None:
+            psf = np.zeros(psf_shape)
+        else:
+            psf_file = psf_files[file_index]
+            logger.info(f"\tUsing example PSF frame from {psf_file}")
+            psf = read_psf_file(psf_file)[0][0]
         logger.info(f"\tShape: {psf.shape}")
 
         # Estimate the padding vector for the f_psf frames to have the same xy-extent as f_img
-        dx = img.shape[0] - psf.shape[0]
-        dy = img.shape[1] - psf.shape[1]
+        dx = image_shape[0] - psf.shape[0]
+        dy = image_shape[1] - psf.shape[1]
         psf_pad_vector = ((dx // 2, int(np.ceil(dx / 2))), (dy // 2, int(np.ceil(dy / 2))))
         logger.info(f"\tPad_width for PSFs: {psf_pad_vector}")
 
         # Apply padding to PSF frame
         psf = np.pad(psf, psf_pad_vector, mode='constant', )
-        if not img.shape == psf.shape:
-            raise ValueError(f"The Fourier transformed images and PSFs have different shape, {img.shape} and "
+        if not image_shape == psf.shape:
+            raise ValueError(f"The Fourier transformed images and PSFs have different shape, {image_shape} and "
                              f"{psf.shape}. Something went wrong with the padding!")
         self.psf_pad_vector = psf_pad_vector
-
-        # Initialize the enumerator, denominator and Fourier object attributes
-        self.enumerator = np.zeros(img.shape, dtype='complex128')
-        self.denominator = np.zeros(img.shape, dtype='complex128')
-        self.fourier_image = np.zeros(img.shape, dtype='complex128')
-
-    def coadd_fft(self):
+        self.psf_center = tuple(pad[0] + (psf_size - pad[0] - pad[1] - 1) / 2
+                                for pad, psf_size in zip(psf_pad_vector, psf.shape))
+
+        # Initialize the enumerator, denominator and Fourier object attributes. The enumerator and denominator are
+        # accumulated on the half spectrum of the real Fourier transform, as the image and PSF frames are real
+        self.image_shape = image_shape
+        spectrum_shape = (image_shape[0], image_shape[1] // 2 + 1)
+        self.enumerator = np.zeros(spectrum_shape, dtype='complex128')
+        self.denominator = np.zeros(spectrum_shape)
+        self.fourier_image = np.zeros(image_shape, dtype='complex128')
+
+    def coadd_fft(self, psf_frames=None):
         """Co-add the Fourier transforms of the image and PSF frames.
 
+        Args:
+            psf_frames (callable, optional):
+                Function that takes the index of a file and its image cube, and returns an iterator over the PSF
+                frames of this file. This allows for estimating the PSFs in the same pass over each cube as the Fourier
+                transforms, see specklepy.core.psfextraction.ReferenceStars.get_psf_frames(). The cache is not
+                consulted in this case, as the contributions are identified by the PSFs. The PSF frames are read from
+                the PSF files if not provided.
+
         Returns:
             fourier_image (np.ndarray, dtype=np.comlex128):
                 Fourier-transformed object reconstruction.
@@ -111,35 +199,309 @@ class FourierObject(object):
 
         for file_index in trange(len(self.in_files), desc="Processing files"):
 
-            # Open PSF and image files
-            psf_cube = fits.getdata(self.psf_files[file_index])
-            image_cube = fits.getdata(os.path.join(self.in_dir, self.in_files[file_index]))
-            n_frames = image_cube.shape[0]
+            # Open PSF file and derive the frame weights. Compressed PSF files provide the basis images and coefficients
+            file = self.in_files[file_index]
+            if psf_frames is None:
+                psf_cube, psf_coefficients = read_psf_file(self.psf_files[file_index])
+            else:
+                psf_cube, psf_coefficients = None, None
+            weights, frame_selection = self._get_frame_weights(file_index, psf_cube=psf_cube,
+                                                               psf_coefficients=psf_coefficients)
+
+            # Consult the checkpoints for the partial sums of this file
+            if self.checkpoint_dir is not None:
+                checkpoint = self._get_checkpoint_path(file_index, psf_cube=psf_cube, psf_coefficients=psf_coefficients,
+                                                       weights=weights, frame_selection=frame_selection)
+                if os.path.isfile(checkpoint):
+                    logger.info(f"Using checkpointed partial sums of file {file} from {checkpoint}")
+                    partials = np.load(checkpoint, mmap_mode='r')
+                    self.enumerator += partials[0]
+                    self.denominator += partials[1].real
+                    continue
+
+            # Consult the cache for the contributions of this file
+            entry = None
+            use_cache = self.cache is not None and psf_frames is None
+            if use_cache:
+                key = self.cache.key(files=[file], in_dir=self.in_dir, function='coadd_fft', psfs=psf_cube,
+                                     psf_coefficients=psf_coefficients, weights=weights,
+                                     frame_selection=frame_selection, subpixel=self.subpixel,
+                                     **self._get_placement(file_index))
+                entry = self.cache.load(key)
+
+            if entry is not None:
+                logger.info(f"Using cached Fourier transforms of file {file}")
+                enumerator = entry['enumerator']
+                denominator = entry['denominator']
+            else:
+                if use_cache or self.checkpoint_dir is not None:
+                    enumerator = np.zeros(self.enumerator.shape, dtype='complex128')
+                    denominator = np.zeros(self.denominator.shape)
+                else:
+                    # Accumulate directly into the attributes
+                    enumerator = self.enumerator
+                    denominator = self.denominator
+
+                if psf_frames is not None:
+                    # Read the image cube once for estimating the PSFs and transforming the frames
+                    image_cube = fits.getdata(os.path.join(self.in_dir, file))
+                    psf_cube = iter(psf_frames(file_index, image_cube))
+                    if frame_selection is not None:
+                        selected = set(frame_selection)
+                        psf_cube = (psf for index, psf in enumerate(psf_cube) if index in selected)
+                else:
+                    image_cube = None
+                    if frame_selection is not None and psf_coefficients is not None:
+                        psf_coefficients = psf_coefficients[frame_selection]
+                    elif frame_selection is not None:
+                        psf_cube = psf_cube[frame_selection]
+                if weights is not None and frame_selection is not None:
+                    weights = weights[frame_selection]
+
+                phase_ramp = self._get_phase_ramp(file_index)
+                spectra = self._get_image_spectra(file_index, image_cube=image_cube, frame_selection=frame_selection)
+                psf_spectra = self._get_psf_spectra(psf_cube, psf_coefficients=psf_coefficients)
+                for frame_index, (f_img, f_psf) in enumerate(zip(spectra, psf_spectra)):
+
+                    # Apply the sub-pixel fraction of the shift
+                    if phase_ramp is not None:
+                        f_img = f_img * phase_ramp
+
+                    # Co-adding for the (weighted) average
+                    if weights is None:
+                        enumerator += np.multiply(f_img, np.conjugate(f_psf))
+                        denominator += np.square(f_psf.real) + np.square(f_psf.imag)
+                    else:
+                        enumerator += weights[frame_index] * np.multiply(f_img, np.conjugate(f_psf))
+                        denominator += weights[frame_index] * (np.square(f_psf.real) + np.square(f_psf.imag))
+
+                # Exhaust the PSF frames, such that generators can finalize, e.g. by saving the PSFs
+                if psf_frames is not None:
+                    for _ in psf_cube:
+                        pass
+
+                if use_cache:
+                    self.cache.store(key, enumerator=enumerator, denominator=denominator)
+
+            if self.checkpoint_dir is not None:
+                self._store_checkpoint(checkpoint, enumerator, denominator)
+            if enumerator is not self.enumerator:
+                self.enumerator += enumerator
+                self.denominator += denominator
 
-            for frame_index in trange(n_frames, desc="Fourier transforming frames"):
+        # Compute the object:
+        # Note that by this division implicitly does averaging. By this implicit summing up of enumerator and
+        # denominator, this computation is cheaper in terms of memory usage
+        self.fourier_image = fftshift(expand_half_spectrum(np.divide(self.enumerator, self.denominator),
+                                                           self.image_shape))
+
+        return self.fourier_image
 
-                # Padding and transforming the image
-                img = pad_array(array=image_cube[frame_index],
-                                pad_vector=self.pad_vectors[file_index],
-                                mode=self.mode,
-                                reference_image_pad_vector=self.reference_image_pad_vector)
-                f_img = fftshift(fft2(img))
+    def _get_placement(self, file_index):
+        """Parameters that define how the frames of a file are placed into the canvas.
 
-                # Padding and Fourier transforming PSF
-                psf = psf_cube[frame_index]
+        The position of the file within the canvas is used instead of the shifts of all files, such that the keys of
+        existing files remain valid if further files with shifts within the canvas are added.
+        """
+        return {'shift': self.shifts[file_index],
+                'offset': get_canvas_offset(self.shifts[file_index], mode=self.mode, shifts=self.shifts),
+                'frame_shifts': self.frame_shifts[file_index] if self.frame_shifts is not None else None,
+                'image_shape': self.image_shape, 'region': self.region}
+
+    def _get_psf_spectra(self, psf_cube, psf_coefficients=None):
+        """Yield the real Fourier transforms of the padded PSF frames.
+
+        Args:
+            psf_cube (np.ndarray or iterator):
+                PSF frames, or the basis images of a compressed PSF file.
+            psf_coefficients (np.ndarray, ndim=2, optional):
+                Coefficients of the frames with respect to the basis images. If provided, only the basis images are
+                Fourier transformed and the spectra of the frames are assembled as linear combinations.
+
+        Yields:
+            f_psf (np.ndarray, dtype=complex):
+                Half spectrum of the padded PSF frame.
+        """
+        if psf_coefficients is None:
+            for psf in psf_cube:
                 psf = np.pad(psf, self.psf_pad_vector, mode='constant',)
-                f_psf = fftshift(fft2(psf))
+                yield scipy.fft.rfft2(psf, workers=-1)
+        else:
+            f_basis = scipy.fft.rfft2(np.pad(psf_cube, ((0, 0),) + self.psf_pad_vector, mode='constant'), workers=-1)
+            for coefficients in psf_coefficients:
+                yield np.tensordot(coefficients, f_basis, axes=1)
 
-                # Co-adding for the average
-                self.enumerator += np.multiply(f_img, np.conjugate(f_psf))
-                self.denominator += np.abs(np.square(f_psf))
+    def _get_phase_ramp(self, file_index):
+        """Phase ramp that shifts the image frames of a file by the sub-pixel fraction of its shift.
 
-        # Compute the object:
-        # Note that by this division implicitly does averaging. By this implicit summing up of enumerator and
-        # denominator, this computation is cheaper in terms of memory usage
-        self.fourier_image = np.divide(self.enumerator, self.denominator)
+        The phase ramps are computed once per file and stored in the `phase_ramps` attribute.
 
-        return self.fourier_image
+        Args:
+            file_index (int):
+                Index of the file in the `in_files` attribute.
+
+        Returns:
+            phase_ramp (np.ndarray, dtype=complex):
+                Phase ramp on the half spectrum, None if not in `subpixel` mode or if the shift is integer.
+        """
+        if not self.subpixel:
+            return None
+        if file_index not in self.phase_ramps:
+            shift = np.array(self.shifts[file_index], dtype=float)
+            fraction = shift - np.round(shift)
+            if np.all(fraction == 0):
+                self.phase_ramps[file_index] = None
+            else:
+                logger.info(f"Applying a sub-pixel shift of {fraction} to file {self.in_files[file_index]}")
+                ramp_x = np.exp(-2j * np.pi * fraction[0] * np.fft.fftfreq(self.image_shape[0]))
+                ramp_y = np.exp(-2j * np.pi * fraction[1] * np.fft.rfftfreq(self.image_shape[1]))
+                self.phase_ramps[file_index] = np.outer(ramp_x, ramp_y)
+        return self.phase_ramps[file_index]
+
+    def _get_frame_weights(self, file_index, psf_cube=None, psf_coefficients=None):
+        """Derive the weights of the frames of a file and select the frames above the cutoff.
+
+        Args:
+            file_index (int):
+                Index of the file in the `in_files` attribute.
+            psf_cube (np.ndarray, optional):
+                PSF cube of the file, required for weights of type 'strehl'.
+            psf_coefficients (np.ndarray, optional):
+                Coefficients of the PSF frames, if `psf_cube` contains the basis images of a compressed PSF file.
+
+        Returns:
+            weights (np.ndarray):
+                Weights of all frames of the file, None if the frames are not weighted.
+            frame_selection (np.ndarray):
+                Indizes of the frames to co-add, None if all frames are co-added.
+        """
+        if self.frame_weights is None:
+            return None, None
+        if isinstance(self.frame_weights, str):
+            if psf_coefficients is not None:
+                psf_cube = np.tensordot(psf_coefficients, psf_cube, axes=1)
+            weights = get_frame_quality(psf_cube)
+        else:
+            weights = np.asarray(self.frame_weights[file_index], dtype=float)
+        if self.weight_fraction is None and self.weight_threshold is None:
+            return weights, None
+        frame_selection = select_frames(weights, fraction=self.weight_fraction, threshold=self.weight_threshold)
+        logger.info(f"Co-adding {len(frame_selection)} of {len(weights)} frames of file {self.in_files[file_index]}")
+        return weights, frame_selection
+
+    def _get_checkpoint_path(self, file_index, psf_cube=None, psf_coefficients=None, weights=None,
+                             frame_selection=None):
+        """Path of the checkpoint of a file, named by the file and a key of its input and PSF generation."""
+        if self.psf_generation is not None:
+            psf_generation = self.psf_generation
+        else:
+            psf_generation = get_key(psfs=psf_cube, psf_coefficients=psf_coefficients)
+        file = self.in_files[file_index]
+        key = get_key(files=[file], in_dir=self.in_dir, function='coadd_fft', psf_generation=psf_generation,
+                      weights=weights, frame_selection=frame_selection, subpixel=self.subpixel,
+                      **self._get_placement(file_index))
+        name = os.path.splitext(os.path.basename(file))[0]
+        return os.path.join(self.checkpoint_dir, f"partials_{name}_{key[:16]}.npy")
+
+    def _store_checkpoint(self, path, enumerator, denominator):
+        """Store the partial sums of a file as a complex cube and remove outdated checkpoints of the file."""
+        if not os.path.isdir(self.checkpoint_dir):
+            os.makedirs(self.checkpoint_dir)
+        logger.info(f"Storing checkpoint {path}")
+        partials = np.lib.format.open_memmap(path + '.tmp', mode='w+', dtype='complex128',
+                                             shape=(2,) + enumerator.shape)
+        partials[0] = enumerator
+        partials[1] = denominator
+        partials.flush()
+        del partials
+        os.replace(path + '.tmp', path)
+
+        # Checkpoints of other PSF generations are outdated
+        stem = path.rsplit('_', 1)[0]
+        for other in glob.glob(glob.escape(stem) + '_' + '?' * 16 + '.npy'):
+            if other != path:
+                os.remove(other)
+
+    def _get_image_spectra(self, file_index, image_cube=None, frame_selection=None):
+        """Yield the real Fourier transforms of the padded image frames of a file.
+
+        If the `spectrum_dir` attribute is set, the transforms are read from a memory-mapped cube in this directory, or
+        written to it if not existing yet.
+
+        Args:
+            file_index (int):
+                Index of the file in the `in_files` attribute.
+            image_cube (np.ndarray, optional):
+                Image cube of the file, if already in memory. The cube is read from the file if not provided.
+            frame_selection (np.ndarray, optional):
+                Indizes of the frames to transform. If provided, only these frames are read from an existing cube
+                in `spectrum_dir`, or transformed without storing them otherwise. All frames are used if not provided.
+
+        Yields:
+            f_img (np.ndarray, dtype=complex):
+                Half spectrum of the padded image frame.
+        """
+
+        file = self.in_files[file_index]
+        path = None
+        if self.spectrum_dir is not None:
+            key = get_key(files=[file], in_dir=self.in_dir, **self._get_placement(file_index))
+            name = os.path.splitext(os.path.basename(file))[0]
+            path = os.path.join(self.spectrum_dir, f"spectra_{name}_{key[:16]}.npy")
+            if os.path.isfile(path):
+                logger.info(f"Reading Fourier transformed image frames of file {file} from {path}")
+                spectra = np.load(path, mmap_mode='r')
+                if frame_selection is None:
+                    frame_selection = range(spectra.shape[0])
+                for frame_index in tqdm(frame_selection, desc="Reading transformed frames"):
+                    yield spectra[frame_index]
+                return
+            if frame_selection is not None:
+                # Storing only the selected frames would not serve other selections
+                path = None
+            elif not os.path.isdir(self.spectrum_dir):
+                os.makedirs(self.spectrum_dir)
+
+        # Open image file
+        if image_cube is None:
+            image_cube = fits.getdata(os.path.join(self.in_dir, file))
+        n_frames = image_cube.shape[0]
+        if frame_selection is None:
+            frame_selection = range(n_frames)
+        if path is not None:
+            logger.info(f"Storing Fourier transformed image frames of file {file} to {path}")
+            spectra = np.lib.format.open_memmap(path + '.tmp', mode='w+', dtype='complex64',
+                                                shape=(n_frames,) + self.enumerator.shape)
+
+        # Initialize the padded image buffer. All frames with the same shift cover the same region of the buffer, such
+        # that the pixels outside of this region remain zero and the buffer needs to be reset only if the shift changes
+        img = np.zeros(self.image_shape)
+        previous_shift = None
+
+        for frame_index in tqdm(frame_selection, desc="Fourier transforming frames"):
+
+            # Padding and transforming the image, where the origin of the region is shifted to the origin of the canvas
+            shift = np.array(self.shifts[file_index])
+            if self.frame_shifts is not None:
+                shift = shift + self.frame_shifts[file_index][frame_index]
+            if self.region is not None:
+                shift = shift - np.array([self.region[0].start, self.region[1].start])
+            if previous_shift is not None and np.any(shift != previous_shift):
+                img[:] = 0
+            previous_shift = shift
+            place_into_canvas(img, image_cube[frame_index], shift, mode=self.mode, shifts=self.shifts, add=False)
+            f_img = scipy.fft.rfft2(img, workers=-1)
+
+            # Store the transform, such that all iterations use the same precision
+            if path is not None:
+                spectra[frame_index] = f_img
+                f_img = spectra[frame_index]
+            yield f_img
+
+        if path is not None:
+            spectra.flush()
+            del spectra
+            os.replace(path + '.tmp', path)
 
     def apodize(self, type, radius, crop=False):
         """Apodize the Fourier object with a Gaussian or Airy disk kernel.
@@ -158,19 +520,15 @@ class FourierObject(object):
                 Apodized Fourier-plane image.
         """
 
-        # Assert image shape
-        if self.fourier_image.shape[0] != self.fourier_image.shape[1]:
-            logger.warning("The apodization is applied to a non-quadratic input image. This may cause some "
-                           "unpredictable results!")
-
         logger.info("Apodizing the object...")
         if type is None and radius is None:
             logger.warning(f"Apodization is skipped for either type or radius not being defined!")
             return self.fourier_image
 
-        # Interpret function input and compute apodization PSF
+        # Interpret function input and compute apodization PSF. The kernel is centered on the padded PSF frames, such
+        # that the apodized image is not shifted with respect to the input frames, independent of the canvas shape
         psf_model = PSFModel(type=type, radius=radius)
-        apodization_psf = psf_model(self.fourier_image.shape)
+        apodization_psf = psf_model(self.fourier_image.shape, center=self.psf_center)
 
         # Crop corners of the PSF
         if crop:
@@ -205,3 +563,26 @@ class FourierObject(object):
             image_scale = total_flux / np.sum(image)
             image = np.multiply(image, image_scale)
         return image
+
+
+def expand_half_spectrum(half_spectrum, shape):
+    """Expand the half spectrum of a real Fourier transform to the full spectrum.
+
+    Args:
+        half_spectrum (np.ndarray, dtype=complex):
+            Half spectrum as obtained from scipy.fft.rfft2, with `shape[1] // 2 + 1` columns.
+        shape (tuple):
+            Shape of the full spectrum.
+
+    Returns:
+        spectrum (np.ndarray, dtype=complex):
+            Full spectrum, as obtained from np.fft.fft2, where the missing columns are derived from the Hermitian
+            symmetry of the transform.
+    """
+    n_columns = half_spectrum.shape[1]
+    spectrum = np.empty(shape, dtype=half_spectrum.dtype)
+    spectrum[:, :n_columns] = half_spectrum
+    rows = -np.arange(shape[0]) % shape[0]
+    columns = shape[1] - np.arange(n_columns, shape[1])
+    spectrum[:, n_columns:] = np.conjugate(half_spectrum[rows][:, columns])
+    return spectrum
@@ -1,191 +1,641 @@
-import numpy as np
-
-from astropy.io import fits
-
-from specklepy.core.aperture import Aperture
-from specklepy.core.fourierobject import FourierObject
-from specklepy.core.psfextraction import ReferenceStars
-from specklepy.core.reconstruction import Reconstruction
-from specklepy.core.sourceextraction import extract_sources
-from specklepy.io.filearchive import FileArchive
-from specklepy.io.reconstructionfile import ReconstructionFile
-from specklepy.exceptions import SpecklepyValueError
-from specklepy.logging import logger
-from specklepy.plotting.plots import imshow
-
-
-def holography(params, mode='same', debug=False):
-    """Execute the holographic image reconstruction.
-
-    The holographic image reconstruction is an algorithm as outlined, eg. by Schoedel et al (2013, Section 3). This
-    function follows that algorithm, see comments in the code. Most of the important functions are imported from other
-    modules of specklepy.
-
-    Args:
-        params (dict):
-            Dictionary that carries all important parameters.
-        mode (str, optional):
-            Define the size of the output image as 'same' to the reference
-            image or expanding to include the 'full' covered field. Default is
-            'same'.
-        debug (bool, optional):
-            Set to True to inspect intermediate results.
-            Default is False.
-
-    Returns:
-        image (np.ndarray): The image reconstruction.
-    """
-
-    logger.info(f"Starting holographic reconstruction...")
-    file_archive = FileArchive(file_list=params['PATHS']['inDir'], cards=[], dtypes=[])
-    in_files = file_archive.files
-    in_dir = file_archive.in_dir
-    tmp_dir = params['PATHS']['tmpDir']
-
-    # Input check
-    if mode not in ['same', 'full', 'valid']:
-        raise SpecklepyValueError('holography()', argname='mode', argvalue=mode,
-                                  expected="either 'same', 'full', or 'valid'")
-
-    if 'apodizationType' in params['APODIZATION']:
-        # Catch deprecated parameter name
-        logger.warning("Parameter 'apodizationType' is deprecated. Use 'type' instead!")
-        params['APODIZATION']['type'] = params['APODIZATION']['apodizationType']
-    if 'apodizationWidth' in params['APODIZATION']:
-        # Catch deprecated parameter name
-        logger.warning("Parameter 'apodizationWidth' is deprecated. Use 'radius' instead!")
-        params['APODIZATION']['radius'] = params['APODIZATION']['apodizationWidth']
-    if params['APODIZATION']['type'] is None or params['APODIZATION']['type'].lower() not in ['gaussian', 'airy']:
-        logger.error(f"Apodization type has not been set or of wrong type ({params['APODIZATION']['type']})")
-    if params['APODIZATION']['radius'] is None or not isinstance(params['APODIZATION']['radius'], (int, float)):
-        logger.error(f"Apodization radius has not been set or of wrong type ({params['APODIZATION']['radius']})")
-
-    # Initialize the outfile
-    out_file = ReconstructionFile(filename=params['PATHS']['outFile'], files=in_files,
-                                  cards={"RECONSTRUCTION": "Holography"}, in_dir=in_dir)
-
-    # Initialize reconstruction
-    reconstruction = Reconstruction(in_files=in_files, mode=mode, alignment_method='ssa',
-                                    reference_image=params['PATHS']['alignmentReferenceFile'],
-                                    in_dir=in_dir, tmp_dir=tmp_dir, out_file=params['PATHS']['outFile'],
-                                    var_ext=params['OPTIONS']['varianceExtensionName'],
-                                    box_indexes=params['OPTIONS']['box_indexes'], debug=debug)
-
-    # (i-ii) Align cubes
-    # shifts = get_shifts(files=in_files, reference_file=params['PATHS']['alignmentReferenceFile'],
-    #                     lazy_mode=True, return_image_shape=False, in_dir=in_dir, debug=debug)
-    shifts = reconstruction.shifts
-
-    # (iii) Compute SSA reconstruction
-    # image = ssa(in_files, mode=mode, outfile=out_file, in_dir=in_dir, tmp_dir=tmp_dir,
-    #             variance_extension_name=params['OPTIONS']['varianceExtensionName'])
-    image = reconstruction.coadd_long_exposures()
-    if isinstance(image, tuple):
-        # SSA returned a reconstruction image and a variance image
-        image, image_var = image
-    total_flux = np.sum(image)  # Stored for flux conservation
-
-    # Start iteration from steps (iv) through (xi)
-    while True:
-        # (iv) Astrometry and photometry, i.e. StarFinder
-        extract_sources(image=image,
-                        fwhm=params['STARFINDER']['starfinderFwhm'],
-                        noise_threshold=params['STARFINDER']['noiseThreshold'],
-                        background_subtraction=True,
-                        write_to=params['PATHS']['allStarsFile'],
-                        star_finder='DAO', debug=debug)
-
-        # (v) Select reference stars
-        print("\tPlease copy your desired reference stars from the all stars file into the reference star file!")
-        input("\tWhen you are done, hit a ENTER.")
-
-        # (vi) PSF extraction
-        ref_stars = ReferenceStars(psf_radius=params['PSFEXTRACTION']['psfRadius'],
-                                   reference_source_file=params['PATHS']['refSourceFile'], in_files=in_files,
-                                   save_dir=tmp_dir, in_dir=in_dir,
-                                   field_segmentation=params['PSFEXTRACTION']['fieldSegmentation'])
-        if params['PSFEXTRACTION']['mode'].lower() == 'epsf':
-            psf_files = ref_stars.extract_epsfs(file_shifts=shifts, debug=debug)
-        elif params['PSFEXTRACTION']['mode'].lower() in ['mean', 'median', 'weighted_mean']:
-            psf_files = ref_stars.extract_psfs(file_shifts=shifts, mode=params['PSFEXTRACTION']['mode'].lower(),
-                                               debug=debug)
-        else:
-            raise RuntimeError(f"PSF extraction mode '{params['PSFEXTRACTION']['mode']}' is not understood!")
-        logger.info("Saved the extracted PSFs...")
-
-        # (vii) Noise thresholding
-        psf_noise_mask = None
-        for file in psf_files:
-            with fits.open(file, mode='update') as hdu_list:
-                n_frames = hdu_list[0].header['NAXIS3']
-                if psf_noise_mask is None:
-                    psf_noise_mask = get_noise_mask(hdu_list[0].data[0],
-                                                    noise_reference_margin=
-                                                    params['PSFEXTRACTION']['noiseReferenceMargin'])
-                for index in range(n_frames):
-                    reference = np.ma.masked_array(hdu_list[0].data[index], mask=psf_noise_mask)
-                    background = np.mean(reference)
-                    noise = np.std(reference)
-                    update = np.maximum(hdu_list[0].data[index] - background -
-                                        params['PSFEXTRACTION']['noiseThreshold'] * noise, 0.0)
-                    if np.sum(update) == 0.0:
-                        raise ValueError("After background subtraction and noise thresholding, no signal is leftover. "
-                                         "Please reduce the noiseThreshold!")
-                    update = update / np.sum(update)  # Flux sum of order unity
-                    hdu_list[0].data[index] = update
-                    hdu_list.flush()
-
-        # (viii) Subtraction of secondary sources within the reference apertures
-        # TODO: Implement Secondary source subtraction
-        pass
-
-        # (ix) Estimate object, following Eq. 1 (Schoedel et al., 2013)
-        f_object = FourierObject(in_files, psf_files, shifts=shifts, mode=mode, in_dir=in_dir)
-        f_object.coadd_fft()
-
-        # (x) Apodization
-        f_object.apodize(type=params['APODIZATION']['type'], radius=params['APODIZATION']['radius'])
-
-        # (xi) Inverse Fourier transform to retain the reconstructed image
-        image = f_object.ifft(total_flux=total_flux)
-
-        # Inspect the latest reconstruction
-        if debug:
-            imshow(image)
-
-        # Save the latest reconstruction image to outfile
-        out_file.data = image
-
-        # Ask the user whether the iteration shall be continued or not
-        answer = input("\tDo you want to continue with one more iteration? [yes/no]\n\t")
-        if answer.lower() in ['n', 'no']:
-            break
-
-    # Repeat astrometry and photometry, i.e. StarFinder on final image
-    extract_sources(image=image, fwhm=params['STARFINDER']['starfinderFwhm'],
-                    noise_threshold=params['STARFINDER']['noiseThreshold'], background_subtraction=True,
-                    write_to=params['PATHS']['allStarsFile'], star_finder='DAO', debug=debug)
-
-    # Finally return the image
-    return image
-
-
-def get_noise_mask(frame, noise_reference_margin):
-    """Create an annulus-like mask within a given aperture for measuring noise
-    and (sky) background.
-
-    Args:
-        frame (np.ndarray):
-            Image frame within which the mask is derived.
-        noise_reference_margin (int):
-            Width of the reference annulus in pixels.
-
-    Returns:
-        annulus_mask (np.ndarray, dtype=bool):
-            Mask array, derived from the frame.
-    """
-    center = int((frame.shape[0] - 1) / 2)
-    radius = center - noise_reference_margin
-    tmp = Aperture(center, center, radius, data=frame, crop=False)
-    annulus_mask = np.logical_not(tmp.data.mask)
-    return annulus_mask
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+import numpy as np
+import os
+from scipy.spatial import cKDTree
+
+from astropy.io import fits
+
+from specklepy.core.aperture import Aperture
+from specklepy.core.fourierobject import FourierObject
+from specklepy.core.psfextraction import ReferenceStars, select_reference_stars
+from specklepy.core.psffitting import fit_psf_photometry, get_apodization_psf
+from specklepy.core.reconstruction import Reconstruction
+from specklepy.core.segmentation import Segmentation
+from specklepy.core.sourceextraction import extract_sources
+from specklepy.core.ssa import SUBPIXEL_UPSAMPLE_FACTOR
+from specklepy.io.cache import Cache, get_key
+from specklepy.io.filearchive import FileArchive
+from specklepy.io.psffile import PSFFile, compress_psf_file
+from specklepy.io.table import read_table
+from specklepy.io.reconstructionfile import ReconstructionFile
+from specklepy.exceptions import SpecklepyValueError
+from specklepy.logging import logger
+from specklepy.plotting.plots import imshow
+
+
+def holography(params, mode='same', batch=False, debug=False):
+    """Execute the holographic image reconstruction.
+
+    The holographic image reconstruction is an algorithm as outlined, eg. by Schoedel et al (2013, Section 3). This
+    function follows that algorithm, see comments in the code. Most of the important functions are imported from other
+    modules of specklepy.
+
+    Args:
+        params (dict):
+            Dictionary that carries all important parameters.
+        mode (str, optional):
+            Define the size of the output image as 'same' to the reference
+            image or expanding to include the 'full' covered field. Default is
+            'same'.
+        batch (bool, optional):
+            Run unattended, i.e. select the reference stars automatically from the extracted sources with
+            specklepy.core.psfextraction.select_reference_stars and iterate until the image or the source catalogue
+            changes by less than the tolerance from the 'BATCH' parameters, or until their maximum number of
+            iterations. Default is False.
+        debug (bool, optional):
+            Set to True to inspect intermediate results.
+            Default is False.
+
+    Returns:
+        image (np.ndarray): The image reconstruction.
+    """
+
+    logger.info(f"Starting holographic reconstruction...")
+    file_archive = FileArchive(file_list=params['PATHS']['inDir'], cards=[], dtypes=[])
+    in_files = file_archive.files
+    in_dir = file_archive.in_dir
+    tmp_dir = params['PATHS']['tmpDir']
+    checkpoint_dir = params['PATHS'].get('checkpointDir')
+    weighting = {'frame_weights': params['OPTIONS'].get('frameWeights'),
+                 'weight_fraction': params['OPTIONS'].get('frameWeightFraction'),
+                 'weight_threshold': params['OPTIONS'].get('frameWeightThreshold')}
+    weighted = any(value is not None for value in weighting.values())
+    subpixel = params['OPTIONS'].get('subpixel', False)
+
+    # Input check
+    if mode not in ['same', 'full', 'valid']:
+        raise SpecklepyValueError('holography()', argname='mode', argvalue=mode,
+                                  expected="either 'same', 'full', or 'valid'")
+
+    if 'apodizationType' in params['APODIZATION']:
+        # Catch deprecated parameter name
+        logger.warning("Parameter 'apodizationType' is deprecated. Use 'type' instead!")
+        params['APODIZATION']['type'] = params['APODIZATION']['apodizationType']
+    if 'apodizationWidth' in params['APODIZATION']:
+        # Catch deprecated parameter name
+        logger.warning("Parameter 'apodizationWidth' is deprecated. Use 'radius' instead!")
+        params['APODIZATION']['radius'] = params['APODIZATION']['apodizationWidth']
+    if params['APODIZATION']['type'] is None or params['APODIZATION']['type'].lower() not in ['gaussian', 'airy']:
+        logger.error(f"Apodization type has not been set or of wrong type ({params['APODIZATION']['type']})")
+    if params['APODIZATION']['radius'] is None or not isinstance(params['APODIZATION']['radius'], (int, float)):
+        logger.error(f"Apodization radius has not been set or of wrong type ({params['APODIZATION']['radius']})")
+
+    # Initialize the cache of intermediate products
+    if params['PATHS'].get('cacheDir') is not None:
+        cache = Cache(params['PATHS']['cacheDir'], max_size=params['OPTIONS'].get('cacheSize'))
+    else:
+        cache = None
+
+    # Initialize the outfile
+    out_file = ReconstructionFile(filename=params['PATHS']['outFile'], files=in_files,
+                                  cards={"RECONSTRUCTION": "Holography"}, in_dir=in_dir)
+
+    # Initialize reconstruction
+    reconstruction = Reconstruction(in_files=in_files, mode=mode, alignment_method='ssa',
+                                    reference_image=params['PATHS']['alignmentReferenceFile'],
+                                    in_dir=in_dir, tmp_dir=tmp_dir, out_file=params['PATHS']['outFile'],
+                                    var_ext=params['OPTIONS']['varianceExtensionName'],
+                                    box_indexes=params['OPTIONS']['box_indexes'],
+                                    selection_fraction=params['OPTIONS'].get('selectionFraction'),
+                                    selection_threshold=params['OPTIONS'].get('selectionThreshold'),
+                                    drift_block_size=params['OPTIONS'].get('driftBlockSize'),
+                                    memory_limit=params['OPTIONS'].get('memoryLimit'), cache=cache,
+                                    upsample_factor=SUBPIXEL_UPSAMPLE_FACTOR if subpixel else None, debug=debug)
+
+    # (i-ii) Align cubes
+    # shifts = get_shifts(files=in_files, reference_file=params['PATHS']['alignmentReferenceFile'],
+    #                     lazy_mode=True, return_image_shape=False, in_dir=in_dir, debug=debug)
+    shifts = reconstruction.shifts
+    frame_shifts = reconstruction.frame_shifts
+    if frame_shifts is not None and params['PSFEXTRACTION']['mode'].lower() == 'epsf':
+        logger.warning("The ePSF extraction does not support drift tracking, ignoring the frame shifts!")
+        frame_shifts = None
+
+    # (iii) Compute SSA reconstruction
+    # image = ssa(in_files, mode=mode, outfile=out_file, in_dir=in_dir, tmp_dir=tmp_dir,
+    #             variance_extension_name=params['OPTIONS']['varianceExtensionName'])
+    image = reconstruction.coadd_long_exposures()
+    if isinstance(image, tuple):
+        # SSA returned a reconstruction image and a variance image
+        image, image_var = image
+    total_flux = np.sum(image)  # Stored for flux conservation
+
+    # Read parameters of the unattended mode
+    if batch:
+        batch_params = params['BATCH'] if 'BATCH' in params else {}
+        max_iterations = batch_params.get('maxIterations', 10)
+        tolerance = batch_params.get('tolerance', 0.01)
+        logger.info(f"Running in batch mode with up to {max_iterations} iterations and a tolerance of {tolerance}")
+    previous_sources = None
+    iteration = 0
+
+    # Start iteration from steps (iv) through (xi)
+    while True:
+        iteration += 1
+        previous_image = image
+
+        # (iv) Astrometry and photometry, i.e. StarFinder
+        sources = extract_sources(image=image,
+                                  fwhm=params['STARFINDER']['starfinderFwhm'],
+                                  noise_threshold=params['STARFINDER']['noiseThreshold'],
+                                  background_subtraction=True,
+                                  write_to=params['PATHS']['allStarsFile'],
+                                  star_finder='DAO', debug=debug)
+
+        # (v) Select reference stars
+        if batch:
+            reference_stars = select_reference_stars(sources, psf_radius=params['PSFEXTRACTION']['psfRadius'],
+                                                     image_shape=image.shape,
+                                                     max_number=batch_params.get('referenceStars'),
+                                                     isolation_radius=batch_params.get('isolationRadius'),
+                                                     isolation_flux_ratio=batch_params.get('isolationFluxRatio', 0.1),
+                                                     field_segmentation=params['PSFEXTRACTION']['fieldSegmentation'])
+            logger.info(f"Writing {len(reference_stars)} reference stars to {params['PATHS']['refSourceFile']}")
+            reference_stars.write(params['PATHS']['refSourceFile'], format='ascii.fixed_width', overwrite=True)
+        else:
+            print("\tPlease copy your desired reference stars from the all stars file into the reference star file!")
+            input("\tWhen you are done, hit a ENTER.")
+
+        if params['PSFEXTRACTION']['fieldSegmentation'] and params['PSFEXTRACTION']['mode'].lower() != 'epsf':
+            # (vi-xi) Reconstruct the field segments with their own PSFs and blend them
+            image = reconstruct_segments(in_files, shifts=shifts, image_shape=image.shape,
+                                         star_table=read_table(params['PATHS']['refSourceFile']),
+                                         field_segmentation=params['PSFEXTRACTION']['fieldSegmentation'],
+                                         halo=params['PSFEXTRACTION'].get('segmentHalo'), mode=mode, in_dir=in_dir,
+                                         tmp_dir=tmp_dir, checkpoint_dir=checkpoint_dir, frame_shifts=frame_shifts,
+                                         psf_radius=params['PSFEXTRACTION']['psfRadius'],
+                                         psf_mode=params['PSFEXTRACTION']['mode'].lower(),
+                                         noise_reference_margin=params['PSFEXTRACTION']['noiseReferenceMargin'],
+                                         noise_threshold=params['PSFEXTRACTION']['noiseThreshold'],
+                                         apodization_type=params['APODIZATION']['type'],
+                                         apodization_radius=params['APODIZATION']['radius'],
+                                         n_processes=params['OPTIONS'].get('nProcesses'), cache=cache,
+                                         store_spectra=params['OPTIONS'].get('storeSpectra', True),
+                                         save_psfs=params['PSFEXTRACTION'].get('savePsfs', True), subpixel=subpixel,
+                                         psf_components=params['PSFEXTRACTION'].get('psfComponents'), **weighting)
+            image = image * total_flux / np.sum(image)
+
+        else:
+            # (vi) PSF extraction
+            ref_stars = ReferenceStars(psf_radius=params['PSFEXTRACTION']['psfRadius'],
+                                       reference_source_file=params['PATHS']['refSourceFile'], in_files=in_files,
+                                       save_dir=tmp_dir, in_dir=in_dir,
+                                       field_segmentation=params['PSFEXTRACTION']['fieldSegmentation'])
+            psf_mode = params['PSFEXTRACTION']['mode'].lower()
+            if psf_mode not in ['epsf', 'mean', 'median', 'weighted_mean']:
+                raise RuntimeError(f"PSF extraction mode '{params['PSFEXTRACTION']['mode']}' is not understood!")
+            psf_components = params['PSFEXTRACTION'].get('psfComponents')
+            if psf_mode != 'epsf' and cache is None and not weighted and psf_components is None:
+                # The PSFs are extracted and (vii) thresholded frame by frame within step (ix), such that each cube is
+                # read only once. With a cache, frame weights or compressed PSFs, the PSFs are extracted beforehand, as
+                # they identify the cached Fourier transforms, define the weights or span the basis
+                psf_files = None
+                psf_frames = partial(get_thresholded_psf_frames, ref_stars=ref_stars, file_shifts=shifts,
+                                     mode=psf_mode, frame_shifts=frame_shifts,
+                                     noise_reference_margin=params['PSFEXTRACTION']['noiseReferenceMargin'],
+                                     noise_threshold=params['PSFEXTRACTION']['noiseThreshold'],
+                                     save=params['PSFEXTRACTION'].get('savePsfs', True))
+                psf_generation = get_psf_generation(
+                    ref_stars, mode=psf_mode,
+                    noise_reference_margin=params['PSFEXTRACTION']['noiseReferenceMargin'],
+                    noise_threshold=params['PSFEXTRACTION']['noiseThreshold'])
+            else:
+                if psf_mode == 'epsf':
+                    psf_files = ref_stars.extract_epsfs(file_shifts=shifts, debug=debug)
+                else:
+                    psf_files = ref_stars.extract_psfs(file_shifts=shifts, mode=psf_mode, frame_shifts=frame_shifts,
+                                                       cache=cache, debug=debug)
+                logger.info("Saved the extracted PSFs...")
+
+                # (vii) Noise thresholding
+                threshold_psf_files(psf_files, noise_reference_margin=params['PSFEXTRACTION']['noiseReferenceMargin'],
+                                    noise_threshold=params['PSFEXTRACTION']['noiseThreshold'])
+                if psf_components is not None:
+                    for psf_file in psf_files:
+                        compress_psf_file(psf_file, n_components=psf_components)
+                psf_frames = None
+                psf_generation = None
+
+            # (viii) Subtraction of secondary sources within the reference apertures
+            # TODO: Implement Secondary source subtraction
+            pass
+
+            # (ix) Estimate object, following Eq. 1 (Schoedel et al., 2013)
+            f_object = FourierObject(in_files, psf_files, shifts=shifts, mode=mode, in_dir=in_dir,
+                                     frame_shifts=frame_shifts, cache=cache,
+                                     spectrum_dir=tmp_dir if params['OPTIONS'].get('storeSpectra', True) else None,
+                                     psf_shape=(ref_stars.box_size, ref_stars.box_size),
+                                     checkpoint_dir=checkpoint_dir, psf_generation=psf_generation, subpixel=subpixel,
+                                     **weighting)
+            f_object.coadd_fft(psf_frames=psf_frames)
+
+            # (x) Apodization
+            f_object.apodize(type=params['APODIZATION']['type'], radius=params['APODIZATION']['radius'])
+
+            # (xi) Inverse Fourier transform to retain the reconstructed image
+            image = f_object.ifft(total_flux=total_flux)
+
+        # Inspect the latest reconstruction
+        if debug:
+            imshow(image)
+
+        # Save the latest reconstruction image to outfile
+        out_file.data = image
+
+        # Evaluate convergence in batch mode or ask the user whether the iteration shall be continued or not
+        if batch:
+            image_change = get_image_change(previous_image, image)
+            logger.info(f"Iteration {iteration}: relative change of the image is {image_change:.3}")
+            if image_change < tolerance:
+                logger.info(f"Image converged to within the tolerance of {tolerance}, stopping the iteration")
+                break
+            if previous_sources is not None:
+                catalogue_change = get_catalogue_change(previous_sources, sources)
+                logger.info(f"Iteration {iteration}: relative change of the source catalogue is {catalogue_change:.3}")
+                if catalogue_change < tolerance:
+                    logger.info(f"Source catalogue converged to within the tolerance of {tolerance}, stopping the "
+                                f"iteration")
+                    break
+            if iteration >= max_iterations:
+                logger.warning(f"Reached the maximum number of {max_iterations} iterations without convergence, "
+                               f"stopping the iteration")
+                break
+            previous_sources = sources
+        else:
+            answer = input("\tDo you want to continue with one more iteration? [yes/no]\n\t")
+            if answer.lower() in ['n', 'no']:
+                break
+
+    # Repeat astrometry and photometry, i.e. StarFinder on final image
+    sources = extract_sources(image=image, fwhm=params['STARFINDER']['starfinderFwhm'],
+                              noise_threshold=params['STARFINDER']['noiseThreshold'], background_subtraction=True,
+                              write_to=params['PATHS']['allStarsFile'], star_finder='DAO', debug=debug)
+
+    # Refine the photometry by fitting the PSF of the reconstruction, which is the apodization kernel
+    if params['STARFINDER'].get('psfFitting', False):
+        if params['APODIZATION']['type'] is None or params['APODIZATION']['radius'] is None:
+            logger.warning("PSF-fitting photometry is skipped for the apodization kernel not being defined!")
+        else:
+            fit_psf_photometry(image, sources=sources,
+                               psf=get_apodization_psf(params['APODIZATION']['type'], params['APODIZATION']['radius']),
+                               tile_size=params['STARFINDER'].get('fittingTileSize'),
+                               write_to=params['PATHS']['allStarsFile'])
+
+    # Finally return the image
+    return image
+
+
+def reconstruct_segments(in_files, shifts, image_shape, star_table, field_segmentation, halo=None, mode='same',
+                         in_dir=None, tmp_dir=None, checkpoint_dir=None, frame_shifts=None, psf_radius=30,
+                         psf_mode='mean', noise_reference_margin=3, noise_threshold=3, apodization_type=None,
+                         apodization_radius=None, n_processes=None, cache=None, store_spectra=True, save_psfs=True,
+                         frame_weights=None, weight_fraction=None, weight_threshold=None, subpixel=False,
+                         psf_components=None):
+    """Reconstruct the segments of a field segmentation with their own PSFs and blend them into one image.
+
+    Each segment is extended by a halo and reconstructed with the PSF from the reference stars within the extended
+    segment, following steps (vi) to (xi) of holography(). The Fourier transforms are computed on the extended segments
+    only, see the `region` argument of specklepy.core.fourierobject.FourierObject. The segment images are then blended
+    with weights that are unity in the segment and decrease linearly across the halo.
+
+    Args:
+        in_files (list):
+            List of input files.
+        shifts (list):
+            List of integer shifts between the files.
+        image_shape (tuple):
+            Shape of the reconstruction canvas.
+        star_table (astropy.table.Table):
+            Table of reference stars with 'x' and 'y' columns in the coordinates of the reconstruction.
+        field_segmentation (list):
+            Number of segments along both image axes.
+        halo (int, optional):
+            Width of the halo around each segment in pixels. Default is the `psf_radius`.
+        mode (str, optional):
+            Reconstruction mode, see holography().
+        in_dir (str, optional):
+            Path to the input files.
+        tmp_dir (str, optional):
+            Directory for the PSF files of each segment, which are stored in sub-directories, and for the transforms of
+            the image frames.
+        checkpoint_dir (str, optional):
+            Directory for the checkpoints of the partial sums of each segment, which are stored in sub-directories.
+            See specklepy.core.fourierobject.FourierObject for details. No checkpoints are stored if not provided.
+        frame_shifts (list of np.ndarray, optional):
+            Shifts of the frames within each file, see specklepy.core.fourierobject.FourierObject.
+        psf_radius (int, optional):
+            Radius of the PSF estimates.
+        psf_mode (str, optional):
+            Combination mode for the PSFs of the reference stars, see
+            specklepy.core.psfextraction.ReferenceStars.extract_psfs().
+        noise_reference_margin (int, optional):
+            Width of the reference annulus of the PSF frames, see get_noise_mask().
+        noise_threshold (float, optional):
+            Multiple of the noise that is subtracted from the PSF frames, see threshold_psfs().
+        apodization_type (str, optional):
+            Type of the apodization, see specklepy.core.fourierobject.FourierObject.apodize().
+        apodization_radius (float, optional):
+            Radius of the apodization kernel.
+        n_processes (int, optional):
+            Number of processes for reconstructing the segments in parallel. Default is 1.
+        cache (specklepy.io.cache.Cache, optional):
+            Cache that is passed to the PSF extraction and Fourier objects.
+        store_spectra (bool, optional):
+            Store the transforms of the image frames of each segment in `tmp_dir`. Default is True.
+        save_psfs (bool, optional):
+            Save the PSFs of each segment, if they are extracted in the same pass over the cubes as the Fourier
+            transforms, which is the case without a cache, frame weights and compression. Default is True.
+        frame_weights (str, optional):
+            Weights of the frames, see specklepy.core.fourierobject.FourierObject.
+        weight_fraction (float, optional):
+            Fraction of the frames with the highest weights to co-add.
+        weight_threshold (float, optional):
+            Minimum weight of co-added frames.
+        subpixel (bool, optional):
+            Align the files on sub-pixel shifts, see specklepy.core.fourierobject.FourierObject. Default is False.
+        psf_components (int, optional):
+            Compress the PSF cubes of each segment into this number of basis images, see
+            specklepy.io.psffile.compress_psf_file(). The PSFs are not compressed if not provided.
+
+    Returns:
+        image (np.ndarray):
+            Blended reconstruction, which is not yet scaled to the total flux.
+    """
+
+    if halo is None:
+        halo = psf_radius
+    if n_processes is None:
+        n_processes = 1
+    if tmp_dir is None:
+        tmp_dir = ''
+
+    # Derive the extended regions and the local reference stars of the segments
+    segmentation = Segmentation(*field_segmentation, image_shape=image_shape)
+    regions = []
+    star_tables = []
+    for segment in segmentation.segments:
+        region = (slice(max(segment.xmin - halo, 0), min(segment.xmax + 1 + halo, image_shape[0])),
+                  slice(max(segment.ymin - halo, 0), min(segment.ymax + 1 + halo, image_shape[1])))
+        # The y-coordinates of the table run along the zero-th image axis
+        inside = (star_table['y'] >= region[0].start) & (star_table['y'] < region[0].stop) & \
+                 (star_table['x'] >= region[1].start) & (star_table['x'] < region[1].stop)
+        if not np.any(inside):
+            raise RuntimeError(f"{segment} does not contain any reference star within a halo of {halo} pixels!")
+        logger.info(f"Reconstructing {segment} with a halo of {halo} pixels and {np.sum(inside)} reference stars")
+        regions.append(region)
+        star_tables.append(star_table[inside])
+
+    # Reconstruct the segments
+    save_dirs = [os.path.join(tmp_dir, f"segment_{index}") for index in range(len(regions))]
+    if checkpoint_dir is None:
+        checkpoint_dirs = [None] * len(regions)
+    else:
+        checkpoint_dirs = [os.path.join(checkpoint_dir, f"segment_{index}") for index in range(len(regions))]
+    kwargs = {'in_files': in_files, 'shifts': shifts, 'mode': mode, 'in_dir': in_dir, 'frame_shifts': frame_shifts,
+              'psf_radius': psf_radius, 'psf_mode': psf_mode, 'noise_reference_margin': noise_reference_margin,
+              'noise_threshold': noise_threshold, 'apodization_type': apodization_type,
+              'apodization_radius': apodization_radius, 'cache': cache,
+              'spectrum_dir': tmp_dir if store_spectra else None, 'save_psfs': save_psfs,
+              'frame_weights': frame_weights, 'weight_fraction': weight_fraction, 'weight_threshold': weight_threshold,
+              'subpixel': subpixel, 'psf_components': psf_components}
+    if n_processes > 1 and len(regions) > 1:
+        logger.info(f"Reconstructing {len(regions)} segments in {n_processes} processes")
+        with ProcessPoolExecutor(max_workers=n_processes) as executor:
+            segment_images = list(executor.map(partial(_reconstruct_segment, **kwargs), regions, star_tables,
+                                               save_dirs, checkpoint_dirs))
+    else:
+        segment_images = [_reconstruct_segment(*args, **kwargs)
+                          for args in zip(regions, star_tables, save_dirs, checkpoint_dirs)]
+
+    # Blend the segment images
+    image = np.zeros(image_shape)
+    weights = np.zeros(image_shape)
+    for segment, region, segment_image in zip(segmentation.segments, regions, segment_images):
+        weight = np.outer(_get_blending_weights(region[0], segment.xmin, segment.xmax + 1, halo),
+                          _get_blending_weights(region[1], segment.ymin, segment.ymax + 1, halo))
+        image[region] += weight * segment_image
+        weights[region] += weight
+    return image / weights
+
+
+def _reconstruct_segment(region, star_table, save_dir, checkpoint_dir, in_files, shifts, mode, in_dir, frame_shifts,
+                         psf_radius, psf_mode, noise_reference_margin, noise_threshold, apodization_type,
+                         apodization_radius, cache, spectrum_dir, save_psfs, frame_weights, weight_fraction,
+                         weight_threshold, subpixel, psf_components):
+    """Reconstruct a single segment, see reconstruct_segments().
+
+    This function is defined on module level, such that it can be distributed to worker processes.
+    """
+    ref_stars = ReferenceStars(psf_radius=psf_radius, reference_source_file=star_table, in_files=in_files,
+                               save_dir=save_dir, in_dir=in_dir)
+    if cache is None and frame_weights is None and weight_fraction is None and weight_threshold is None and \
+            psf_components is None:
+        psf_files = None
+        psf_frames = partial(get_thresholded_psf_frames, ref_stars=ref_stars, file_shifts=shifts, mode=psf_mode,
+                             frame_shifts=frame_shifts, noise_reference_margin=noise_reference_margin,
+                             noise_threshold=noise_threshold, save=save_psfs)
+        psf_generation = get_psf_generation(ref_stars, mode=psf_mode, noise_reference_margin=noise_reference_margin,
+                                            noise_threshold=noise_threshold)
+    else:
+        psf_files = ref_stars.extract_psfs(file_shifts=shifts, mode=psf_mode, frame_shifts=frame_shifts, cache=cache)
+        threshold_psf_files(psf_files, noise_reference_margin=noise_reference_margin, noise_threshold=noise_threshold)
+        if psf_components is not None:
+            for psf_file in psf_files:
+                compress_psf_file(psf_file, n_components=psf_components)
+        psf_frames = None
+        psf_generation = None
+    f_object = FourierObject(in_files, psf_files, shifts=shifts, mode=mode, in_dir=in_dir, frame_shifts=frame_shifts,
+                             cache=cache, spectrum_dir=spectrum_dir, region=region,
+                             psf_shape=(ref_stars.box_size, ref_stars.box_size), checkpoint_dir=checkpoint_dir,
+                             psf_generation=psf_generation, frame_weights=frame_weights,
+                             weight_fraction=weight_fraction, weight_threshold=weight_threshold, subpixel=subpixel)
+    f_object.coadd_fft(psf_frames=psf_frames)
+    f_object.apodize(type=apodization_type, radius=apodization_radius)
+    return f_object.ifft()
+
+
+def _get_blending_weights(region_slice, start, stop, halo):
+    """Weights along one axis of a region, which are unity in [start, stop) and decrease linearly across the halo."""
+    indexes = np.arange(region_slice.start, region_slice.stop)
+    distance = np.maximum(start - indexes, 0) + np.maximum(indexes - stop + 1, 0)
+    return 1 - distance / (halo + 1)
+
+
+def threshold_psf_files(psf_files, noise_reference_margin, noise_threshold):
+    """Apply threshold_psfs() to the PSF cubes in a list of files, updating each file in a single flush.
+
+    Args:
+        psf_files (list of str):
+            List of PSF files.
+        noise_reference_margin (int):
+            Width of the reference annulus, see get_noise_mask().
+        noise_threshold (float):
+            Multiple of the noise that is subtracted, see threshold_psfs().
+    """
+    psf_noise_mask = None
+    for file in psf_files:
+        with fits.open(file, mode='update') as hdu_list:
+            if psf_noise_mask is None:
+                psf_noise_mask = get_noise_mask(hdu_list[0].data[0], noise_reference_margin=noise_reference_margin)
+            hdu_list[0].data[:] = threshold_psfs(hdu_list[0].data, noise_mask=psf_noise_mask,
+                                                 noise_threshold=noise_threshold)
+            hdu_list.flush()
+
+
+def get_thresholded_psf_frames(file_index, image_cube, ref_stars, file_shifts=None, mode='median', frame_shifts=None,
+                               noise_reference_margin=3, noise_threshold=3, save=False):
+    """Extract and threshold the PSFs of a file frame by frame.
+
+    This combines steps (vi) and (vii) of holography() for a single cube, such that the PSF frames can be consumed by
+    specklepy.core.fourierobject.FourierObject.coadd_fft() in the same pass over the cube as the image frames.
+
+    Args:
+        file_index (int):
+            Index of the file in the `in_files` attribute of `ref_stars`.
+        image_cube (np.ndarray):
+            Image cube of the file.
+        ref_stars (specklepy.core.psfextraction.ReferenceStars):
+            Reference stars, from which the PSFs are extracted.
+        file_shifts (list, optional):
+            List of shifts for each of the files, see ReferenceStars.extract_psfs().
+        mode (str, optional):
+            Combination mode for the PSFs of the reference stars.
+        frame_shifts (list of np.ndarray, optional):
+            Shifts of the frames within each file, see ReferenceStars.extract_psfs().
+        noise_reference_margin (int, optional):
+            Width of the reference annulus, see get_noise_mask().
+        noise_threshold (float, optional):
+            Multiple of the noise that is subtracted, see threshold_psfs().
+        save (bool, optional):
+            Save the thresholded PSFs to a PSF file in the `save_dir` of `ref_stars`, once all frames are consumed.
+            Default is False.
+
+    Yields:
+        psf (np.ndarray):
+            Thresholded PSF of the next frame.
+    """
+    psf_noise_mask = None
+    psfs = []
+    for psf in ref_stars.get_psf_frames(file_index, file_shifts=file_shifts, mode=mode, frame_shifts=frame_shifts,
+                                        data=image_cube):
+        if psf_noise_mask is None:
+            psf_noise_mask = get_noise_mask(psf, noise_reference_margin=noise_reference_margin)
+        psf = threshold_psfs(psf[np.newaxis], noise_mask=psf_noise_mask, noise_threshold=noise_threshold)[0]
+        if save:
+            psfs.append(psf)
+        yield psf
+
+    if save:
+        psf_file = PSFFile(ref_stars.in_files[file_index], out_dir=ref_stars.save_dir,
+                           frame_shape=(ref_stars.box_size, ref_stars.box_size), in_dir=ref_stars.in_dir,
+                           header_card_prefix="HIERARCH SPECKLEPY ")
+        psf_file.data = np.array(psfs)
+
+
+def get_psf_generation(ref_stars, **params):
+    """Compute a tag of the PSF estimates from the reference stars and the extraction parameters.
+
+    Args:
+        ref_stars (specklepy.core.psfextraction.ReferenceStars):
+            Reference stars, from which the PSFs are extracted.
+        **params:
+            Further parameters of the PSF extraction and thresholding.
+
+    Returns:
+        psf_generation (str):
+            Key of the reference star positions, the PSF radius and the parameters.
+    """
+    return get_key(stars=[(row['x'], row['y']) for row in ref_stars.star_table], radius=ref_stars.radius, **params)
+
+
+def get_noise_mask(frame, noise_reference_margin):
+    """Create an annulus-like mask within a given aperture for measuring noise
+    and (sky) background.
+
+    Args:
+        frame (np.ndarray):
+            Image frame within which the mask is derived.
+        noise_reference_margin (int):
+            Width of the reference annulus in pixels.
+
+    Returns:
+        annulus_mask (np.ndarray, dtype=bool):
+            Mask array, derived from the frame.
+    """
+    center = int((frame.shape[0] - 1) / 2)
+    radius = center - noise_reference_margin
+    tmp = Aperture(center, center, radius, data=frame, crop=False)
+    annulus_mask = np.logical_not(tmp.data.mask)
+    return annulus_mask
+
+
+def threshold_psfs(psf_cube, noise_mask, noise_threshold):
+    """Subtract the background and noise threshold from all PSF frames at once and normalize them.
+
+    Args:
+        psf_cube (np.ndarray, ndim=3):
+            Cube of PSF frames.
+        noise_mask (np.ndarray, dtype=bool):
+            Mask of the PSF frames, where the pixels outside of the mask are the reference for measuring the
+            background and noise, as obtained from get_noise_mask().
+        noise_threshold (float):
+            Multiple of the noise that is subtracted on top of the background.
+
+    Returns:
+        thresholded (np.ndarray, ndim=3):
+            Thresholded PSF frames, each normalized to a flux sum of unity.
+    """
+    reference = psf_cube[:, ~noise_mask]
+    background = np.mean(reference, axis=1)
+    noise = np.std(reference, axis=1)
+    thresholded = np.maximum(psf_cube - (background + noise_threshold * noise)[:, np.newaxis, np.newaxis], 0.0)
+    flux = np.sum(thresholded, axis=(1, 2))
+    if np.any(flux == 0.0):
+        raise ValueError("After background subtraction and noise thresholding, no signal is leftover. Please reduce "
+                         "the noiseThreshold!")
+    return thresholded / flux[:, np.newaxis, np.newaxis]  # Flux sum of order unity
+
+
+def get_image_change(previous, current):
+    """Compute the relative change between two image reconstructions.
+
+    Args:
+        previous (np.ndarray):
+            Image of the previous iteration.
+        current (np.ndarray):
+            Image of the current iteration.
+
+    Returns:
+        change (float):
+            Norm of the difference relative to the norm of the previous image, infinite if the shapes do not match.
+    """
+    if previous.shape != current.shape:
+        return np.inf
+    return np.linalg.norm(current - previous) / np.linalg.norm(previous)
+
+
+def get_catalogue_change(previous, current, match_radius=1.):
+    """Compute the relative change between two source catalogues.
+
+    Args:
+        previous (astropy.table.Table):
+            Source table of the previous iteration, with 'x' and 'y' columns.
+        current (astropy.table.Table):
+            Source table of the current iteration.
+        match_radius (float, optional):
+            Maximum distance in pixels between the positions of a source in both catalogues. Default is 1.
+
+    Returns:
+        change (float):
+            Fraction of the sources in either catalogue without a counterpart in the other catalogue.
+    """
+    if len(previous) == 0 or len(current) == 0:
+        return 0. if len(previous) == len(current) else 1.
+    previous_positions = np.stack([previous['x'], previous['y']], axis=1)
+    current_positions = np.stack([current['x'], current['y']], axis=1)
+    distances, _ = cKDTree(previous_positions).query(current_positions, distance_upper_bound=match_radius)
+    unmatched_current = np.sum(np.isinf(distances))
+    distances, _ = cKDTree(current_positions).query(previous_positions, distance_upper_bound=match_radius)
+    unmatched_previous = np.sum(np.isinf(distances))
+    return (unmatched_current + unmatched_previous) / (len(current) + len(previous))
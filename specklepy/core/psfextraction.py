@@ -4,6 +4,7 @@ from scipy import ndimage
 from tqdm import trange
 
 from astropy.io import fits
+from astropy.table import Table
 
 from specklepy.core.aperture import Aperture
 from specklepy.core.segmentation import Segmentation
@@ -25,8 +26,8 @@ class ReferenceStars(object):
             psf_radius (int):
                 Radius of the PSF estimate. The PSF frames will have a box size of `2 * psf_radius + 1`, along each
                 axes.
-            reference_source_file (str):
-                Name of the table file that contains the positions of the reference stars.
+            reference_source_file (str or astropy.table.Table):
+                Name of the table file that contains the positions of the reference stars, or the table itself.
             in_files (list of str):
                 List of input files.
             save_dir (str):
@@ -39,7 +40,10 @@ class ReferenceStars(object):
 
         # Store attributes
         self.radius = psf_radius
-        self.star_table = read_table(reference_source_file, error=True)
+        if isinstance(reference_source_file, Table):
+            self.star_table = reference_source_file
+        else:
+            self.star_table = read_table(reference_source_file, error=True)
         self.in_files = in_files
         self.save_dir = save_dir
         if in_dir is None:
@@ -48,11 +52,12 @@ class ReferenceStars(object):
             self.in_dir = in_dir
 
         if field_segmentation:
-            example_image_shape = fits.getdata(self.in_files[0])[0].shape
+            example_image_shape = fits.getdata(os.path.join(self.in_dir, self.in_files[0])).shape[-2:]
             segmentation = Segmentation(*field_segmentation, image_shape=example_image_shape)
             star_positions = []
             for row in self.star_table:
-                star_positions.append((row['x'], row['y']))
+                # The y-coordinates of the table run along the zero-th image axis
+                star_positions.append((row['y'], row['x']))
             if not segmentation.all_covered(positions=star_positions):
                 covering = segmentation.all_covered(positions=star_positions, return_all=True)
                 raise RuntimeError(f"Image segmentation into ({field_segmentation}) segments requested, but not all "
@@ -64,18 +69,22 @@ class ReferenceStars(object):
     def box_size(self):
         return self.radius * 2 + 1
 
-    def init_apertures(self, filename, shift=None):
+    def init_apertures(self, filename, shift=None, margin=0, data=None):
 
         if shift is None:
             shift = (0, 0)
 
+        # Read the cube only once for all apertures
+        if data is None:
+            data = fits.getdata(os.path.join(self.in_dir, filename))
+
         apertures = []
         for star in self.star_table:
-            apertures.append(Aperture(star['y'] - shift[0], star['x'] - shift[1], self.radius,
-                                      data=os.path.join(self.in_dir, filename), mask='rectangular', crop=True))
+            apertures.append(Aperture(star['y'] - shift[0], star['x'] - shift[1], self.radius + margin,
+                                      data=data, mask='rectangular', crop=True))
         return apertures
 
-    def extract_psfs(self, file_shifts=None, mode='median', align=True, debug=False):
+    def extract_psfs(self, file_shifts=None, mode='median', align=True, frame_shifts=None, cache=None, debug=False):
         """Extract the PSF of the list of ReferenceStars frame by frame.
 
         Long description...
@@ -88,6 +97,13 @@ class ReferenceStars(object):
                 Combination mode for PSFs from different apertures.
             align (bool, optional):
                 Execute sub-pixel alignments of apertures. Default is True.
+            frame_shifts (list of np.ndarray, optional):
+                List of the integer shifts of the individual frames within each file, as obtained from
+                specklepy.core.alignment.get_frame_shifts. If provided, the apertures follow the drift of the frames,
+                such that the PSFs are centered on the drift-corrected reference star positions. Default is None.
+            cache (specklepy.io.cache.Cache, optional):
+                Cache that is consulted for the PSFs of each file, extracted from the same reference stars with the
+                same parameters, before extracting them. Newly extracted PSFs are stored in the cache.
             debug (bool, optional):
                 Shows the (integrated) apertures if set to True. Default is False.
 
@@ -96,16 +112,6 @@ class ReferenceStars(object):
                 List of file names where the PSFs are stored in.
         """
 
-        # Input parameters
-        if mode == 'median':
-            func = np.median
-        elif mode == 'mean':
-            func = np.mean
-        elif mode == 'weighted_mean':
-            func = weighted_mean
-        else:
-            raise ValueError('ReferenceStars received unknown mode for extract method ({}).'.format(mode))
-
         # Create a list of psf files and store it to params
         psf_files = []
 
@@ -117,46 +123,114 @@ class ReferenceStars(object):
                                in_dir=self.in_dir, header_card_prefix="HIERARCH SPECKLEPY ")
             psf_files.append(psf_file.file_path)
 
-            # Consider alignment of cubes when initializing the apertures, i.e.
-            # the position of the aperture in the shifted cube
-            if file_shifts is None:
-                apertures = self.init_apertures(file)
-            else:
-                apertures = self.init_apertures(file, shift=file_shifts[file_index])
+            # Consult the cache for PSFs of this file
+            if cache is not None:
+                key = cache.key(files=[file], in_dir=self.in_dir, function='extract_psfs',
+                                stars=[(row['x'], row['y']) for row in self.star_table], radius=self.radius,
+                                file_shift=file_shifts[file_index] if file_shifts is not None else None, mode=mode,
+                                align=align,
+                                frame_shifts=frame_shifts[file_index] if frame_shifts is not None else None)
+                entry = cache.load(key)
+                if entry is not None:
+                    logger.info(f"Using cached PSFs for file {file}")
+                    psf_file.data = entry['psfs']
+                    continue
+
+            # Collect the PSF frames and write them to the file at once
+            psfs = np.array(list(self.get_psf_frames(file_index, file_shifts=file_shifts, mode=mode, align=align,
+                                                     frame_shifts=frame_shifts, debug=debug)))
+            psf_file.data = psfs
+
+            if cache is not None:
+                cache.store(key, psfs=psfs)
 
-            # Extract the number of frames in the FITS file from the header
-            frame_number = fits.getheader(os.path.join(self.in_dir, file))['NAXIS3']
+        return psf_files
 
-            # Check apertures visually
-            if debug:
-                for index, aperture in enumerate(apertures):
-                    imshow(aperture.get_integrated(), title="Inspect reference aperture {}".format(index + 1))
+    def get_psf_frames(self, file_index, file_shifts=None, mode='median', align=True, frame_shifts=None, data=None,
+                       debug=False):
+        """Extract the PSF of a single file frame by frame.
 
-            # Extract the PSF by combining the aperture frames in the desired mode
-            for frame_index in trange(frame_number, desc="Extracting PSF frame"):
-                psfs = np.empty((len(apertures), self.box_size, self.box_size))
-                vars = np.ones((len(apertures), self.box_size, self.box_size))
-                for aperture_index, aperture in enumerate(apertures):
+        This generator is the core of extract_psfs(), but can also be consumed directly, e.g. for processing the PSF
+        frames in the same pass over the cube as the image frames, without storing them to a file.
+
+        Args:
+            file_index (int):
+                Index of the file in the `in_files` attribute.
+            file_shifts (list, optional):
+                List of shifts for each of the files, see extract_psfs().
+            mode (str, optional):
+                Combination mode for PSFs from different apertures.
+            align (bool, optional):
+                Execute sub-pixel alignments of apertures. Default is True.
+            frame_shifts (list of np.ndarray, optional):
+                List of the integer shifts of the individual frames within each file, see extract_psfs().
+            data (np.ndarray, optional):
+                Cube of the file, if already in memory. The cube is read from the file if not provided.
+            debug (bool, optional):
+                Shows the (integrated) apertures if set to True. Default is False.
+
+        Yields:
+            psf (np.ndarray):
+                PSF estimate of the next frame.
+        """
+
+        # Input parameters
+        if mode == 'median':
+            func = np.median
+        elif mode == 'mean':
+            func = np.mean
+        elif mode == 'weighted_mean':
+            func = weighted_mean
+        else:
+            raise ValueError('ReferenceStars received unknown mode for extract method ({}).'.format(mode))
 
-                    flux = aperture[frame_index]
-                    var = aperture.vars
+        # Consider alignment of cubes when initializing the apertures, i.e.
+        # the position of the aperture in the shifted cube
+        # Extend the apertures by a margin that covers the drift of the frames
+        file = self.in_files[file_index]
+        if frame_shifts is None:
+            margin = 0
+        else:
+            margin = int(np.max(np.abs(frame_shifts[file_index]), initial=0))
+        if file_shifts is None:
+            apertures = self.init_apertures(file, margin=margin, data=data)
+        else:
+            apertures = self.init_apertures(file, shift=file_shifts[file_index], margin=margin, data=data)
+
+        # Check apertures visually
+        if debug:
+            for index, aperture in enumerate(apertures):
+                imshow(aperture.get_integrated(), title="Inspect reference aperture {}".format(index + 1))
+
+        # Extract the PSF by combining the aperture frames in the desired mode
+        for frame_index in trange(apertures[0].n_frames, desc="Extracting PSF frame"):
+            psfs = np.empty((len(apertures), self.box_size, self.box_size))
+            vars = np.ones((len(apertures), self.box_size, self.box_size))
+            if frame_shifts is None:
+                window = (slice(None), slice(None))
+            else:
+                # The reference star in this frame is displaced by the negative frame shift
+                dx, dy = margin - frame_shifts[file_index][frame_index]
+                window = (slice(dx, dx + self.box_size), slice(dy, dy + self.box_size))
+            for aperture_index, aperture in enumerate(apertures):
 
-                    if align:
-                        flux = ndimage.shift(flux, shift=(aperture.xoffset, aperture.yoffset))
-                        var = ndimage.shift(var, shift=(aperture.xoffset, aperture.yoffset))
+                flux = aperture[frame_index][window]
+                var = aperture.vars[window]
 
-                    # Normalization of each psf to make median estimate sensible
-                    psfs[aperture_index] = flux / np.sum(flux)
-                    vars[aperture_index] = var / np.sum(flux)
+                if align:
+                    flux = ndimage.shift(flux, shift=(aperture.xoffset, aperture.yoffset))
+                    var = ndimage.shift(var, shift=(aperture.xoffset, aperture.yoffset))
 
-                if mode != 'weighted_mean':
-                    psf = func(psfs, axis=0)
-                else:
-                    psf, var = weighted_mean(psfs, axis=0, vars=vars)
+                # Normalization of each psf to make median estimate sensible
+                psfs[aperture_index] = flux / np.sum(flux)
+                vars[aperture_index] = var / np.sum(flux)
 
-                psf_file.update_frame(frame_index, psf)
+            if mode != 'weighted_mean':
+                psf = func(psfs, axis=0)
+            else:
+                psf, var = weighted_mean(psfs, axis=0, vars=vars)
 
-        return psf_files
+            yield psf
 
     def extract_epsfs(self, file_shifts=None, oversampling=4, debug=False):
         """Extract effective PSFs following Anderson & King (2000).
@@ -240,3 +314,102 @@ class ReferenceStars(object):
                 psf_file.update_frame(frame_index, epsf)
 
         return psf_files
+
+
+def select_reference_stars(sources, psf_radius, image_shape, max_number=None, isolation_radius=None,
+                           isolation_flux_ratio=0.1, field_segmentation=None):
+    """Select reference stars for the PSF extraction automatically from a source table.
+
+    Sources are rejected if their PSF aperture exceeds the image or if a neighbour within the isolation radius is
+    brighter than the `isolation_flux_ratio` times their own flux. If a field segmentation is provided, the brightest
+    remaining source of each segment is selected first, such that all segments are covered. The selection is then
+    filled up with the brightest remaining sources. All decisions are logged.
+
+    Args:
+        sources (astropy.table.Table):
+            Table of sources with 'x', 'y' and 'flux' columns, as obtained from
+            specklepy.core.sourceextraction.extract_sources.
+        psf_radius (int):
+            Radius of the PSF apertures.
+        image_shape (tuple):
+            Shape of the image that the sources were extracted from.
+        max_number (int, optional):
+            Maximum number of reference stars. Additional stars are selected only if required for covering all field
+            segments. All suitable sources are selected if not provided.
+        isolation_radius (float, optional):
+            Radius around a source, within which no bright neighbour is tolerated. Default is the `psf_radius`.
+        isolation_flux_ratio (float, optional):
+            Upper limit of the flux of neighbours within the isolation radius, relative to the flux of the source.
+            Default is 0.1.
+        field_segmentation (list, optional):
+            Segmentation of the image into (nx, ny) field segments, which each need to contain a reference star.
+
+    Returns:
+        reference_stars (astropy.table.Table):
+            Table of the selected sources, sorted by decreasing flux.
+    """
+
+    if len(sources) == 0:
+        raise RuntimeError("Unable to select reference stars from an empty source table!")
+    if isolation_radius is None:
+        isolation_radius = psf_radius
+
+    sources = sources.copy()
+    sources.sort('flux', reverse=True)
+    x = np.array(sources['x'], dtype=float)
+    y = np.array(sources['y'], dtype=float)
+    flux = np.array(sources['flux'], dtype=float)
+
+    # Reject sources close to the image edges or with bright neighbours
+    candidates = []
+    for index in range(len(sources)):
+        position = f"({x[index]:.1f}, {y[index]:.1f})"
+        if not (psf_radius <= y[index] < image_shape[0] - psf_radius and
+                psf_radius <= x[index] < image_shape[1] - psf_radius):
+            logger.info(f"Rejecting source at {position} as reference star, as its PSF aperture exceeds the image")
+            continue
+        neighbours = (np.hypot(x - x[index], y - y[index]) < isolation_radius) & \
+                     (flux >= isolation_flux_ratio * flux[index])
+        neighbours[index] = False
+        if np.any(neighbours):
+            logger.info(f"Rejecting source at {position} as reference star, as it is not isolated from "
+                        f"{np.sum(neighbours)} neighbour(s)")
+            continue
+        candidates.append(index)
+
+    # Cover all field segments by their brightest candidate
+    selected = []
+    segmentation = None
+    if field_segmentation:
+        segmentation = Segmentation(*field_segmentation, image_shape=image_shape)
+        for segment in segmentation.segments:
+            for index in candidates:
+                if (y[index], x[index]) in segment:
+                    if index not in selected:
+                        logger.info(f"Selecting source at ({x[index]:.1f}, {y[index]:.1f}) with flux {flux[index]:.3} "
+                                    f"as reference star for {segment}")
+                        selected.append(index)
+                    break
+            else:
+                logger.warning(f"No suitable reference star found in {segment}")
+
+    # Fill up with the brightest candidates
+    for index in candidates:
+        if max_number is not None and len(selected) >= max_number:
+            break
+        if index not in selected:
+            logger.info(f"Selecting source at ({x[index]:.1f}, {y[index]:.1f}) with flux {flux[index]:.3} as "
+                        f"reference star")
+            selected.append(index)
+
+    if len(selected) == 0:
+        raise RuntimeError("None of the sources is suitable as reference star!")
+    if segmentation is not None:
+        positions = [(y[index], x[index]) for index in selected]
+        if not segmentation.all_covered(positions=positions):
+            covering = segmentation.all_covered(positions=positions, return_all=True)
+            raise RuntimeError(f"Image segmentation into ({field_segmentation}) segments requested, but not all "
+                               f"image segments contain suitable reference stars:\n{covering}")
+
+    logger.info(f"Selected {len(selected)} of {len(sources)} sources as reference stars")
+    return sources[np.sort(selected)]
@@ -0,0 +1,192 @@
+import numpy as np
+from scipy import ndimage, sparse
+from scipy.sparse.linalg import lsqr
+
+from astropy.io import fits
+from astropy.table import Table
+
+from specklepy.core.psfmodel import PSFModel
+from specklepy.exceptions import SpecklepyTypeError, SpecklepyValueError
+from specklepy.io.psffile import read_psf_file
+from specklepy.io.table import read_table
+from specklepy.logging import logger
+
+
+def fit_psf_photometry(image, sources, psf, tile_size=None, image_var=None, background=True, oversampling=20,
+                       write_to=None):
+    """Measure the fluxes of sources by fitting a PSF at their positions.
+
+    The fluxes of all sources are solved together as a linear least-squares problem, where each source contributes a
+    column of a sparse design matrix, that contains the PSF at the source position. For large numbers of sources, the
+    image is divided into square tiles and each tile is solved on its own, extended by a halo of the PSF size. All
+    sources that contribute flux to the extended tile are fitted, but only the fluxes of the sources within the tile are
+    kept, such that sources close to the tile edges are fitted together with their neighbours.
+
+    The source positions are not refined. Sub-pixel positions are accounted for by shifting the PSF, where the shifts
+    are rounded to a grid of 1 / `oversampling` pixels, such that the shifted PSFs can be reused.
+
+    Args:
+        image (np.ndarray or str):
+            Image array or the name of a file containing the image array.
+        sources (astropy.table.Table or str):
+            Table of sources with 'x' and 'y' columns, as returned by specklepy.core.sourceextraction.extract_sources(),
+            or the name of a file containing the table. The y-coordinates run along the zero-th image axis.
+        psf (np.ndarray or list):
+            PSF image or cube, or a list of PSF files. Cubes and the frames of all files are averaged. The PSF is
+            normalized to unit sum, such that the fluxes are total fluxes.
+        tile_size (int, optional):
+            Edge length of the tiles in pixels. The whole image is solved at once if not provided.
+        image_var (np.ndarray or float, optional):
+            Variance of the image, for weighting the pixels in the fit. All pixels are weighted equally if not
+            provided.
+        background (bool, optional):
+            Fit a constant background per tile along with the fluxes. Default is `True`.
+        oversampling (int, optional):
+            Number of sub-pixel positions per pixel, on which the shifted PSFs are evaluated. Default is 20.
+        write_to (str, optional):
+            If provided as a str, the table of sources is saved to this file.
+
+    Returns:
+        sources (astropy.table.Table):
+            Table of the sources with the columns 'x', 'y' and 'flux', sorted by decreasing flux.
+    """
+
+    # Input parameters
+    if isinstance(image, str):
+        logger.info(f"The argument image '{image}' is interpreted as file name.")
+        image = fits.getdata(image).squeeze()
+    elif not isinstance(image, np.ndarray):
+        raise SpecklepyTypeError('fit_psf_photometry()', argname='image', argtype=type(image),
+                                 expected='np.ndarray or str')
+    if isinstance(sources, str):
+        sources = read_table(sources)
+    elif not isinstance(sources, Table):
+        raise SpecklepyTypeError('fit_psf_photometry()', argname='sources', argtype=type(sources),
+                                 expected='astropy.table.Table or str')
+    psf = get_mean_psf(psf)
+    if tile_size is None:
+        tile_size = max(image.shape)
+    elif not isinstance(tile_size, int):
+        raise SpecklepyTypeError('fit_psf_photometry()', argname='tile_size', argtype=type(tile_size), expected='int')
+    elif tile_size < 1:
+        raise SpecklepyValueError('fit_psf_photometry()', argname='tile_size', argvalue=tile_size, expected='>= 1')
+    if image_var is None:
+        pixel_weights = np.ones(image.shape)
+    else:
+        pixel_weights = np.broadcast_to(1 / np.sqrt(image_var), image.shape)
+
+    # Derive the placement of the shifted PSFs, relative to the PSF centroid
+    center = ndimage.center_of_mass(np.maximum(psf, 0))
+    positions = np.array([sources['y'], sources['x']], dtype=float).T
+    offsets = positions - np.array(center)
+    integer_offsets = np.round(offsets).astype(int)
+    fractions = np.round((offsets - integer_offsets) * oversampling).astype(int)
+    halo = max(psf.shape)
+    stamps = {}
+    stamp_rows, stamp_cols = np.indices(psf.shape).reshape((2, -1))
+
+    # Assign the sources to tiles
+    n_tiles = [int(np.ceil(length / tile_size)) for length in image.shape]
+    tile_indexes = np.clip(np.floor((positions + 0.5) / tile_size).astype(int), 0, np.array(n_tiles) - 1)
+    logger.info(f"Fitting the fluxes of {len(sources)} sources in {n_tiles[0] * n_tiles[1]} tiles")
+
+    fluxes = np.zeros(len(sources))
+    for ix in range(n_tiles[0]):
+        for iy in range(n_tiles[1]):
+            in_tile = (tile_indexes[:, 0] == ix) & (tile_indexes[:, 1] == iy)
+            if not np.any(in_tile):
+                continue
+
+            # Extend the tile by the halo and collect all sources that contribute flux to the extended tile
+            xmin, xmax = max(ix * tile_size - halo, 0), min((ix + 1) * tile_size + halo, image.shape[0])
+            ymin, ymax = max(iy * tile_size - halo, 0), min((iy + 1) * tile_size + halo, image.shape[1])
+            overlaps = (integer_offsets[:, 0] > xmin - psf.shape[0]) & (integer_offsets[:, 0] < xmax) & \
+                       (integer_offsets[:, 1] > ymin - psf.shape[1]) & (integer_offsets[:, 1] < ymax)
+            indexes = np.where(overlaps | in_tile)[0]
+
+            # Build the sparse design matrix from the shifted PSFs of the sources
+            rows = integer_offsets[indexes, 0, None] + stamp_rows - xmin
+            cols = integer_offsets[indexes, 1, None] + stamp_cols - ymin
+            values = np.array([_get_shifted_psf(psf, tuple(fractions[index]), oversampling, stamps).ravel()
+                               for index in indexes])
+            inside = (rows >= 0) & (rows < xmax - xmin) & (cols >= 0) & (cols < ymax - ymin)
+            columns = np.broadcast_to(np.arange(len(indexes))[:, None], rows.shape)
+            pixels = rows[inside] * (ymax - ymin) + cols[inside]
+            weights = pixel_weights[xmin:xmax, ymin:ymax].ravel()
+            design_matrix = sparse.csr_matrix((values[inside] * weights[pixels], (pixels, columns[inside])),
+                                              shape=((xmax - xmin) * (ymax - ymin), len(indexes)))
+            if background:
+                design_matrix = sparse.hstack([design_matrix, sparse.csr_matrix(weights[:, None])], format='csr')
+
+            # Solve for the fluxes with normalized columns for a faster convergence, and keep the fluxes of the sources
+            # within the tile
+            norms = sparse.linalg.norm(design_matrix, axis=0)
+            norms[norms == 0] = 1
+            solution = lsqr(design_matrix @ sparse.diags(1 / norms), image[xmin:xmax, ymin:ymax].ravel() * weights,
+                            atol=1e-8, btol=1e-8)[0] / norms
+            fluxes[indexes[in_tile[indexes]]] = solution[:len(indexes)][in_tile[indexes]]
+
+    # Reformatting sources table
+    sources = Table([positions[:, 1], positions[:, 0], fluxes], names=['x', 'y', 'flux'])
+    sources.sort('flux', reverse=True)
+
+    # Save sources table to file, if requested
+    if write_to is not None:
+        logger.info(f"Writing list of sources to file {write_to}")
+        sources.write(write_to, format='ascii.fixed_width', overwrite=True)
+
+    return sources
+
+
+def _get_shifted_psf(psf, fraction, oversampling, stamps):
+    """Shift the PSF by a multiple of 1 / `oversampling` pixels, reusing the PSFs that were shifted before."""
+    if fraction not in stamps:
+        stamps[fraction] = ndimage.shift(psf, np.array(fraction) / oversampling, order=3, mode='constant')
+    return stamps[fraction]
+
+
+def get_mean_psf(psf):
+    """Average a PSF cube or the PSF frames of a list of files into a single PSF, normalized to unit sum.
+
+    Args:
+        psf (np.ndarray or list):
+            PSF image or cube, or a list of PSF files, which may be compressed by
+            specklepy.io.psffile.compress_psf_file().
+
+    Returns:
+        psf (np.ndarray, ndim=2):
+            Average PSF.
+    """
+    if isinstance(psf, list):
+        frames = []
+        for file in psf:
+            psfs, coefficients = read_psf_file(file)
+            if coefficients is not None:
+                psfs = np.tensordot(np.mean(coefficients, axis=0), psfs, axes=1)
+            frames.append(psfs if psfs.ndim == 2 else np.mean(psfs, axis=0))
+        psf = np.mean(frames, axis=0)
+    elif not isinstance(psf, np.ndarray):
+        raise SpecklepyTypeError('get_mean_psf()', argname='psf', argtype=type(psf), expected='np.ndarray or list')
+    elif psf.ndim == 3:
+        psf = np.mean(psf, axis=0)
+    if psf.ndim != 2:
+        raise SpecklepyValueError('get_mean_psf()', argname='psf.ndim', argvalue=psf.ndim, expected='2 or 3')
+    return psf / np.sum(psf)
+
+
+def get_apodization_psf(type, radius):
+    """Evaluate the apodization kernel of a holographic reconstruction, which is the PSF of the reconstructed image.
+
+    Args:
+        type (str):
+            Type of the apodization, see specklepy.core.fourierobject.FourierObject.apodize().
+        radius (float):
+            Radius of the apodization kernel.
+
+    Returns:
+        psf (np.ndarray, ndim=2):
+            Apodization kernel, normalized to unit sum.
+    """
+    size = 2 * int(np.ceil(4 * radius)) + 1
+    psf = PSFModel(type=type, radius=radius)((size, size))
+    return psf / np.sum(psf)
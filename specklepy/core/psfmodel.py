@@ -26,26 +26,41 @@ class PSFModel(object):
                 kwargs['x_stddev'] = kwargs['radius']
                 kwargs['y_stddev'] = kwargs['radius']
                 del kwargs['radius']
-            self.model = Gaussian2D(x_mean=self.center[0], y_mean=self.center[1], **kwargs)
+            self.model = Gaussian2D(x_mean=self.center[1], y_mean=self.center[0], **kwargs)
 
         elif 'airy' in self.type.lower():
-            self.model = AiryDisk2D(x_0=self.center[0], y_0=self.center[1], **kwargs)
+            self.model = AiryDisk2D(x_0=self.center[1], y_0=self.center[0], **kwargs)
 
         else:
             raise SpecklepyValueError('PSFModel', argname='type', argvalue=type, expected="either 'Gaussian' or 'Airy'")
 
-    def __call__(self, shape):
+    def __call__(self, shape, center=None):
+        """Evaluate the model on a grid.
+
+        Args:
+            shape (tuple):
+                Shape of the grid.
+            center (tuple, optional):
+                Center of the model along both image axes. Default is ((shape[0] + 1) / 2, (shape[1] + 1) / 2).
+
+        Returns:
+            model (np.ndarray):
+                Model evaluated on the grid.
+        """
 
         # Update shape and center according to input shape
         self.shape = shape
-        self.center = ((self.shape[0] + 1) / 2, (self.shape[1] + 1) / 2)
+        if center is None:
+            self.center = ((self.shape[0] + 1) / 2, (self.shape[1] + 1) / 2)
+        else:
+            self.center = tuple(center)
 
-        # Update self.model center coordinates
+        # Update self.model center coordinates, where the model x-coordinate runs along the second image axis
         from IPython import embed
         if isinstance(self.model, Gaussian2D):
-            self.model.x_mean, self.model.y_mean = list(self.center)
+            self.model.x_mean, self.model.y_mean = self.center[1], self.center[0]
         elif isinstance(self.model, AiryDisk2D):
-            self.model.x_0, self.model.y_0 = list(self.center)
+            self.model.x_0, self.model.y_0 = self.center[1], self.center[0]
 
         # Create coordinate grid
         y, x = np.mgrid[0:self.shape[0], 0:self.shape[1]]
@@ -1,3 +1,4 @@
+from contextlib import contextmanager
 from IPython import embed
 import numpy as np
 import os
@@ -5,7 +6,7 @@ import os
 from astropy.io import fits
 
 from specklepy.core import alignment
-from specklepy.core.ssa import coadd_frames
+from specklepy.core.ssa import coadd_frames, get_frame_quality, select_frames
 from specklepy.exceptions import SpecklepyTypeError, SpecklepyValueError
 from specklepy.io.outfile import Outfile
 from specklepy.io.reconstructionfile import ReconstructionFile
@@ -24,12 +25,14 @@ class Reconstruction(object):
     supported_modes = ['full', 'same', 'valid']
 
     def __init__(self, in_files, mode='same', reference_image=None, out_file=None, in_dir=None, tmp_dir=None,
-                 alignment_method='collapse', var_ext=None, box_indexes=None, debug=False):
+                 alignment_method='collapse', var_ext=None, box_indexes=None, selection_fraction=None,
+                 selection_threshold=None, drift_block_size=None, memory_limit=None, cache=None, upsample_factor=None,
+                 debug=False):
         """Create a Reconstruction instance.
 
         Args:
             in_files (list):
-                List of input data cubes.
+                List of input data cubes, given as file names or as arrays, which may be memory-mapped.
             mode (str, optional):
                 Reconstruction mode, defines the final image size and can be `full`, `same` and `valid`. The final image
                 sizes is derived as follows:
@@ -41,13 +44,37 @@ class Reconstruction(object):
                 - `valid`:
                     The reconstruction image covers only that field that is covered by all images in the input files.
             reference_image (int or str, optional):
-                The index in the `in_files` list or the name of the image serving as reference in 'same' mode.
+                The index in the `in_files` list or the name of the image serving as reference in 'same' mode. Names
+                are only supported for files.
             out_file (str, optional):
                 Name of an output file to store the reconstructed image in.
             in_dir (str, optional):
                 Path to the `in_files`.
             tmp_dir (str, optional):
-                Path to the directory for storing temporary products.
+                Path to the directory for storing temporary products, i.e. the long exposures that exceed the
+                `memory_limit`.
+            selection_fraction (float, optional):
+                Fraction of the frames of each cube with the highest quality that are considered for the long
+                exposures. See specklepy.core.ssa.select_frames for details.
+            selection_threshold (float, optional):
+                Minimum quality of the frames that are considered for the long exposures. See
+                specklepy.core.ssa.select_frames for details.
+            drift_block_size (int, optional):
+                If provided, the drift of the frames within each cube is tracked in blocks of this number of frames,
+                see specklepy.core.alignment.get_frame_shifts. The collapsed long exposures are then corrected for
+                the drift and the shifts are stored in the `frame_shifts` attribute. No drift is tracked if not
+                provided.
+            memory_limit (float, optional):
+                Upper limit of memory in units of MB for keeping the long exposures of the cubes in memory. Further
+                long exposures are stored as FITS files in `tmp_dir` and read back for the co-addition. All long
+                exposures are kept in memory if not provided.
+            cache (specklepy.io.cache.Cache, optional):
+                Cache that is consulted for the long exposures, frame selections, frame shifts and shifts of the cubes
+                before computing them, and that these are stored in otherwise.
+            upsample_factor (int, optional):
+                Estimate the shifts between the long exposures to a precision of 1 / `upsample_factor` pixels, see
+                specklepy.core.alignment.get_shifts. The long exposures are co-added on the rounded shifts. Integer
+                shifts are estimated if not provided.
             debug (bool, optional):
                 Show debugging information.
         """
@@ -72,17 +99,27 @@ class Reconstruction(object):
         self.in_dir = in_dir if in_dir is not None else ''
         self.tmp_dir = tmp_dir if tmp_dir is not None else ''
         self.var_ext = var_ext  # if var_ext is not None else 'VAR'
+        self.box_indexes = box_indexes
         self.box = Box(box_indexes) if box_indexes is not None else None
+        self.selection_fraction = selection_fraction
+        self.selection_threshold = selection_threshold
+        self.frame_selections = None
+        self.drift_block_size = drift_block_size
+        self.frame_shifts = None
+        self.memory_limit = memory_limit
+        self.cache = cache
+        self.upsample_factor = upsample_factor
 
         # Retrieve name of reference file
         self.reference_file = self.identify_reference_file()
 
         # Derive shape of individual input frames
         single_cube_mode = len(self.in_files) == 1
-        example_frame = fits.getdata(os.path.join(in_dir, self.in_files[0]))
-        if example_frame.ndim == 3:
-            example_frame = example_frame[0]
-        self.frame_shape = example_frame.shape
+        if isinstance(self.in_files[0], np.ndarray):
+            example_cube = self.in_files[0]
+        else:
+            example_cube = fits.getdata(os.path.join(self.in_dir, self.in_files[0]))
+        self.frame_shape = example_cube.shape[-2:]
 
         # Initialize image
         if single_cube_mode:
@@ -90,18 +127,16 @@ class Reconstruction(object):
             self.shifts = (0, 0)
         else:
             # Compute SSA reconstructions of cubes or collapse cubes for initial alignments
-            self.long_exp_files = self.create_long_exposures(alignment_method=alignment_method)
+            self.long_exposures, self.long_exposure_vars = \
+                self.create_long_exposures(alignment_method=alignment_method)
 
-            # Identify reference tmp file
-            self.reference_tmp_file = self.identify_reference_long_exposure_file()
+            # Identify reference long exposure
+            self.reference_long_exposure = self.identify_reference_long_exposure()
 
             # Estimate relative shifts
-            self.shifts = alignment.get_shifts(files=self.long_exp_files, reference_file=self.reference_tmp_file,
-                                               lazy_mode=True, return_image_shape=False, in_dir=tmp_dir, debug=debug)
-
-            # Derive corresponding padding vectors
-            self.pad_vectors, self.reference_pad_vector = \
-                alignment.get_pad_vectors(shifts=self.shifts, cube_mode=False, return_reference_image_pad_vector=True)
+            self.shifts = alignment.get_shifts(files=self.long_exposures, reference_file=self.reference_long_exposure,
+                                               lazy_mode=True, return_image_shape=False, in_dir=self.tmp_dir,
+                                               upsample_factor=self.upsample_factor, cache=self.cache, debug=debug)
 
             # Derive corresponding image sizes
             self.image = self.initialize_image()
@@ -114,6 +149,8 @@ class Reconstruction(object):
                                       in_dir=in_dir, cards={"RECONSTRUCTION": "SSA"})
         if self.var is not None:
             self.out_file.new_extension(name=self.var_ext, data=self.var)
+        if self.frame_selections is not None:
+            self.out_file.set_frame_selections(self.frame_selections)
 
     def identify_reference_file(self):
 
@@ -126,79 +163,143 @@ class Reconstruction(object):
         elif isinstance(self.reference_image, int):
             reference_file = self.in_files[self.reference_image]
         else:
-            SpecklepyTypeError('Reconstruction', 'reference_image', type(self.reference_image), 'int or str')
+            raise SpecklepyTypeError('Reconstruction', 'reference_image', type(self.reference_image), 'int or str')
 
         return reference_file
 
-    def identify_reference_long_exposure_file(self):
-        """Identify the long exposure file that corresponds to the reference cube"""
-        reference_tmp_file = None
+    def identify_reference_long_exposure(self):
+        """Identify the long exposure that corresponds to the reference cube."""
 
         if isinstance(self.reference_image, str):
-            for tmp_file in self.long_exp_files:
-                if self.reference_file in tmp_file:
-                    self.reference_tmp_file = tmp_file
-            if reference_tmp_file is None:
-                raise RuntimeError(f"Unable to identify reference file in list of temporary reconstructions!")
-
-        elif isinstance(self.reference_image, int):
-            reference_tmp_file = self.long_exp_files[self.reference_image]
+            for index, file in enumerate(self.in_files):
+                if isinstance(file, str) and os.path.basename(file) == os.path.basename(self.reference_file):
+                    return self.long_exposures[index]
+            raise RuntimeError(f"Unable to identify reference file {self.reference_file} in list of input files!")
 
-        return reference_tmp_file
+        return self.long_exposures[self.reference_image]
 
     def create_long_exposures(self, alignment_method):
-        """Compute long exposures from the input data cubes."""
+        """Compute long exposures from the input data cubes.
 
-        # Initialize list of long exposure files
-        long_exposure_files = []
+        The long exposures are kept in memory, until their total size exceeds the `memory_limit`. Further long
+        exposures are stored to FITS files in `tmp_dir`.
 
-        # Iterate over input data cubes
-        for file in self.in_files:
+        Returns:
+            long_exposures (list):
+                List of the long exposure images or the names of the files in `tmp_dir` that they are stored in.
+            long_exposure_vars (list):
+                List of the variances of the long exposures that are kept in memory, None otherwise.
+        """
 
-            # Read data from file
-            cube = fits.getdata(os.path.join(self.in_dir, file))
-            image = None
-            image_var = None
+        # Initialize lists of long exposures
+        long_exposures = []
+        long_exposure_vars = []
+        memory_usage = 0
+        select = self.selection_fraction is not None or self.selection_threshold is not None
+        if select:
+            self.frame_selections = []
+        if self.drift_block_size is not None:
+            self.frame_shifts = []
+
+        # Iterate over input data cubes
+        for index, file in enumerate(self.in_files):
+
+            name = os.path.basename(file) if isinstance(file, str) else f"cube_{index}.fits"
+            tmp_file = ('int_' if alignment_method == 'collapse' else 'ssa_') + name
+
+            # Consult the cache for the long exposure of this cube
+            if self.cache is not None:
+                key = self.cache.key(files=[file], in_dir=self.in_dir, function='create_long_exposures',
+                                     alignment_method=alignment_method, box_indexes=self.box_indexes,
+                                     selection_fraction=self.selection_fraction,
+                                     selection_threshold=self.selection_threshold,
+                                     drift_block_size=self.drift_block_size)
+                entry = self.cache.load(key)
+            else:
+                entry = None
+
+            if entry is not None:
+                logger.info(f"Using cached long exposure of cube {name}")
+                image = entry['image']
+                image_var = entry.get('image_var')
+                if select:
+                    self.frame_selections.append(entry['frame_selection'])
+                if self.drift_block_size is not None:
+                    self.frame_shifts.append(entry['frame_shifts'])
+            else:
+                image, image_var = self._compute_long_exposure(file, alignment_method=alignment_method)
+                if self.cache is not None:
+                    self.cache.store(key, image=image, image_var=image_var,
+                                     frame_selection=self.frame_selections[-1] if select else None,
+                                     frame_shifts=self.frame_shifts[-1] if self.drift_block_size is not None else None)
+
+            # Keep the long exposure in memory or store data to a new Outfile instance beyond the memory limit
+            memory_usage += image.nbytes + (image_var.nbytes if image_var is not None else 0)
+            if self.memory_limit is None or memory_usage <= self.memory_limit * 1024**2:
+                long_exposures.append(image)
+                long_exposure_vars.append(image_var)
+            else:
+                tmp_path = os.path.join(self.tmp_dir, tmp_file)
+                logger.info(f"Saving temporary reconstruction of cube {name} to {tmp_path}")
+                tmp_file_object = Outfile(tmp_path, data=image, verbose=True)
+                if image_var is not None:
+                    tmp_file_object.new_extension(name=self.var_ext, data=image_var)
+                long_exposures.append(tmp_file)
+                long_exposure_vars.append(None)
+
+        return long_exposures, long_exposure_vars
+
+    def _compute_long_exposure(self, file, alignment_method):
+        """Compute the long exposure of a single cube, appending its frame selection and frame shifts."""
+
+        select = self.selection_fraction is not None or self.selection_threshold is not None
+        image = None
+        image_var = None
+
+        # Compute collapsed or SSA'ed images from the memory-mapped cube, such that only the box region is read for the
+        # frame selection and peak search
+        with _read_cube(file, in_dir=self.in_dir) as cube:
+            if self.drift_block_size is not None:
+                frame_shifts = alignment.get_frame_shifts(cube, block_size=self.drift_block_size)
+                self.frame_shifts.append(frame_shifts)
+            else:
+                frame_shifts = None
 
-            # Compute collapsed or SSA'ed images from the cube
             if alignment_method == 'collapse':
-                image = np.sum(cube, axis=0)
-                tmp_file = 'int_' + os.path.basename(file)
+                if frame_shifts is not None:
+                    # Collapse the cube, correcting for the drift
+                    image, _, frame_selection = coadd_frames(cube=cube, box=self.box,
+                                                             selection_fraction=self.selection_fraction,
+                                                             selection_threshold=self.selection_threshold,
+                                                             return_selection=True, frame_shifts=frame_shifts)
+                    if select:
+                        self.frame_selections.append(frame_selection)
+                elif select:
+                    frame_selection = select_frames(get_frame_quality(cube, box=self.box),
+                                                    fraction=self.selection_fraction,
+                                                    threshold=self.selection_threshold)
+                    image = np.sum(cube[frame_selection], axis=0)
+                    self.frame_selections.append(frame_selection)
+                else:
+                    image = np.sum(cube, axis=0)
             elif alignment_method == 'ssa':
-                image, image_var = coadd_frames(cube=cube, box=self.box)
-                tmp_file = 'ssa_' + os.path.basename(file)
+                image, image_var, frame_selection = coadd_frames(cube=cube, box=self.box,
+                                                                 selection_fraction=self.selection_fraction,
+                                                                 selection_threshold=self.selection_threshold,
+                                                                 return_selection=True)
+                if select:
+                    self.frame_selections.append(frame_selection)
             else:
                 raise SpecklepyValueError('Reconstruction', 'alignment_method', alignment_method,
                                           expected="either 'collapse' or 'ssa'")
 
-            # Store data to a new Outfile instance
-            tmp_path = os.path.join(self.tmp_dir, tmp_file)
-            logger.info(f"Saving temporary reconstruction of cube {file} to {tmp_path}")
-            tmp_file_object = Outfile(tmp_path, data=image, verbose=True)
-            if image_var is not None:
-                tmp_file_object.new_extension(name=self.var_ext, data=image_var)
-
-            # Add the recently created file to the list
-            long_exposure_files.append(tmp_file)
-
-        return long_exposure_files
+        return image, image_var
 
     def initialize_image(self):
         """Initialize the reconstruction image."""
 
-        # Initialize image along the input frame shape
-        image = np.zeros(self.frame_shape)
-
-        # Crop or expand according to the reconstruction mode
-        if self.mode == 'same':
-            pass
-        elif self.mode == 'full':
-            image = np.pad(image, self.reference_pad_vector, mode='constant')
-        elif self.mode == 'valid':
-            # Estimate minimum overlap
-            _shifts = np.array(self.shifts)
-            _crop_by = np.max(_shifts, axis=0) - np.min(_shifts, axis=0)
-            image = image[_crop_by[0]:, _crop_by[1]:]
+        # Initialize image along the input frame shape, expanded or cropped according to the reconstruction mode
+        image = np.zeros(alignment.get_canvas_shape(self.frame_shape, self.shifts, mode=self.mode))
 
         return image
 
@@ -206,22 +307,25 @@ class Reconstruction(object):
         """Coadd the interim long exposures."""
 
         # Iterate over long exposure images
-        for index, file in enumerate(self.long_exp_files):
+        for index, long_exposure in enumerate(self.long_exposures):
 
-            # Read data
-            with fits.open(os.path.join(self.tmp_dir, file)) as hdu_list:
-                tmp_image = hdu_list[0].data
-                if self.var_ext is not None and self.var_ext in hdu_list:
-                    tmp_image_var = hdu_list[self.var_ext].data
-                else:
-                    tmp_image_var = None
-
-            # Co-add reconstructions and var images
-            self.image += alignment.pad_array(tmp_image, self.pad_vectors[index], mode=self.mode,
-                                                  reference_image_pad_vector=self.reference_pad_vector)
+            # Read data, if not kept in memory
+            if isinstance(long_exposure, np.ndarray):
+                tmp_image = long_exposure
+                tmp_image_var = self.long_exposure_vars[index]
+            else:
+                with fits.open(os.path.join(self.tmp_dir, long_exposure)) as hdu_list:
+                    tmp_image = hdu_list[0].data
+                    if self.var_ext is not None and self.var_ext in hdu_list:
+                        tmp_image_var = hdu_list[self.var_ext].data
+                    else:
+                        tmp_image_var = None
+
+            # Co-add reconstructions and var images in place
+            alignment.place_into_canvas(self.image, tmp_image, self.shifts[index], mode=self.mode, shifts=self.shifts)
             if tmp_image_var is not None:
-                self.var += alignment.pad_array(tmp_image_var, self.pad_vectors[index], mode=self.mode,
-                                                          reference_image_pad_vector=self.reference_pad_vector)
+                alignment.place_into_canvas(self.var, tmp_image_var, self.shifts[index], mode=self.mode,
+                                            shifts=self.shifts)
 
         # Update out_file
         self.out_file.data = self.image
@@ -229,3 +333,13 @@ class Reconstruction(object):
             self.out_file.update_extension(ext_name=self.var_ext, data=self.var)
 
         return self.image, self.var
+
+
+@contextmanager
+def _read_cube(file, in_dir=''):
+    """Provide a data cube from an array or a memory-mapped FITS file."""
+    if isinstance(file, np.ndarray):
+        yield file
+    else:
+        with fits.open(os.path.join(in_dir, file), memmap=True) as hdu_list:
+            yield hdu_list[0].data
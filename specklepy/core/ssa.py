@@ -1,19 +1,28 @@
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
 import numpy as np
 import os
 
 from astropy.io import fits
 
 from specklepy.core import alignment
+from specklepy.core.accumulator import SSAAccumulator
 from specklepy.exceptions import SpecklepyTypeError, SpecklepyValueError
 from specklepy.io.outfile import Outfile
 from specklepy.io.reconstructionfile import ReconstructionFile
 from specklepy.logging import logger
 from specklepy.utils.box import Box
+from specklepy.utils.chunks import chunk_slices, get_chunk_size
 from specklepy.plotting.plots import imshow
 
 
+# Number of grid points per pixel for the sub-pixel alignment of the reconstructions of different cubes
+SUBPIXEL_UPSAMPLE_FACTOR = 100
+
+
 def ssa(files, mode='same', reference_file=None, outfile=None, in_dir=None, tmp_dir=None, lazy_mode=True, box_indexes=None,
-        debug=False, **kwargs):
+        memory_limit=None, subpixel=False, n_processes=None, selection_fraction=None, selection_threshold=None,
+        accumulator_file=None, debug=False, **kwargs):
     """Compute the SSA reconstruction of a list of files.
 
     The simple shift-and-add (SSA) algorithm makes use of the structure of typical speckle patterns, i.e.
@@ -31,7 +40,8 @@ def ssa(files, mode='same', reference_file=None, outfile=None, in_dir=None, tmp_
         mode (str):
             Name of the reconstruction mode: In 'same' mode, the reconstruction covers the same field of view of the
             reference file. In 'full' mode, every patch of the sky that is covered by at least one frame will be
-            contained in the final reconstruction.
+            contained in the final reconstruction. In 'valid' mode, the reconstruction covers only the field that is
+            covered by all cubes.
         reference_file (str, int, optional):
             Path to a reference file or index of the file in files, relative to which the shifts are computed. See
             specklepy.core.aligment.get_shifts for details. Default is 0.
@@ -40,12 +50,34 @@ def ssa(files, mode='same', reference_file=None, outfile=None, in_dir=None, tmp_
         in_dir (str, optional):
             Path to the files. `None` is substituted by an empty string.
         tmp_dir (str, optional):
-            Path of a directory in which the temporary results are stored in.
+            Path of a directory in which the temporary results are stored in. The interim reconstructions of the
+            individual cubes are kept in memory only, if not provided.
         lazy_mode (bool, optional):
             Set to False, to enforce the alignment of a single file with respect to the reference file. Default is True.
         box_indexes (list, optional):
             Constraining the search for the intensity peak to the specified box. Searching the full frames if not
             provided.
+        memory_limit (float, optional):
+            Upper limit of memory in units of MB for reading frames. If provided, the cubes are memory-mapped and
+            processed in chunks of frames that fit into this limit. Reading full cubes at once if not provided.
+        subpixel (bool, optional):
+            Set to True to align the frames within a cube on sub-pixel peak positions, see coadd_frames() for details,
+            and the reconstructions of different cubes on sub-pixel shifts from an upsampled cross-correlation, see
+            specklepy.core.alignment.get_shift(). Default is False.
+        n_processes (int, optional):
+            Number of processes for computing the SSA reconstructions of the individual cubes in parallel. Default is 1.
+        selection_fraction (float, optional):
+            Fraction of the frames of each cube with the highest quality that are considered for the reconstruction.
+            See coadd_frames() for details. All frames are considered if not provided.
+        selection_threshold (float, optional):
+            Minimum quality of the frames that are considered for the reconstruction. See coadd_frames() for details.
+            All frames are considered if not provided.
+        accumulator_file (str, optional):
+            Path to a file that stores the running sums of the aligned cubes, see
+            specklepy.core.accumulator.SSAAccumulator. If the file exists, only files that are not yet contained are
+            reconstructed and added, and the `reference_file` of the existing accumulator is used. The file is
+            created or updated afterwards. The result is identical to a reconstruction of all files with
+            `lazy_mode=False`.
         debug (bool, optional):
             Show debugging information. Default is False.
 
@@ -75,19 +107,35 @@ def ssa(files, mode='same', reference_file=None, outfile=None, in_dir=None, tmp_
     elif not isinstance(reference_file, str):
         raise SpecklepyTypeError('ssa()', argname='reference_file', argtype=type(reference_file), expected='str or int')
 
+    if in_dir is None:
+        in_dir = ''
+    reference_file = os.path.join(in_dir, reference_file)
+
+    if accumulator_file is None:
+        accumulator = None
+    elif not isinstance(accumulator_file, str):
+        raise SpecklepyTypeError('ssa()', argname='accumulator_file', argtype=type(accumulator_file), expected='str')
+    elif os.path.isfile(accumulator_file):
+        accumulator = SSAAccumulator.from_file(accumulator_file)
+    else:
+        logger.info(f"Initializing SSA accumulator with reference file {reference_file}")
+        accumulator = SSAAccumulator(reference_image=fits.getdata(reference_file),
+                                     upsample_factor=SUBPIXEL_UPSAMPLE_FACTOR if subpixel else None)
+
     if outfile is None:
         pass
     elif isinstance(outfile, str):
-        outfile = ReconstructionFile(files=files, filename=outfile, cards={"RECONSTRUCTION": "SSA"})
+        if accumulator is None:
+            outfile = ReconstructionFile(files=files, filename=outfile, cards={"RECONSTRUCTION": "SSA"}, in_dir=in_dir)
+        else:
+            paths = accumulator.files + [os.path.join(in_dir, file) for file in files
+                                         if os.path.join(in_dir, file) not in accumulator]
+            outfile = ReconstructionFile(files=paths, filename=outfile, cards={"RECONSTRUCTION": "SSA"})
     elif isinstance(outfile, ReconstructionFile):
         pass
     else:
         raise SpecklepyTypeError('ssa()', argname='outfile', argtype=type(outfile), expected='str')
 
-    if in_dir is None:
-        in_dir = ''
-    reference_file = os.path.join(in_dir, reference_file)
-
     if tmp_dir is not None:
         if isinstance(tmp_dir, str) and not os.path.isdir(tmp_dir):
             os.makedirs(tmp_dir)
@@ -100,6 +148,31 @@ def ssa(files, mode='same', reference_file=None, outfile=None, in_dir=None, tmp_
     else:
         box = None
 
+    if memory_limit is not None and not isinstance(memory_limit, (int, float)):
+        raise SpecklepyTypeError('ssa()', argname='memory_limit', argtype=type(memory_limit), expected='int or float')
+
+    if not isinstance(subpixel, bool):
+        raise SpecklepyTypeError('ssa()', argname='subpixel', argtype=type(subpixel), expected='bool')
+
+    if n_processes is None:
+        n_processes = 1
+    elif not isinstance(n_processes, int):
+        raise SpecklepyTypeError('ssa()', argname='n_processes', argtype=type(n_processes), expected='int')
+    elif n_processes < 1:
+        raise SpecklepyValueError('ssa()', argname='n_processes', argvalue=n_processes, expected='>= 1')
+
+    if selection_fraction is not None:
+        if not isinstance(selection_fraction, (int, float)):
+            raise SpecklepyTypeError('ssa()', argname='selection_fraction', argtype=type(selection_fraction),
+                                     expected='float')
+        if not 0 < selection_fraction <= 1:
+            raise SpecklepyValueError('ssa()', argname='selection_fraction', argvalue=selection_fraction,
+                                      expected='in the interval (0, 1]')
+
+    if selection_threshold is not None and not isinstance(selection_threshold, (int, float)):
+        raise SpecklepyTypeError('ssa()', argname='selection_threshold', argtype=type(selection_threshold),
+                                 expected='float')
+
     if 'variance_extension_name' in kwargs.keys():
         var_ext = kwargs['variance_extension_name']
     else:
@@ -110,79 +183,88 @@ def ssa(files, mode='same', reference_file=None, outfile=None, in_dir=None, tmp_
         logger.handlers[0].setLevel('DEBUG')
         logger.info("Set logging level to DEBUG")
 
+    # Skip files that are already contained in the accumulator
+    if accumulator is not None:
+        for file in files:
+            if os.path.join(in_dir, file) in accumulator:
+                logger.info(f"Skipping file {file}, which is already contained in the SSA accumulator")
+        files = [file for file in files if os.path.join(in_dir, file) not in accumulator]
+
     # Align reconstructions if multiple files are provided
-    if lazy_mode and len(files) == 1:
+    if accumulator is not None:
+
+        # Add reconstructions of the new cubes to the running sums
+        paths = [os.path.join(in_dir, file) for file in files]
+        results = _coadd_files(paths, n_processes=n_processes, var_ext=var_ext, box=box, memory_limit=memory_limit,
+                               subpixel=subpixel, selection_fraction=selection_fraction,
+                               selection_threshold=selection_threshold)
+        for path, (tmp, tmp_var, frame_selection) in zip(paths, results):
+            accumulator.add(tmp, file=path, image_var=tmp_var, frame_selection=frame_selection)
+        del results
+        accumulator.save(accumulator_file)
+        reconstruction, reconstruction_var = accumulator.get_image(mode=mode)
+        frame_selections = accumulator.frame_selections
+
+    elif lazy_mode and len(files) == 1:
 
         # Do not align just a single file
-        with fits.open(os.path.join(in_dir, files[0])) as hdu_list:
-            cube = hdu_list[0].data
-            if var_ext in hdu_list:
-                var_cube = hdu_list[var_ext].data
-            else:
-                var_cube = None
-            reconstruction, reconstruction_var = coadd_frames(cube, var_cube=var_cube, box=box)
+        reconstruction, reconstruction_var, frame_selection = \
+            _coadd_file(os.path.join(in_dir, files[0]), var_ext=var_ext, box=box, memory_limit=memory_limit,
+                        subpixel=subpixel, selection_fraction=selection_fraction,
+                        selection_threshold=selection_threshold)
+        frame_selections = [frame_selection]
 
     else:
 
-        # Compute temporary reconstructions of the individual cubes
-        tmp_files = []
-        for index, file in enumerate(files):
-            with fits.open(os.path.join(in_dir, file)) as hdu_list:
-                cube = hdu_list[0].data
-                if var_ext in hdu_list:
-                    var_cube = hdu_list[var_ext].data
-                    logger.debug(f"Found variance extension {var_ext} in file {file}")
-                else:
-                    logger.debug(f"Did not find variance extension {var_ext} in file {file}")
-                    var_cube = None
-                tmp, tmp_var = coadd_frames(cube, var_cube=var_cube, box=box)
+        # Compute interim reconstructions of the individual cubes
+        paths = [os.path.join(in_dir, file) for file in files]
+        results = _coadd_files(paths, n_processes=n_processes, var_ext=var_ext, box=box, memory_limit=memory_limit,
+                               subpixel=subpixel, selection_fraction=selection_fraction,
+                               selection_threshold=selection_threshold)
+        tmp_images = [result[0] for result in results]
+        tmp_image_vars = [result[1] for result in results]
+        frame_selections = [result[2] for result in results]
+        del results
 
+        for index, file in enumerate(files):
             if debug:
-                imshow(box(tmp), norm='log')
-
-            tmp_file = os.path.basename(file).replace(".fits", "_ssa.fits")
-            tmp_file = os.path.join(tmp_dir, tmp_file)
-            logger.info("Saving interim SSA reconstruction of cube to {}".format(tmp_file))
-            tmp_file_object = Outfile(tmp_file, data=tmp, verbose=True)
-
-            # Store variance of temporary reconstruction
-            if tmp_var is not None:
-                tmp_file_object.new_extension(var_ext, data=tmp_var)
-                del tmp_var
-            tmp_files.append(tmp_file)
-
-        # Align tmp reconstructions and add up
-        file_shifts, image_shape = alignment.get_shifts(tmp_files, reference_file=reference_file,
-                                                        return_image_shape=True, lazy_mode=True)
-        pad_vectors, ref_pad_vector = alignment.get_pad_vectors(file_shifts, cube_mode=(len(image_shape) == 3),
-                                                                return_reference_image_pad_vector=True)
-
-        # Iterate over file-wise reconstructions
-        reconstruction = None
+                imshow(box(tmp_images[index]) if box is not None else tmp_images[index], norm='log')
+
+            # Store temporary reconstructions, if requested
+            if tmp_dir is not None:
+                tmp_file = os.path.basename(file).replace(".fits", "_ssa.fits")
+                tmp_file = os.path.join(tmp_dir, tmp_file)
+                logger.info("Saving interim SSA reconstruction of cube to {}".format(tmp_file))
+                tmp_file_object = Outfile(tmp_file, data=tmp_images[index], verbose=True)
+
+                # Store variance of temporary reconstruction
+                if tmp_image_vars[index] is not None:
+                    tmp_file_object.new_extension(var_ext, data=tmp_image_vars[index])
+
+        # Align interim reconstructions and add up
+        file_shifts, image_shape = alignment.get_shifts(tmp_images, reference_file=reference_file,
+                                                        return_image_shape=True, lazy_mode=True,
+                                                        upsample_factor=SUBPIXEL_UPSAMPLE_FACTOR if subpixel else None)
+        if subpixel:
+            # Apply the sub-pixel fractions of the shifts to the interim reconstructions
+            integer_shifts = np.round(file_shifts).astype(int)
+            for index, fraction in enumerate(np.array(file_shifts) - integer_shifts):
+                tmp_images[index] = alignment.fourier_shift(tmp_images[index], fraction)
+                if tmp_image_vars[index] is not None:
+                    tmp_image_vars[index] = alignment.fourier_shift(tmp_image_vars[index], fraction)
+            file_shifts = [tuple(shift) for shift in integer_shifts]
+
+        # Co-add the file-wise reconstructions in place
+        canvas_shape = alignment.get_canvas_shape(image_shape, file_shifts, mode=mode)
+        reconstruction = np.zeros(canvas_shape)
         reconstruction_var = None
-        for index, file in enumerate(tmp_files):
-
-            # Read data
-            with fits.open(file) as hdu_list:
-                tmp_image = hdu_list[0].data
-                if var_ext in hdu_list:
-                    tmp_image_var = hdu_list[var_ext].data
-                else:
-                    tmp_image_var = None
-
-            # Initialize or co-add reconstructions and var images
-            if reconstruction is None:
-                reconstruction = alignment.pad_array(tmp_image, pad_vectors[index], mode=mode,
-                                                     reference_image_pad_vector=ref_pad_vector)
-                if tmp_image_var is not None:
-                    reconstruction_var = alignment.pad_array(tmp_image_var, pad_vectors[index], mode=mode,
-                                                             reference_image_pad_vector=ref_pad_vector)
-            else:
-                reconstruction += alignment.pad_array(tmp_image, pad_vectors[index], mode=mode,
-                                                      reference_image_pad_vector=ref_pad_vector)
-                if tmp_image_var is not None:
-                    reconstruction_var += alignment.pad_array(tmp_image_var, pad_vectors[index], mode=mode,
-                                                              reference_image_pad_vector=ref_pad_vector)
+        for index, tmp_image in enumerate(tmp_images):
+            alignment.place_into_canvas(reconstruction, tmp_image, file_shifts[index], mode=mode, shifts=file_shifts)
+            if tmp_image_vars[index] is not None:
+                if reconstruction_var is None:
+                    reconstruction_var = np.zeros(canvas_shape)
+                alignment.place_into_canvas(reconstruction_var, tmp_image_vars[index], file_shifts[index], mode=mode,
+                                            shifts=file_shifts)
     logger.info("Reconstruction finished...")
 
     # Save the result to an Outfile
@@ -190,6 +272,8 @@ def ssa(files, mode='same', reference_file=None, outfile=None, in_dir=None, tmp_
         outfile.data = reconstruction
         if reconstruction_var is not None:
             outfile.new_extension(name=var_ext, data=reconstruction_var)
+        if selection_fraction is not None or selection_threshold is not None:
+            outfile.set_frame_selections(frame_selections)
 
     # Return reconstruction (and the variance map if computed)
     if reconstruction_var is not None:
@@ -197,11 +281,24 @@ def ssa(files, mode='same', reference_file=None, outfile=None, in_dir=None, tmp_
     return reconstruction
 
 
-def coadd_frames(cube, var_cube=None, box=None):
+def coadd_frames(cube, var_cube=None, box=None, memory_limit=None, subpixel=False, selection_fraction=None,
+                 selection_threshold=None, return_selection=False, frame_shifts=None):
     """Compute the simple shift-and-add (SSA) reconstruction of a data cube.
 
     This function uses the SSA algorithm to coadd frames of a cube. If provided, this function coadds the variances
-    within a var cube considering the exact same shifts.
+    within a var cube considering the exact same shifts. If a memory limit is provided, the frames are read in chunks
+    that fit into this limit, such that memory-mapped cubes larger than the available memory can be processed. The
+    result does not depend on the chunk size.
+
+    In `subpixel` mode, the peak coordinates are refined by a quadratic fit to the peak and its neighbours along each
+    axis. The frames are then shifted by the integer part of their shifts via slicing and by the remaining fraction of
+    a pixel via phase ramps in Fourier space, which are applied to a whole chunk of frames at once.
+
+    If a selection fraction or threshold is provided, only the frames of highest quality are shifted and added (lucky
+    imaging). The quality of a frame is measured as its peak-to-flux ratio within the box, see get_frame_quality().
+
+    If `frame_shifts` are provided, e.g. the drift estimates from specklepy.core.alignment.get_frame_shifts(), the
+    frames are shifted by these instead of being aligned on their intensity peaks.
 
     Args:
         cube (np.ndarray, ndim=3):
@@ -211,12 +308,28 @@ def coadd_frames(cube, var_cube=None, box=None):
         box (Box object, optional):
             Constraining the search for the intensity peak to the specified box. Searching the full frames if not
             provided.
+        memory_limit (float, optional):
+            Upper limit of memory in units of MB for the chunks of frames that are read at once. All frames are read at
+            once if not provided.
+        subpixel (bool, optional):
+            Set to True to align the frames on sub-pixel peak positions. The frames of `var_cube` are shifted by the
+            same sub-pixel shifts. Default is False.
+        selection_fraction (float, optional):
+            Fraction of frames with the highest quality that are co-added. See select_frames() for details.
+        selection_threshold (float, optional):
+            Minimum quality of frames that are co-added. See select_frames() for details.
+        return_selection (bool, optional):
+            Set to True for returning the indizes of the co-added frames. Default is False.
+        frame_shifts (array_like, shape=(n_frames, 2), optional):
+            Shifts of the individual frames, which replace the shifts from the intensity peaks.
 
     Returns:
         coadded (np.ndarray, ndim=2):
             SSA-integrated frames of the input cube.
         var_coadded (np.ndarray, ndim=2):
             SSA-integrated variances of the input cube or the variance map itself if provided as a 2D cube.
+        frame_selection (np.ndarray, optional):
+            Indizes of the co-added frames. Only returned if `return_selection` is set to True.
     """
 
     if not isinstance(cube, np.ndarray):
@@ -236,36 +349,71 @@ def coadd_frames(cube, var_cube=None, box=None):
                 raise SpecklepyValueError('coadd_frames()', argname='var_cube.shape', argvalue=str(var_cube.shape),
                                           expected=str(cube.shape))
 
-    # Compute shifts
-    peak_indizes = np.zeros((cube.shape[0], 2), dtype=int)
-    for index, frame in enumerate(cube):
-        if box is not None:
-            frame = box(frame)
-        peak_indizes[index] = np.array(np.unravel_index(np.argmax(frame, axis=None), frame.shape), dtype=int)
+    if frame_shifts is not None:
+        frame_shifts = np.array(frame_shifts)
+        if frame_shifts.shape != (cube.shape[0], 2):
+            raise SpecklepyValueError('coadd_frames()', argname='frame_shifts.shape', argvalue=frame_shifts.shape,
+                                      expected=f"({cube.shape[0]}, 2)")
+
+    # Derive the number of frames per chunk
+    n_cubes = 2 if var_cube is not None and var_cube.ndim == 3 else 1
+    if subpixel or (frame_shifts is not None and not np.issubdtype(frame_shifts.dtype, np.integer)):
+        # Account for the Fourier transformed and shifted copies of a chunk
+        n_cubes += 2
+    chunk_size = get_chunk_size(cube.shape[1:], cube.dtype, n_frames=cube.shape[0], memory_limit=memory_limit,
+                                n_cubes=n_cubes)
+    if chunk_size < cube.shape[0]:
+        logger.debug(f"Processing cube in chunks of {chunk_size} frames")
+
+    # Compute shifts and frame qualities. The search is restricted to the box, such that only the box region of
+    # memory-mapped cubes is read, in chunks according to the smaller box size
+    select = selection_fraction is not None or selection_threshold is not None
+    search = frame_shifts is None
+    peak_indizes = np.zeros((cube.shape[0], 2), dtype=float if subpixel else int)
+    quality = np.zeros(cube.shape[0]) if select else None
+    if search or select:
+        search_cube = cube if box is None else cube[(slice(None),) + box.slices(cube.shape[1:])]
+        search_chunk_size = get_chunk_size(search_cube.shape[1:], cube.dtype, n_frames=cube.shape[0],
+                                           memory_limit=memory_limit)
+        for chunk in chunk_slices(cube.shape[0], search_chunk_size):
+            frames = np.ascontiguousarray(search_cube[chunk])
+            if search:
+                peak_indizes[chunk] = _get_peak_indizes(frames, subpixel=subpixel)
+            if select:
+                quality[chunk] = get_frame_quality(frames)
+        del search_cube
+
+    # Select frames of highest quality
+    if select:
+        frame_selection = select_frames(quality, fraction=selection_fraction, threshold=selection_threshold)
+        logger.info(f"Selected {len(frame_selection)} out of {cube.shape[0]} frames")
+        peak_indizes = peak_indizes[frame_selection]
+    else:
+        frame_selection = np.arange(cube.shape[0])
 
     # Compute shifts from indizes
-    peak_indizes = peak_indizes.transpose()
-    xmean, ymean = np.mean(np.array(peak_indizes), axis=1)
-    xmean = int(xmean)
-    ymean = int(ymean)
-    shifts = np.array([xmean - peak_indizes[0], ymean - peak_indizes[1]])
-    shifts = shifts.transpose()
+    if not search:
+        shifts = frame_shifts[frame_selection]
+    elif subpixel:
+        shifts = np.mean(peak_indizes, axis=0) - peak_indizes
+    else:
+        peak_indizes = peak_indizes.transpose()
+        xmean, ymean = np.mean(np.array(peak_indizes), axis=1)
+        xmean = int(xmean)
+        ymean = int(ymean)
+        shifts = np.array([xmean - peak_indizes[0], ymean - peak_indizes[1]])
+        shifts = shifts.transpose()
 
     # Shift frames and add to coadded
     coadded = np.zeros(cube[0].shape)
-    pad_vectors, ref_pad_vector = alignment.get_pad_vectors(shifts, cube_mode=False,
-                                                            return_reference_image_pad_vector=True)
-    for index, frame in enumerate(cube):
-        coadded += alignment.pad_array(frame, pad_vectors[index], mode='same',
-                                       reference_image_pad_vector=ref_pad_vector)
+    _coadd_shifted(coadded, cube, shifts, chunk_size=chunk_size, frame_indizes=frame_selection if select else None)
 
     # Coadd variance cube (if not an image itself)
     if var_cube is not None:
         if var_cube.ndim == 3:
             var_coadded = np.zeros(coadded.shape)
-            for index, frame in enumerate(var_cube):
-                var_coadded += alignment.pad_array(frame, pad_vectors[index], mode='same',
-                                                   reference_image_pad_vector=ref_pad_vector)
+            _coadd_shifted(var_coadded, var_cube, shifts, chunk_size=chunk_size,
+                           frame_indizes=frame_selection if select else None)
         elif var_cube.ndim == 2:
             var_coadded = var_cube
         else:
@@ -273,4 +421,196 @@ def coadd_frames(cube, var_cube=None, box=None):
     else:
         var_coadded = None
 
+    if return_selection:
+        return coadded, var_coadded, frame_selection
     return coadded, var_coadded
+
+
+def get_frame_quality(frames, box=None):
+    """Measure the quality of frames as their peak-to-flux ratio in a single vectorized pass.
+
+    Args:
+        frames (np.ndarray, ndim=3):
+            Stack of frames, with the zero-th axis being the time axis.
+        box (Box object, optional):
+            Constraining the quality measurement to the specified box.
+
+    Returns:
+        quality (np.ndarray, ndim=1):
+            Ratio of the peak intensity to the total flux of each frame.
+    """
+    if box is not None:
+        frames = frames[(slice(None),) + box.slices(frames.shape[1:])]
+    frames = frames.reshape((frames.shape[0], -1))
+    return np.divide(np.max(frames, axis=1), np.sum(frames, axis=1, dtype=float))
+
+
+def select_frames(quality, fraction=None, threshold=None):
+    """Select the frames of highest quality.
+
+    Args:
+        quality (np.ndarray, ndim=1):
+            Quality of each frame, as obtained from get_frame_quality().
+        fraction (float, optional):
+            Fraction of frames with the highest quality to select. At least one frame is selected.
+        threshold (float, optional):
+            Minimum quality of selected frames. If provided together with `fraction`, frames have to obey both
+            criteria.
+
+    Returns:
+        frame_selection (np.ndarray, ndim=1):
+            Sorted indizes of the selected frames.
+    """
+    selected = np.ones(len(quality), dtype=bool)
+    if threshold is not None:
+        selected &= quality >= threshold
+    if fraction is not None:
+        n_best = max(1, int(round(fraction * len(quality))))
+        best = np.zeros(len(quality), dtype=bool)
+        best[np.argsort(quality)[::-1][:n_best]] = True
+        selected &= best
+    if not np.any(selected):
+        raise RuntimeError(f"No frame passes the selection with fraction {fraction} and threshold {threshold}! The "
+                           f"highest frame quality is {np.max(quality)}.")
+    return np.where(selected)[0]
+
+
+def _coadd_files(paths, n_processes=1, **kwargs):
+    """Compute the SSA reconstructions of a list of FITS files, optionally distributed over a process pool.
+
+    Args:
+        paths (list of str):
+            Paths to the FITS files.
+        n_processes (int, optional):
+            Number of processes. The files are processed in the current process if 1. Default is 1.
+        **kwargs:
+            Passed to _coadd_file().
+
+    Returns:
+        results (list of tuple):
+            List of the return values of _coadd_file() for each file.
+    """
+    if n_processes > 1 and len(paths) > 1:
+        logger.info(f"Computing SSA reconstructions of {len(paths)} cubes in {n_processes} processes")
+        with ProcessPoolExecutor(max_workers=n_processes) as executor:
+            return list(executor.map(partial(_coadd_file, **kwargs), paths))
+    return [_coadd_file(path, **kwargs) for path in paths]
+
+
+def _coadd_file(path, var_ext='VAR', box=None, memory_limit=None, subpixel=False, selection_fraction=None,
+                selection_threshold=None):
+    """Compute the SSA reconstruction of the data cube in a FITS file.
+
+    This function is defined on module level, such that it can be distributed to worker processes.
+
+    Args:
+        path (str):
+            Path to the FITS file.
+        var_ext (str, optional):
+            Name of the variance extension, which is co-added with the same shifts if present in the file.
+        box (Box object, optional):
+            Passed to coadd_frames().
+        memory_limit (float, optional):
+            Passed to coadd_frames().
+        subpixel (bool, optional):
+            Passed to coadd_frames().
+        selection_fraction (float, optional):
+            Passed to coadd_frames().
+        selection_threshold (float, optional):
+            Passed to coadd_frames().
+
+    Returns:
+        coadded (np.ndarray, ndim=2):
+            SSA-integrated frames of the cube.
+        var_coadded (np.ndarray, ndim=2):
+            SSA-integrated variances of the cube, None if the file does not contain a variance extension.
+        frame_selection (np.ndarray, ndim=1):
+            Indizes of the co-added frames.
+    """
+    with fits.open(path, memmap=True) as hdu_list:
+        cube = hdu_list[0].data
+        if var_ext in hdu_list:
+            var_cube = hdu_list[var_ext].data
+            logger.debug(f"Found variance extension {var_ext} in file {path}")
+        else:
+            logger.debug(f"Did not find variance extension {var_ext} in file {path}")
+            var_cube = None
+        return coadd_frames(cube, var_cube=var_cube, box=box, memory_limit=memory_limit, subpixel=subpixel,
+                            selection_fraction=selection_fraction, selection_threshold=selection_threshold,
+                            return_selection=True)
+
+
+def _get_peak_indizes(frames, subpixel=False):
+    """Identify the indizes of the intensity peaks of a stack of frames in a single vectorized pass.
+
+    Args:
+        frames (np.ndarray, ndim=3):
+            Stack of frames, with the zero-th axis being the time axis.
+        subpixel (bool, optional):
+            Refine the peak indizes by fitting a parabola through the peak and its two neighbours along each axis. Peaks
+            on the edges of the frames are not refined.
+
+    Returns:
+        peak_indizes (np.ndarray, shape=(n_frames, 2)):
+            Indizes of the intensity peaks. The array is of float type in `subpixel` mode.
+    """
+    indizes = np.argmax(frames.reshape((frames.shape[0], -1)), axis=1)
+    peak_indizes = np.stack(np.unravel_index(indizes, frames.shape[1:]), axis=1)
+    if not subpixel:
+        return peak_indizes
+
+    # Refine peak indizes with a quadratic fit along each axis
+    frame_indizes = np.arange(frames.shape[0])
+    refined = peak_indizes.astype(float)
+    for axis in range(2):
+        lower = peak_indizes.copy()
+        upper = peak_indizes.copy()
+        lower[:, axis] = np.maximum(peak_indizes[:, axis] - 1, 0)
+        upper[:, axis] = np.minimum(peak_indizes[:, axis] + 1, frames.shape[axis + 1] - 1)
+        center_values = frames[frame_indizes, peak_indizes[:, 0], peak_indizes[:, 1]].astype(float)
+        lower_values = frames[frame_indizes, lower[:, 0], lower[:, 1]].astype(float)
+        upper_values = frames[frame_indizes, upper[:, 0], upper[:, 1]].astype(float)
+        curvature = lower_values - 2 * center_values + upper_values
+        valid = (curvature < 0) & (lower[:, axis] < peak_indizes[:, axis]) & (upper[:, axis] > peak_indizes[:, axis])
+        offsets = np.zeros(frames.shape[0])
+        offsets[valid] = 0.5 * (lower_values[valid] - upper_values[valid]) / curvature[valid]
+        refined[:, axis] += np.clip(offsets, -0.5, 0.5)
+    return refined
+
+
+def _coadd_shifted(coadded, cube, shifts, chunk_size=None, frame_indizes=None):
+    """Add the frames of a cube to an image, each shifted by an integer or sub-pixel shift.
+
+    The frames are added in place via specklepy.core.alignment.place_into_canvas() in 'same' mode, such that no padded
+    copy of the frames is allocated. Non-integer shifts are split into the nearest integer,
+    which is applied via slicing, and a remaining fraction of at most half a pixel, which is applied to each chunk of
+    frames via specklepy.core.alignment.fourier_shift().
+
+    Args:
+        coadded (np.ndarray, ndim=2):
+            Image that the shifted frames are added to.
+        cube (np.ndarray, ndim=3):
+            Data cube with frames of the same shape as `coadded`.
+        shifts (np.ndarray, shape=(n_frames, 2)):
+            Shift of each frame, or of each frame in `frame_indizes` if provided.
+        chunk_size (int, optional):
+            Number of frames that are read at once. Reading all frames at once if not provided.
+        frame_indizes (np.ndarray, optional):
+            Indizes of the frames that are added. All frames are added if not provided.
+    """
+    n_frames = cube.shape[0] if frame_indizes is None else len(frame_indizes)
+    if chunk_size is None:
+        chunk_size = n_frames
+    if np.issubdtype(shifts.dtype, np.integer):
+        fractions = None
+    else:
+        integer_shifts = np.round(shifts).astype(int)
+        fractions = shifts - integer_shifts
+        shifts = integer_shifts
+
+    for chunk in chunk_slices(n_frames, chunk_size):
+        frames = cube[chunk] if frame_indizes is None else cube[frame_indizes[chunk]]
+        if fractions is not None:
+            frames = alignment.fourier_shift(frames, fractions[chunk])
+        for index, frame in enumerate(frames, start=chunk.start):
+            alignment.place_into_canvas(coadded, frame, shifts[index], mode='same')
@@ -60,6 +60,20 @@ class GeneralArgParser(object):
         parser_ssa.add_argument('-b', '--box_indexes', type=int, nargs=4, default=None,
                                 help='Coordinates of a box constraining the search of the emission peak for frame '
                                      'alignment. Provide as a list [x_min, x_max, y_min, y_max].')
+        parser_ssa.add_argument('--memory_limit', type=float, default=None,
+                                help='Upper limit of memory in units of MB for reading frames. If provided, the cubes '
+                                     'are memory-mapped and processed in chunks of frames.')
+        parser_ssa.add_argument('--subpixel', action='store_true',
+                                help='Align frames on sub-pixel peak positions.')
+        parser_ssa.add_argument('-n', '--n_processes', type=int, default=1,
+                                help='Number of processes for reconstructing the individual cubes in parallel.')
+        parser_ssa.add_argument('--selection_fraction', type=float, default=None,
+                                help='Fraction of frames with the highest peak-to-flux ratio to co-add.')
+        parser_ssa.add_argument('--selection_threshold', type=float, default=None,
+                                help='Minimum peak-to-flux ratio of frames to co-add.')
+        parser_ssa.add_argument('-a', '--accumulator_file', type=str, default=None,
+                                help='File storing the running sums of the aligned cubes. Only files that are not '
+                                     'contained yet are reconstructed and added.')
         parser_ssa.add_argument('-o', '--outfile', type=str, default='ssa.fits', help='Name of the output file.')
         parser_ssa.add_argument('-t', '--tmpdir', type=str, default='tmp/', help='Path for saving temporary files.')
         parser_ssa.add_argument('-d', '--debug', action='store_true', help='show debugging information.')
@@ -70,6 +84,8 @@ class GeneralArgParser(object):
         parser_holography.set_defaults(command='holography')
         parser_holography.add_argument('parfile', type=str, help='Path to a parameter file.')
         parser_holography.add_argument('-d', '--debug', action='store_true', help='show debugging information.')
+        parser_holography.add_argument('-b', '--batch', action='store_true',
+                                       help='run unattended, with automatic reference star selection.')
 
         # Parser for extracting 1D PSF profiles
         # parser_psf_1d = subparsers.add_parser('psf1d', help='Extract 1D PSF profiles.')
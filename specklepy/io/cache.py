@@ -0,0 +1,171 @@
+import glob
+import hashlib
+import numpy as np
+import os
+
+from specklepy.exceptions import SpecklepyTypeError, SpecklepyValueError
+from specklepy.logging import logger
+
+
+class Cache(object):
+
+    """Content-addressed cache of intermediate reconstruction products.
+
+    The entries are stored as `.npz` files in the cache directory, named by a digest of the input files and of the
+    parameters that they were computed with. Input files are identified by their path, size and modification time, such
+    that modified files invalidate the entries, while arrays are identified by their content. If the total size of the
+    entries exceeds the size limit, the least recently used entries are removed.
+
+    Attributes:
+        directory (str):
+            Path to the cache directory.
+        max_size (float):
+            Upper limit of the total size of the entries in units of MB, None for an unlimited cache.
+    """
+
+    def __init__(self, directory, max_size=None):
+        """Create a Cache instance.
+
+        Args:
+            directory (str):
+                Path to the cache directory, which is created if not existing yet.
+            max_size (float, optional):
+                Upper limit of the total size of the entries in units of MB. The cache is not limited if not provided.
+        """
+
+        if not isinstance(directory, str):
+            raise SpecklepyTypeError('Cache', argname='directory', argtype=type(directory), expected='str')
+        if max_size is not None:
+            if not isinstance(max_size, (int, float)):
+                raise SpecklepyTypeError('Cache', argname='max_size', argtype=type(max_size), expected='int or float')
+            if max_size <= 0:
+                raise SpecklepyValueError('Cache', argname='max_size', argvalue=max_size, expected='> 0')
+
+        self.directory = directory
+        self.max_size = max_size
+        if not os.path.isdir(self.directory):
+            logger.info(f"Creating cache directory {self.directory}")
+            os.makedirs(self.directory)
+
+    def key(self, files=None, in_dir=None, **params):
+        """Compute the key of an entry from the identity of its input files and its parameters.
+
+        See get_key() for details.
+        """
+        return get_key(files=files, in_dir=in_dir, **params)
+
+    def path(self, key):
+        return os.path.join(self.directory, key + '.npz')
+
+    def __contains__(self, key):
+        return os.path.isfile(self.path(key))
+
+    def load(self, key):
+        """Load the arrays of an entry, marking it as recently used.
+
+        Args:
+            key (str):
+                Key of the entry, see key().
+
+        Returns:
+            arrays (dict):
+                Dictionary of the stored arrays, None if the entry does not exist.
+        """
+        path = self.path(key)
+        try:
+            with np.load(path, allow_pickle=False) as entry:
+                arrays = {name: entry[name] for name in entry.files}
+        except (FileNotFoundError, ValueError, OSError):
+            return None
+        os.utime(path)
+        logger.debug(f"Loaded cache entry {key}")
+        return arrays
+
+    def store(self, key, **arrays):
+        """Store arrays as an entry and evict the least recently used entries beyond the size limit.
+
+        Args:
+            key (str):
+                Key of the entry, see key().
+            **arrays:
+                Arrays to store. Entries that are None are skipped.
+        """
+        arrays = {name: array for name, array in arrays.items() if array is not None}
+        tmp_path = self.path(key) + '.tmp'
+        with open(tmp_path, 'wb') as file:
+            np.savez(file, **arrays)
+        os.replace(tmp_path, self.path(key))
+        logger.debug(f"Stored cache entry {key}")
+        self.evict()
+
+    def evict(self):
+        """Remove the least recently used entries until the total size is within the size limit."""
+        if self.max_size is None:
+            return
+        entries = [(os.stat(path), path) for path in glob.glob(os.path.join(self.directory, '*.npz'))]
+        entries.sort(key=lambda entry: entry[0].st_mtime_ns)
+        total_size = sum(stat.st_size for stat, _ in entries)
+        for stat, path in entries:
+            if total_size <= self.max_size * 1024**2:
+                break
+            logger.debug(f"Evicting cache entry {os.path.basename(path)}")
+            os.remove(path)
+            total_size -= stat.st_size
+
+    def clear(self):
+        """Remove all entries."""
+        for path in glob.glob(os.path.join(self.directory, '*.npz')):
+            os.remove(path)
+
+
+def get_key(files=None, in_dir=None, **params):
+    """Compute a key from the identity of input files and parameters.
+
+    Args:
+        files (list, optional):
+            List of input files or arrays. Files are identified by their absolute path, size and modification time,
+            arrays by their content.
+        in_dir (str, optional):
+            Path to the input files.
+        **params:
+            Parameters that the entry is computed with. Arrays, lists, tuples and dicts are resolved recursively, all
+            other values by their representation.
+
+    Returns:
+        key (str):
+            Hexadecimal digest of the input.
+    """
+    digest = hashlib.sha256()
+    for file in files if files is not None else []:
+        if isinstance(file, np.ndarray):
+            digest.update(_array_digest(file))
+        else:
+            path = os.path.abspath(os.path.join(in_dir if in_dir is not None else '', file))
+            stat = os.stat(path)
+            digest.update(f"{path}:{stat.st_size}:{stat.st_mtime_ns}".encode())
+    for name in sorted(params):
+        digest.update(name.encode())
+        _update(digest, params[name])
+    return digest.hexdigest()
+
+
+def _update(digest, value):
+    if isinstance(value, np.ndarray):
+        digest.update(_array_digest(value))
+    elif isinstance(value, (list, tuple)):
+        digest.update(f"{type(value).__name__}{len(value)}".encode())
+        for item in value:
+            _update(digest, item)
+    elif isinstance(value, dict):
+        for name in sorted(value):
+            digest.update(str(name).encode())
+            _update(digest, value[name])
+    elif isinstance(value, np.generic):
+        digest.update(repr(value.item()).encode())
+    else:
+        digest.update(repr(value).encode())
+
+
+def _array_digest(array):
+    array = np.ascontiguousarray(array)
+    return f"{array.dtype.str}{array.shape}".encode() + hashlib.sha256(array.data).digest()
@@ -1,8 +1,9 @@
+import numpy as np
 import os
 
 from astropy.io import fits
 
-from specklepy.exceptions import SpecklepyTypeError
+from specklepy.exceptions import SpecklepyTypeError, SpecklepyValueError
 from specklepy.logging import logger
 from specklepy.io.outfile import Outfile
 
@@ -65,3 +66,77 @@ class PSFFile(Outfile):
 
         super().__init__(filename=out_file, path=out_dir, shape=shape, cards=cards,
                          header_card_prefix=header_card_prefix)
+
+
+def compress_psfs(psf_cube, n_components):
+    """Compress a PSF cube into a basis of principal components and the coefficients of each frame.
+
+    The basis is obtained from a truncated singular value decomposition of the frames, without subtracting the mean
+    PSF, such that each frame is approximated by the linear combination of the basis images with its coefficients.
+
+    Args:
+        psf_cube (np.ndarray, ndim=3):
+            Cube of PSF frames.
+        n_components (int):
+            Number of basis images. Limited to the number of frames.
+
+    Returns:
+        basis (np.ndarray, ndim=3):
+            Basis images, sorted by decreasing significance.
+        coefficients (np.ndarray, ndim=2):
+            Coefficients of shape (n_frames, n_components).
+    """
+    if not isinstance(n_components, int):
+        raise SpecklepyTypeError('compress_psfs()', 'n_components', type(n_components), 'int')
+    if n_components < 1:
+        raise SpecklepyValueError('compress_psfs()', argname='n_components', argvalue=n_components, expected='>= 1')
+    frames = psf_cube.reshape((psf_cube.shape[0], -1))
+    n_components = min(n_components, *frames.shape)
+    u, s, vh = np.linalg.svd(frames, full_matrices=False)
+    basis = vh[:n_components].reshape((n_components,) + psf_cube.shape[1:])
+    coefficients = u[:, :n_components] * s[:n_components]
+    return basis, coefficients
+
+
+def compress_psf_file(path, n_components):
+    """Replace the PSF cube of a PSF file by its compressed form.
+
+    The primary HDU of the file is emptied and the basis and coefficients from compress_psfs() are stored in the
+    'BASIS' and 'COEFFS' extensions. The file can be read by read_psf_file().
+
+    Args:
+        path (str):
+            Path to the PSF file.
+        n_components (int):
+            Number of basis images, see compress_psfs().
+    """
+    with fits.open(path, mode='update') as hdu_list:
+        psf_cube = hdu_list[0].data
+        basis, coefficients = compress_psfs(psf_cube, n_components)
+        residual = np.max(np.abs(psf_cube - np.tensordot(coefficients, basis, axes=1))) / np.max(np.abs(psf_cube))
+        logger.info(f"Compressing {psf_cube.shape[0]} PSF frames in {path} into {basis.shape[0]} components with a "
+                    f"maximum relative residual of {residual:.2e}")
+        hdu_list[0].data = None
+        hdu_list[0].header.set('PSFCOMP', basis.shape[0], 'Number of PSF basis images')
+        hdu_list.append(fits.ImageHDU(data=basis, name='BASIS'))
+        hdu_list.append(fits.ImageHDU(data=coefficients, name='COEFFS'))
+        hdu_list.flush()
+
+
+def read_psf_file(path):
+    """Read the PSFs from a PSF file, which may be compressed by compress_psf_file().
+
+    Args:
+        path (str):
+            Path to the PSF file.
+
+    Returns:
+        psfs (np.ndarray, ndim=3):
+            Cube of PSF frames, or the basis images if the file is compressed.
+        coefficients (np.ndarray, ndim=2):
+            Coefficients of the frames with respect to the basis images, None if the file is not compressed.
+    """
+    with fits.open(path) as hdu_list:
+        if 'BASIS' in hdu_list:
+            return hdu_list['BASIS'].data.copy(), hdu_list['COEFFS'].data.copy()
+        return hdu_list[0].data.copy(), None
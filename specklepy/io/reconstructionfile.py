@@ -1,5 +1,7 @@
+import numpy as np
 import os
 from astropy.io import fits
+from datetime import datetime
 
 from specklepy.io.outfile import Outfile
 
@@ -11,8 +13,12 @@ class ReconstructionFile(Outfile):
         if cards is None:
             cards = {}
 
-        # Add list of files to header
+        # Add list of files to header, where cubes may be provided as arrays
         for index, file in enumerate(files):
+            if isinstance(file, np.ndarray):
+                cards["FILE {}".format(index)] = 'in-memory cube'
+                cards["FILE {} FRAMES".format(index)] = file.shape[0] if file.ndim == 3 else 1
+                continue
             cards["FILE {}".format(index)] = os.path.basename(file)
             if in_dir:
                 file = os.path.join(in_dir, file)
@@ -36,3 +42,34 @@ class ReconstructionFile(Outfile):
 
         super().__init__(filename=filename, shape=shape, extensions=None, cards=cards, timestamp=False,
                          header_card_prefix=header_card_prefix)
+
+    def set_frame_selections(self, frame_selections):
+        """Record the indizes of the frames that were selected from each file in the header.
+
+        The indizes are stored in compact form as comma-separated ranges, e.g. '0-4,7,9-12'.
+
+        Args:
+            frame_selections (list of array_like):
+                List of frame indizes for each file, in the order of the files in the header.
+        """
+        with fits.open(self.file_path, mode='update') as hdu_list:
+            for index, frame_indizes in enumerate(frame_selections):
+                hdu_list[0].header.set(self.header_card_prefix + f"FILE {index} SELECTED", len(frame_indizes))
+                hdu_list[0].header.set(self.header_card_prefix + f"FILE {index} SELECTED FRAMES",
+                                       self.format_frame_indizes(frame_indizes))
+            hdu_list[0].header.set('UPDATED', str(datetime.now()))
+            hdu_list.flush()
+
+    @staticmethod
+    def format_frame_indizes(frame_indizes):
+        """Format a list of frame indizes as a str of comma-separated ranges."""
+        frame_indizes = np.sort(np.array(frame_indizes, dtype=int))
+        ranges = []
+        start = None
+        for index, frame_index in enumerate(frame_indizes):
+            if start is None:
+                start = frame_index
+            if index + 1 == len(frame_indizes) or frame_indizes[index + 1] != frame_index + 1:
+                ranges.append(str(start) if start == frame_index else f"{start}-{frame_index}")
+                start = None
+        return ','.join(ranges)
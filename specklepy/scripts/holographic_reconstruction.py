@@ -18,6 +18,8 @@ def parser(options=None):
 
     parser.add_argument('parameter_file', type=str, help='Path to the parameter file.')
     parser.add_argument('-d', '--debug', action='store_true', help='Set to inspect intermediate results.')
+    parser.add_argument('-b', '--batch', action='store_true',
+                        help='Run unattended, with automatic reference star selection.')
 
     if options is None:
         args = parser.parse_args()
@@ -51,7 +53,7 @@ def main(options=None):
                         make_dirs=make_dirs)
 
     # Execute reconstruction
-    holography(params, mode=params.options.reconstructionMode, debug=args.debug)
+    holography(params, mode=params.options.reconstructionMode, batch=args.batch, debug=args.debug)
 
 
 
@@ -53,7 +53,9 @@ def main():
         if args.tmpdir is not None and not os.path.isdir(args.tmpdir):
             os.mkdir(args.tmpdir)
         ssa(args.files, mode=args.mode, tmp_dir=args.tmpdir, outfile=args.outfile, box_indexes=args.box_indexes,
-            debug=args.debug)
+            memory_limit=args.memory_limit, subpixel=args.subpixel, n_processes=args.n_processes,
+            selection_fraction=args.selection_fraction, selection_threshold=args.selection_threshold,
+            accumulator_file=args.accumulator_file, debug=args.debug)
 
     elif args.command is 'holography':
 
@@ -62,7 +64,7 @@ def main():
         defaults_file = os.path.abspath(defaults_file)
         params = config.read(defaults_file)
         params = config.update_from_file(params, args.parfile)
-        holography(params, mode=params['OPTIONS']['reconstructionMode'], debug=args.debug)
+        holography(params, mode=params['OPTIONS']['reconstructionMode'], batch=args.batch, debug=args.debug)
 
     elif args.command is 'aperture':
         if args.mode == 'psf1d':
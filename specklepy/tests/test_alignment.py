@@ -1,4 +1,5 @@
 import unittest
+from itertools import product
 import os
 import numpy as np
 from astropy.io import fits
@@ -41,6 +42,107 @@ class TestAlignment(unittest.TestCase):
         for pad_vector in pad_vectors:
             padded = alignment.pad_array(np.ones(self.cube_shape), pad_vector=pad_vector, mode='same', reference_image_pad_vector=ref_pad_vector)
 
+    def test_fourier_shift(self):
+        x, y = np.mgrid[0:64, 0:64]
+        gaussian = lambda x0, y0: np.exp(-((x - x0)**2 + (y - y0)**2) / 2 / 2.**2)
+        shifted = alignment.fourier_shift(gaussian(30, 32), (0.3, -0.45))
+        self.assertTrue(np.allclose(shifted, gaussian(30.3, 31.55), atol=1e-6))
+        frames = np.array([gaussian(30, 32), gaussian(31, 30)])
+        shifted = alignment.fourier_shift(frames, [(0.3, -0.45), (-0.7, 2.)])
+        self.assertTrue(np.allclose(shifted[1], gaussian(30.3, 32), atol=1e-6))
+        with self.assertRaises(ValueError):
+            alignment.fourier_shift(frames, [(0.3, -0.45)])
+
+    def test_get_shift_real_fft(self):
+        np.random.seed(1)
+        for shape in [(64, 64), (63, 50)]:
+            reference = np.random.rand(*shape)
+            for shift in [(3, -5), (-7, 2), (0, 0)]:
+                image = np.roll(reference, shift, axis=(0, 1))
+                self.assertEqual(alignment.get_shift(image, reference_image=reference), tuple(-s for s in shift))
+                self.assertEqual(alignment.get_shift(image, reference_image=np.fft.fft2(reference),
+                                                     is_fourier_transformed=True), tuple(-s for s in shift))
+
+    def test_get_shift_upsampled(self):
+        x, y = np.mgrid[0:64, 0:63]
+        gaussian = lambda x0, y0: np.exp(-((x - x0)**2 + (y - y0)**2) / 2 / 2.**2)
+        reference = gaussian(30, 32)
+        for offset in [(2.37, -1.81), (-0.5, 0.25), (-7.04, 3.5)]:
+            image = gaussian(30 + offset[0], 32 + offset[1])
+            shift = alignment.get_shift(image, reference_image=reference, upsample_factor=100)
+            self.assertTrue(np.allclose(shift, [-offset[0], -offset[1]], atol=0.02))
+        shifts = alignment.get_shifts([reference, gaussian(31.3, 32)], reference_file=reference, upsample_factor=20)
+        self.assertIsInstance(shifts[1][0], float)
+        self.assertAlmostEqual(shifts[1][0], -1.3, delta=0.05)
+
+    def test_get_shift_pyramid(self):
+        np.random.seed(3)
+        x, y = np.mgrid[0:512, 0:512]
+        stars = np.random.uniform(50, 460, size=(30, 2))
+        fluxes = np.random.uniform(1, 10, size=30)
+
+        def star_field(offset):
+            field = 0.01 * np.random.rand(512, 512)
+            for (x0, y0), flux in zip(stars + offset, fluxes):
+                field += flux * np.exp(-((x - x0)**2 + (y - y0)**2) / 2 / 1.5**2)
+            return field
+
+        reference = star_field((0, 0))
+        for offset in [(37, -21), (-3, 45)]:
+            image = star_field(offset)
+            expected = alignment.get_shift(image, reference_image=reference)
+            self.assertEqual(expected, (-offset[0], -offset[1]))
+            self.assertEqual(alignment.get_shift(image, reference_image=reference, mode='pyramid'), expected)
+            self.assertEqual(alignment.get_shift(image, reference_image=reference, mode='pyramid', binning=8,
+                                                 window_size=64), expected)
+        shift = alignment.get_shift(star_field((2.3, -4.6)), reference_image=reference, mode='pyramid',
+                                    upsample_factor=20)
+        self.assertTrue(np.allclose(shift, (-2.3, 4.6), atol=0.1))
+
+    def test_get_frame_shifts(self):
+        np.random.seed(6)
+        reference = np.random.rand(48, 40)
+        drifts = np.array([(k // 2, -(k // 2)) for k in range(9)])
+        cube = np.array([np.roll(reference, drift, axis=(0, 1)) for drift in drifts])
+        frame_shifts = alignment.get_frame_shifts(cube, reference_image=reference, memory_limit=0.05)
+        self.assertTrue(np.array_equal(frame_shifts, -drifts))
+        block_shifts = alignment.get_frame_shifts(cube, reference_image=reference, block_size=2)
+        self.assertTrue(np.array_equal(block_shifts, -drifts))
+
+    def test_place_into_canvas(self):
+        np.random.seed(2)
+        for shifts, mode in product([[(0, 0), (3, -5), (-7, 2), (30, 0)], [(2, 1), (5, 3), (4, 8)]],
+                                    ['same', 'full', 'valid']):
+            pad_vectors, ref_pad_vector = alignment.get_pad_vectors(shifts, return_reference_image_pad_vector=True)
+            canvas = np.zeros(alignment.get_canvas_shape((64, 48), shifts, mode=mode))
+            expected = 0
+            for shift, pad_vector in zip(shifts, pad_vectors):
+                array = np.random.rand(64, 48)
+                alignment.place_into_canvas(canvas, array, shift, mode=mode, shifts=shifts)
+                expected += alignment.pad_array(array, pad_vector, mode=mode, reference_image_pad_vector=ref_pad_vector)
+            self.assertTrue(np.array_equal(canvas, expected))
+
+        cube = np.random.rand(3, 64, 48)
+        canvas = alignment.place_into_canvas(np.ones(cube.shape), cube, (3, -5), add=False)
+        self.assertTrue(np.array_equal(canvas[:, 3:, :-5], cube[:, :-3, 5:]))
+        self.assertTrue(np.all(canvas[:, :3] == 1))
+
+        shifts = [(0, 0), (3, -5), (-7, 2)]
+        self.assertEqual(alignment.get_canvas_shape((64, 48), shifts, mode='valid'), (54, 41))
+        canvas = alignment.place_into_canvas(np.zeros((54, 41)), np.ones((64, 48)), (3, -5), mode='valid', shifts=shifts)
+        self.assertTrue(np.all(canvas == 1))
+
+    def test_get_reference_transform(self):
+        reference = np.random.rand(32, 31)
+        file = 'test_reference_transform.fits'
+        fits.writeto(file, reference, overwrite=True)
+        try:
+            f_reference, shape = alignment.get_reference_transform(file)
+            self.assertEqual(shape, (32, 31))
+            self.assertTrue(np.allclose(f_reference, np.fft.rfft2(reference)))
+            self.assertIs(alignment.get_reference_transform(file)[0], f_reference)
+        finally:
+            os.remove(file)
 
 
 if __name__ == "__main__":
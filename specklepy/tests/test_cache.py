@@ -0,0 +1,66 @@
+import unittest
+import numpy as np
+import os
+import tempfile
+
+from astropy.io import fits
+
+from specklepy.core.alignment import get_shifts
+from specklepy.io.cache import Cache
+
+
+class TestCache(unittest.TestCase):
+
+    def setUp(self):
+        np.random.seed(42)
+        self.image = np.random.rand(32, 32)
+
+    def test_key(self):
+        with tempfile.TemporaryDirectory() as directory:
+            cache = Cache(os.path.join(directory, 'cache'))
+            file = os.path.join(directory, 'image.fits')
+            fits.writeto(file, self.image)
+            key = cache.key(files=[file], mode='same', shift=(1, np.int64(2)))
+            self.assertEqual(key, cache.key(files=[file], shift=(1, 2), mode='same'))
+            self.assertNotEqual(key, cache.key(files=[file], mode='full', shift=(1, 2)))
+            self.assertNotEqual(cache.key(files=[self.image]), cache.key(files=[self.image + 1]))
+
+            # Modified files invalidate the key
+            os.utime(file, ns=(0, 0))
+            self.assertNotEqual(key, cache.key(files=[file], mode='same', shift=(1, 2)))
+
+    def test_store_load(self):
+        with tempfile.TemporaryDirectory() as directory:
+            cache = Cache(directory)
+            self.assertIsNone(cache.load('missing'))
+            cache.store('entry', image=self.image, var=None)
+            entry = cache.load('entry')
+            self.assertTrue(np.array_equal(entry['image'], self.image))
+            self.assertNotIn('var', entry)
+
+    def test_eviction(self):
+        with tempfile.TemporaryDirectory() as directory:
+            cache = Cache(directory, max_size=0.02)
+            cache.store('first', image=self.image)
+            cache.store('second', image=self.image)
+            os.utime(cache.path('first'), ns=(0, 0))
+            os.utime(cache.path('second'), ns=(1, 1))
+            cache.load('first')
+            cache.store('third', image=self.image)
+            self.assertIn('first', cache)
+            self.assertNotIn('second', cache)
+            self.assertIn('third', cache)
+
+    def test_get_shifts(self):
+        images = [np.roll(self.image, shift, axis=(0, 1)) for shift in [(0, 0), (2, -3), (-1, 4)]]
+        with tempfile.TemporaryDirectory() as directory:
+            cache = Cache(directory)
+            shifts = get_shifts(images, cache=cache)
+            self.assertEqual(len(os.listdir(directory)), 1)
+            cached_shifts, image_shape = get_shifts(images, cache=cache, return_image_shape=True)
+            self.assertEqual(shifts, cached_shifts)
+            self.assertEqual(image_shape, self.image.shape)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,178 @@
+import unittest
+import numpy as np
+import os
+import tempfile
+
+from astropy.io import fits
+
+from specklepy.core.alignment import fourier_shift
+from specklepy.core.fourierobject import FourierObject, expand_half_spectrum
+from specklepy.core.ssa import get_frame_quality
+from specklepy.io.psffile import compress_psf_file, compress_psfs, read_psf_file
+
+
+class TestFourierObject(unittest.TestCase):
+
+    def setUp(self):
+        np.random.seed(42)
+        x, y = np.mgrid[0:32, 0:32]
+        self.cube = np.array([np.exp(-((x - 15)**2 + (y - 12)**2) / 2 / 1.5**2) + 1e-3 * np.random.rand(32, 32)
+                              for _ in range(4)])
+        self.psfs = self.cube[:, 10:21, 7:18]
+
+    def test_expand_half_spectrum(self):
+        for shape in [(8, 10), (7, 9)]:
+            image = np.random.rand(*shape)
+            self.assertTrue(np.allclose(expand_half_spectrum(np.fft.rfft2(image), shape), np.fft.fft2(image)))
+
+    def test_spectrum_dir(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            fits.writeto(os.path.join(tmp_dir, 'cube.fits'), self.cube)
+            psf_file = os.path.join(tmp_dir, 'psf_cube.fits')
+            fits.writeto(psf_file, self.psfs)
+            kwargs = {'in_files': ['cube.fits'], 'psf_files': [psf_file], 'shifts': [(0, 0)], 'in_dir': tmp_dir}
+            expected = FourierObject(**kwargs).coadd_fft()
+
+            spectrum_dir = os.path.join(tmp_dir, 'spectra')
+            stored = FourierObject(**kwargs, spectrum_dir=spectrum_dir).coadd_fft()
+            self.assertEqual(len(os.listdir(spectrum_dir)), 1)
+            read = FourierObject(**kwargs, spectrum_dir=spectrum_dir).coadd_fft()
+            self.assertTrue(np.allclose(stored, expected, rtol=1e-5, atol=1e-5 * np.abs(expected).max()))
+            self.assertTrue(np.array_equal(stored, read))
+
+    def test_psf_frames(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            fits.writeto(os.path.join(tmp_dir, 'cube.fits'), self.cube)
+            psf_file = os.path.join(tmp_dir, 'psf_cube.fits')
+            fits.writeto(psf_file, self.psfs)
+            kwargs = {'in_files': ['cube.fits'], 'shifts': [(0, 0)], 'in_dir': tmp_dir}
+            expected = FourierObject(psf_files=[psf_file], **kwargs).coadd_fft()
+            f_object = FourierObject(psf_files=None, psf_shape=self.psfs.shape[1:], **kwargs)
+            fused = f_object.coadd_fft(psf_frames=lambda file_index, cube: (frame[10:21, 7:18] for frame in cube))
+            self.assertTrue(np.allclose(fused, expected))
+            with self.assertRaises(ValueError):
+                FourierObject(psf_files=None, **kwargs)
+
+    def test_checkpoints(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            for index in range(3):
+                fits.writeto(os.path.join(tmp_dir, f"cube_{index}.fits"), np.roll(self.cube, index, axis=1))
+            psf_file = os.path.join(tmp_dir, 'psf_cube.fits')
+            fits.writeto(psf_file, self.psfs)
+            in_files = [f"cube_{index}.fits" for index in range(3)]
+            shifts = [(0, 0), (1, 0), (2, 0)]
+            expected = FourierObject(in_files, [psf_file] * 3, shifts=shifts, in_dir=tmp_dir).coadd_fft()
+
+            # Extend a checkpointed reconstruction by a further file
+            checkpoint_dir = os.path.join(tmp_dir, 'checkpoints')
+            FourierObject(in_files[:2], [psf_file] * 2, shifts=shifts[:2], in_dir=tmp_dir,
+                          checkpoint_dir=checkpoint_dir).coadd_fft()
+            checkpoints = os.listdir(checkpoint_dir)
+            self.assertEqual(len(checkpoints), 2)
+            extended = FourierObject(in_files, [psf_file] * 3, shifts=shifts, in_dir=tmp_dir,
+                                     checkpoint_dir=checkpoint_dir).coadd_fft()
+            self.assertTrue(np.allclose(extended, expected))
+            self.assertEqual(len(os.listdir(checkpoint_dir)), 3)
+            self.assertTrue(set(checkpoints).issubset(os.listdir(checkpoint_dir)))
+
+            # A new PSF generation replaces the checkpoints
+            FourierObject(in_files, [psf_file] * 3, shifts=shifts, in_dir=tmp_dir, checkpoint_dir=checkpoint_dir,
+                          psf_generation='second').coadd_fft()
+            self.assertEqual(len(os.listdir(checkpoint_dir)), 3)
+            self.assertFalse(set(checkpoints) & set(os.listdir(checkpoint_dir)))
+
+    def test_frame_weights(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            fits.writeto(os.path.join(tmp_dir, 'cube.fits'), self.cube)
+            psf_file = os.path.join(tmp_dir, 'psf_cube.fits')
+            fits.writeto(psf_file, self.psfs)
+            kwargs = {'in_files': ['cube.fits'], 'psf_files': [psf_file], 'shifts': [(0, 0)], 'in_dir': tmp_dir}
+            expected = FourierObject(**kwargs).coadd_fft()
+            weighted = FourierObject(**kwargs, frame_weights=[np.full(4, 0.5)]).coadd_fft()
+            self.assertTrue(np.allclose(weighted, expected))
+
+            # Skip the frames with the lowest Strehl proxy
+            quality = get_frame_quality(self.psfs)
+            selection = np.sort(np.argsort(quality)[2:])
+            fits.writeto(os.path.join(tmp_dir, 'selected.fits'), self.cube[selection])
+            fits.writeto(os.path.join(tmp_dir, 'psf_selected.fits'), self.psfs[selection])
+            expected = FourierObject(['selected.fits'], [os.path.join(tmp_dir, 'psf_selected.fits')], shifts=[(0, 0)],
+                                     in_dir=tmp_dir, frame_weights=[quality[selection]]).coadd_fft()
+            selected = FourierObject(**kwargs, frame_weights='strehl', weight_fraction=0.5).coadd_fft()
+            self.assertTrue(np.allclose(selected, expected))
+
+            # Weights and cutoffs apply to PSF frames that are passed on the fly
+            f_object = FourierObject(psf_files=None, psf_shape=self.psfs.shape[1:], frame_weights=[quality],
+                                     weight_fraction=0.5, **{k: v for k, v in kwargs.items() if k != 'psf_files'})
+            fused = f_object.coadd_fft(psf_frames=lambda file_index, cube: (frame[10:21, 7:18] for frame in cube))
+            self.assertTrue(np.allclose(fused, expected))
+            with self.assertRaises(ValueError):
+                FourierObject(**kwargs, frame_weights='snr')
+
+    def test_subpixel(self):
+        shift = (2.4, -1.3)
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            fits.writeto(os.path.join(tmp_dir, 'cube.fits'), self.cube)
+            fits.writeto(os.path.join(tmp_dir, 'shifted.fits'), fourier_shift(self.cube, [(-2.4, 1.3)] * 4))
+            psf_file = os.path.join(tmp_dir, 'psf_cube.fits')
+            fits.writeto(psf_file, self.psfs)
+
+            def reconstruct(in_files, shifts, **kwargs):
+                f_object = FourierObject(in_files, [psf_file] * 2, shifts=shifts, in_dir=tmp_dir, **kwargs)
+                f_object.coadd_fft()
+                return f_object.ifft()
+
+            expected = reconstruct(['cube.fits', 'cube.fits'], [(0, 0), (0, 0)])
+            rounded = reconstruct(['cube.fits', 'shifted.fits'], [(0, 0), shift])
+            aligned = reconstruct(['cube.fits', 'shifted.fits'], [(0, 0), shift], subpixel=True)
+            self.assertLess(np.max(np.abs(aligned - expected)), 0.2 * np.max(np.abs(rounded - expected)))
+            self.assertAlmostEqual(np.max(aligned) / np.max(expected), 1., delta=0.02)
+
+    def test_region(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            fits.writeto(os.path.join(tmp_dir, 'cube.fits'), self.cube)
+            psf_file = os.path.join(tmp_dir, 'psf_cube.fits')
+            fits.writeto(psf_file, self.psfs)
+            kwargs = {'in_files': ['cube.fits'], 'psf_files': [psf_file], 'shifts': [(0, 0)], 'in_dir': tmp_dir}
+            expected = FourierObject(**kwargs).coadd_fft()
+            full = FourierObject(**kwargs, region=(slice(None), slice(None))).coadd_fft()
+            self.assertTrue(np.allclose(full, expected))
+
+            # Apodized reconstructions of non-square regions match the crop of the full reconstruction
+            f_object = FourierObject(**kwargs)
+            f_object.coadd_fft()
+            f_object.apodize(type='Gaussian', radius=1.5)
+            full = f_object.ifft()
+            for region in [(slice(4, 28), slice(2, 22)), (slice(3, 30), slice(0, 32))]:
+                f_object = FourierObject(**kwargs, region=region)
+                self.assertEqual(f_object.coadd_fft().shape, (region[0].stop - region[0].start,
+                                                              region[1].stop - region[1].start))
+                f_object.apodize(type='Gaussian', radius=1.5)
+                self.assertTrue(np.allclose(f_object.ifft(), full[region], atol=1e-3 * np.max(full)))
+
+    def test_compressed_psfs(self):
+        basis, coefficients = compress_psfs(self.psfs, n_components=2)
+        self.assertEqual(basis.shape, (2,) + self.psfs.shape[1:])
+        self.assertEqual(coefficients.shape, (4, 2))
+        with self.assertRaises(ValueError):
+            compress_psfs(self.psfs, n_components=0)
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            fits.writeto(os.path.join(tmp_dir, 'cube.fits'), self.cube)
+            psf_file = os.path.join(tmp_dir, 'psf_cube.fits')
+            fits.writeto(psf_file, self.psfs)
+            kwargs = {'in_files': ['cube.fits'], 'psf_files': [psf_file], 'shifts': [(0, 0)], 'in_dir': tmp_dir}
+            expected = FourierObject(**kwargs).coadd_fft()
+            selected = FourierObject(**kwargs, frame_weights='strehl', weight_fraction=0.5).coadd_fft()
+
+            # A complete basis reproduces the uncompressed reconstruction
+            compress_psf_file(psf_file, n_components=4)
+            psfs, coefficients = read_psf_file(psf_file)
+            self.assertTrue(np.allclose(np.tensordot(coefficients, psfs, axes=1), self.psfs))
+            self.assertTrue(np.allclose(FourierObject(**kwargs).coadd_fft(), expected))
+            compressed = FourierObject(**kwargs, frame_weights='strehl', weight_fraction=0.5).coadd_fft()
+            self.assertTrue(np.allclose(compressed, selected))
+
+
+if __name__ == "__main__":
+    unittest.main()
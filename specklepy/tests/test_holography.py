@@ -1,5 +1,13 @@
 import unittest
+import numpy as np
+import os
+import tempfile
+
+from astropy.io import fits
+from astropy.table import Table
+
 from specklepy.core import holography as holo
+from specklepy.core.psfextraction import ReferenceStars
 from specklepy.io.parameterset import ParameterSet
 
 
@@ -19,5 +27,70 @@ class TestHolography(unittest.TestCase):
         with self.assertRaises(ValueError):
             holo.get_fourier_object(self.params.inFiles, self.params.psf_files, shifts=self.shifts, mode='Nonsense')
 
+    def test_convergence(self):
+        image = np.random.rand(16, 16)
+        self.assertEqual(holo.get_image_change(image, image), 0.)
+        self.assertAlmostEqual(holo.get_image_change(image, 1.1 * image), 0.1)
+        previous = Table({'x': [10., 20., 30., 40.], 'y': [10., 20., 30., 40.]})
+        current = Table({'x': [10.2, 20., 30.5], 'y': [9.9, 20.3, 35.]})
+        self.assertEqual(holo.get_catalogue_change(previous, previous), 0.)
+        self.assertAlmostEqual(holo.get_catalogue_change(previous, current), 3 / 7)
+
+    def test_threshold_psfs(self):
+        psf_cube = np.random.rand(5, 21, 21)
+        psf_cube[:, 10, 10] += 5.
+        mask = holo.get_noise_mask(psf_cube[0], noise_reference_margin=3)
+        thresholded = holo.threshold_psfs(psf_cube, noise_mask=mask, noise_threshold=1.5)
+        for frame, psf in zip(psf_cube, thresholded):
+            reference = np.ma.masked_array(frame, mask=mask)
+            expected = np.maximum(frame - np.mean(reference) - 1.5 * np.std(reference), 0.)
+            self.assertTrue(np.allclose(psf, expected / np.sum(expected)))
+        with self.assertRaises(ValueError):
+            holo.threshold_psfs(psf_cube, noise_mask=mask, noise_threshold=1e3)
+
+    def test_thresholded_psf_frames(self):
+        x, y = np.mgrid[0:64, 0:64]
+        cube = np.array([np.exp(-((x - 30)**2 + (y - 25)**2) / 2 / 1.5**2) + 1e-3 * np.random.rand(64, 64)
+                         for _ in range(5)])
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            fits.writeto(os.path.join(tmp_dir, 'cube.fits'), cube)
+            ref_stars = ReferenceStars(psf_radius=6, reference_source_file=Table({'x': [25], 'y': [30]}),
+                                       in_files=['cube.fits'], save_dir=os.path.join(tmp_dir, 'psfs'), in_dir=tmp_dir)
+            psf_files = ref_stars.extract_psfs(mode='mean')
+            holo.threshold_psf_files(psf_files, noise_reference_margin=3, noise_threshold=3)
+            expected = fits.getdata(psf_files[0])
+            os.remove(psf_files[0])
+            psfs = list(holo.get_thresholded_psf_frames(0, cube, ref_stars, mode='mean', save=True))
+            self.assertTrue(np.allclose(psfs, expected))
+            self.assertTrue(np.allclose(fits.getdata(psf_files[0]), expected))
+
+    def test_reconstruct_segments(self):
+        shape = (64, 48)
+        stars = Table({'x': [12., 35., 14., 33.], 'y': [14., 17., 46., 50.], 'flux': [1., 2., 3., 4.]})
+        x, y = np.mgrid[0:shape[0], 0:shape[1]]
+        cube = np.array([sum(star['flux'] * np.exp(
+            -((x - star['y'])**2 + (y - star['x'])**2) / 2 / 1.5**2) for star in stars) for _ in range(4)])
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            fits.writeto(os.path.join(tmp_dir, 'cube.fits'), cube)
+            kwargs = {'in_files': ['cube.fits'], 'shifts': [(0, 0)], 'image_shape': shape, 'star_table': stars,
+                      'halo': 8, 'in_dir': tmp_dir, 'tmp_dir': tmp_dir, 'psf_radius': 6, 'psf_mode': 'mean',
+                      'noise_threshold': 1, 'apodization_type': 'Gaussian', 'apodization_radius': 1.5}
+            expected = holo.reconstruct_segments(field_segmentation=[1, 1], **kwargs)
+
+            # Blended non-square segments reproduce the stars of the reconstruction of the whole field, while the
+            # deconvolution artifacts differ between the canvas shapes
+            image = holo.reconstruct_segments(field_segmentation=[2, 1], **kwargs)
+            self.assertEqual(image.shape, shape)
+            self.assertGreater(np.corrcoef(image.ravel(), expected.ravel())[0, 1], 0.95)
+            for star in stars:
+                aperture = (x - star['y'])**2 + (y - star['x'])**2 <= 16
+                self.assertAlmostEqual(np.sum(image[aperture]) / np.sum(expected[aperture]), 1., delta=0.02)
+            parallel = holo.reconstruct_segments(field_segmentation=[2, 1], n_processes=2, **kwargs)
+            self.assertTrue(np.allclose(parallel, image))
+
+            with self.assertRaises(RuntimeError):
+                holo.reconstruct_segments(field_segmentation=[1, 4], **dict(kwargs, halo=0))
+
+
 if __name__ == "__main__":
     unittest.main()
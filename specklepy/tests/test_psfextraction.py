@@ -1,5 +1,7 @@
 import unittest
-from specklepy.core.psfextraction import ReferenceStars
+from astropy.table import Table
+
+from specklepy.core.psfextraction import ReferenceStars, select_reference_stars
 from specklepy.io.parameterset import ParameterSet
 
 
@@ -32,6 +34,18 @@ class TestPSFExtraction(unittest.TestCase):
         ref_stars = ReferenceStars(**self.params)
         ref_stars.extract_epsfs(debug=False)
 
+    def test_select_reference_stars(self):
+        sources = Table({'x': [50., 54., 150., 5., 120., 160.],
+                         'y': [50., 52., 60., 100., 150., 140.],
+                         'flux': [100., 50., 80., 200., 10., 5.]})
+        selected = select_reference_stars(sources, psf_radius=10, image_shape=(200, 200))
+        self.assertEqual(list(selected['flux']), [80., 10., 5.])
+        selected = select_reference_stars(sources, psf_radius=10, image_shape=(200, 200), max_number=1,
+                                          field_segmentation=[2, 1])
+        self.assertEqual(list(selected['flux']), [80., 10.])
+        with self.assertRaises(RuntimeError):
+            select_reference_stars(sources, psf_radius=10, image_shape=(200, 200), field_segmentation=[3, 1])
+
 
 if __name__ == "__main__":
     unittest.main()
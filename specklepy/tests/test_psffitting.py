@@ -0,0 +1,70 @@
+import unittest
+import numpy as np
+import os
+import tempfile
+
+from astropy.io import fits
+from astropy.table import Table
+
+from specklepy.core.psffitting import fit_psf_photometry, get_apodization_psf, get_mean_psf
+from specklepy.io.psffile import compress_psf_file
+from specklepy.io.table import read_table
+
+
+class TestPSFFitting(unittest.TestCase):
+
+    def setUp(self):
+        np.random.seed(42)
+        self.shape = (96, 80)
+        self.positions = np.random.uniform(4, 76, size=(60, 2))
+        self.fluxes = np.random.uniform(1, 100, size=60)
+        x, y = np.mgrid[0:self.shape[0], 0:self.shape[1]]
+        self.image = np.full(self.shape, 2.)
+        for (x0, y0), flux in zip(self.positions, self.fluxes):
+            self.image += flux * np.exp(-((x - x0)**2 + (y - y0)**2) / 2 / 1.5**2) / (2 * np.pi * 1.5**2)
+        self.sources = Table({'x': self.positions[:, 1], 'y': self.positions[:, 0]})
+        x, y = np.mgrid[0:13, 0:13]
+        self.psf = np.exp(-((x - 6)**2 + (y - 6)**2) / 2 / 1.5**2)
+
+    def get_fluxes(self, sources):
+        fluxes = {(row['y'], row['x']): row['flux'] for row in sources}
+        return np.array([fluxes[tuple(position)] for position in self.positions])
+
+    def test_fit_psf_photometry(self):
+        sources = fit_psf_photometry(self.image, self.sources, self.psf, oversampling=100)
+        self.assertEqual(sources.colnames, ['x', 'y', 'flux'])
+        self.assertTrue(np.all(np.diff(sources['flux']) <= 0))
+        fluxes = self.get_fluxes(sources)
+        self.assertTrue(np.allclose(fluxes, self.fluxes, rtol=1e-2, atol=1))
+
+        # Tiles reproduce the fit of the whole image
+        for tile_size in [16, 40]:
+            tiled = self.get_fluxes(fit_psf_photometry(self.image, self.sources, self.psf, tile_size=tile_size,
+                                                       oversampling=100))
+            self.assertTrue(np.allclose(tiled, fluxes, rtol=1e-3, atol=1e-2))
+
+        with self.assertRaises(TypeError):
+            fit_psf_photometry(self.image, self.sources, self.psf, tile_size=16.)
+        with self.assertRaises(ValueError):
+            fit_psf_photometry(self.image, self.sources, self.psf, tile_size=0)
+
+    def test_psf_files(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            psf_files = [os.path.join(tmp_dir, f"psf_{index}.fits") for index in range(2)]
+            fits.writeto(psf_files[0], np.array([self.psf, 3 * self.psf]))
+            fits.writeto(psf_files[1], np.array([2 * self.psf, self.psf]))
+            compress_psf_file(psf_files[1], n_components=1)
+            self.assertTrue(np.allclose(get_mean_psf(psf_files), self.psf / np.sum(self.psf)))
+
+            all_stars_file = os.path.join(tmp_dir, 'all_stars.dat')
+            sources = fit_psf_photometry(self.image, self.sources, psf_files, write_to=all_stars_file)
+            self.assertTrue(np.allclose(read_table(all_stars_file)['flux'], sources['flux']))
+
+    def test_get_apodization_psf(self):
+        psf = get_apodization_psf('Gaussian', 2)
+        self.assertEqual(psf.ndim, 2)
+        self.assertAlmostEqual(np.sum(psf), 1.)
+
+
+if __name__ == "__main__":
+    unittest.main()
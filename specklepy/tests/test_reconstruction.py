@@ -1,4 +1,10 @@
 import unittest
+import numpy as np
+import os
+import tempfile
+
+from astropy.io import fits
+
 from specklepy.core.reconstruction import Reconstruction
 
 
@@ -20,6 +26,26 @@ class TestReconstruction(unittest.TestCase):
         with self.assertRaises(ValueError):
             Reconstruction(in_files=[], mode='nonSense')
 
+    def test_array_inputs(self):
+        np.random.seed(42)
+        x, y = np.mgrid[0:64, 0:64]
+        image = 0.1 * np.random.rand(64, 64) + 50 * np.exp(-((x - 30)**2 + (y - 30)**2) / 2 / 1.5**2)
+        cubes = [np.array([np.roll(image, shift, axis=(0, 1))] * 5) for shift in [(0, 0), (3, -2), (-1, 4)]]
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            files = []
+            for index, cube in enumerate(cubes):
+                files.append(f"cube_{index}.fits")
+                fits.writeto(os.path.join(tmp_dir, files[-1]), cube)
+            out_file = os.path.join(tmp_dir, 'reconstruction.fits')
+            reconstruction = Reconstruction(files, in_dir=tmp_dir, tmp_dir=tmp_dir, out_file=out_file)
+            expected, _ = reconstruction.coadd_long_exposures()
+
+            reconstruction = Reconstruction(cubes, tmp_dir=tmp_dir, out_file=out_file, memory_limit=0.04)
+            self.assertIsInstance(reconstruction.long_exposures[0], np.ndarray)
+            self.assertEqual(reconstruction.long_exposures[2], 'int_cube_2.fits')
+            image, _ = reconstruction.coadd_long_exposures()
+            self.assertTrue(np.array_equal(image, expected))
+            self.assertEqual(fits.getheader(out_file)['HIERARCH SPECKLEPY FILE 1 FRAMES'], 5)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,192 @@
+import unittest
+import numpy as np
+import os
+import tempfile
+
+from astropy.io import fits
+
+from specklepy.core import alignment
+from specklepy.core.ssa import coadd_frames, get_frame_quality, select_frames, ssa
+from specklepy.io.reconstructionfile import ReconstructionFile
+from specklepy.utils.box import Box
+from specklepy.utils.chunks import get_chunk_size
+
+
+class TestSSA(unittest.TestCase):
+
+    def setUp(self):
+        np.random.seed(42)
+        self.shape = (20, 64, 64)
+        self.cube = np.random.rand(*self.shape)
+        self.var_cube = np.random.rand(*self.shape) * 0.1
+        for index in range(self.shape[0]):
+            x, y = np.random.randint(20, 44, size=2)
+            self.cube[index, x, y] += 50.
+            self.cube[index, x + 3, y - 2] += 20.
+
+    def test_get_chunk_size(self):
+        self.assertEqual(get_chunk_size((64, 64), float, n_frames=20), 20)
+        self.assertEqual(get_chunk_size((1024, 1024), 'float64', n_frames=1000, memory_limit=80), 10)
+        self.assertEqual(get_chunk_size((1024, 1024), 'float64', n_frames=1000, memory_limit=80, n_cubes=2), 5)
+        self.assertEqual(get_chunk_size((1024, 1024), 'float64', n_frames=1000, memory_limit=1), 1)
+        with self.assertRaises(ValueError):
+            get_chunk_size((64, 64), float, n_frames=20, memory_limit=0)
+
+    def test_coadd_frames_memory_limit(self):
+        coadded, var_coadded = coadd_frames(self.cube, var_cube=self.var_cube)
+        for memory_limit in [0.01, 0.1, 1]:
+            chunked, var_chunked = coadd_frames(self.cube, var_cube=self.var_cube, memory_limit=memory_limit)
+            self.assertTrue(np.array_equal(coadded, chunked))
+            self.assertTrue(np.array_equal(var_coadded, var_chunked))
+
+        coadded, _ = coadd_frames(self.cube, box=Box([10, 54, 10, 54]))
+        chunked, _ = coadd_frames(self.cube, box=Box([10, 54, 10, 54]), memory_limit=0.05)
+        self.assertTrue(np.array_equal(coadded, chunked))
+
+    def test_coadd_frames_shifted_accumulation(self):
+        box = Box([10, 54, 5, 60])
+        coadded, var_coadded = coadd_frames(self.cube, var_cube=self.var_cube, box=box)
+
+        # Compare against padding every frame individually
+        peak_indizes = np.array([np.unravel_index(np.argmax(box(frame, update=False)), box.shape)
+                                 for frame in self.cube])
+        shifts = np.mean(peak_indizes, axis=0).astype(int) - peak_indizes
+        pad_vectors, ref_pad_vector = alignment.get_pad_vectors(shifts, return_reference_image_pad_vector=True)
+        expected = np.zeros(self.shape[1:])
+        expected_var = np.zeros(self.shape[1:])
+        for index in range(self.shape[0]):
+            expected += alignment.pad_array(self.cube[index], pad_vectors[index], mode='same',
+                                            reference_image_pad_vector=ref_pad_vector)
+            expected_var += alignment.pad_array(self.var_cube[index], pad_vectors[index], mode='same',
+                                                reference_image_pad_vector=ref_pad_vector)
+        self.assertTrue(np.array_equal(coadded, expected))
+        self.assertTrue(np.array_equal(var_coadded, expected_var))
+
+    def test_coadd_frames_subpixel(self):
+        x, y = np.mgrid[0:64, 0:64]
+        positions = 32 + np.random.uniform(-5, 5, size=(self.shape[0], 2))
+        cube = np.array([np.exp(-((x - x0)**2 + (y - y0)**2) / 2 / 1.2**2) for x0, y0 in positions])
+        coadded, var_coadded = coadd_frames(cube, var_cube=np.ones(cube.shape), subpixel=True)
+        integer_coadded, _ = coadd_frames(cube)
+        self.assertGreater(np.max(coadded), np.max(integer_coadded))
+        self.assertAlmostEqual(np.max(coadded) / self.shape[0], 1., delta=0.05)
+        self.assertAlmostEqual(np.sum(coadded), np.sum(cube), delta=1e-3 * np.sum(cube))
+        self.assertEqual(var_coadded.shape, coadded.shape)
+
+        chunked, _ = coadd_frames(cube, subpixel=True, memory_limit=0.1)
+        self.assertTrue(np.allclose(coadded, chunked))
+
+    def test_coadd_frames_memmap_box(self):
+        box = Box([10, 54, 5, 60])
+        with tempfile.TemporaryDirectory() as in_dir:
+            file = os.path.join(in_dir, 'cube.fits')
+            fits.writeto(file, self.cube)
+            with fits.open(file, memmap=True) as hdu_list:
+                coadded, _ = coadd_frames(hdu_list[0].data, box=box, memory_limit=0.05)
+        expected, _ = coadd_frames(self.cube, box=box)
+        self.assertTrue(np.array_equal(coadded, expected))
+
+    def test_ssa_processes(self):
+        with tempfile.TemporaryDirectory() as in_dir:
+            files = []
+            for index, shift in enumerate([(0, 0), (3, -2), (-4, 1)]):
+                file = f"cube_{index}.fits"
+                hdu_list = fits.HDUList([fits.PrimaryHDU(np.roll(self.cube, shift, axis=(1, 2))),
+                                         fits.ImageHDU(self.var_cube, name='VAR')])
+                hdu_list.writeto(os.path.join(in_dir, file))
+                files.append(file)
+
+            image, var = ssa(files, in_dir=in_dir)
+            parallel_image, parallel_var = ssa(files, in_dir=in_dir, n_processes=2)
+            self.assertTrue(np.array_equal(image, parallel_image))
+            self.assertTrue(np.array_equal(var, parallel_var))
+
+            tmp_dir = os.path.join(in_dir, 'tmp')
+            tmp_image, _ = ssa(files, in_dir=in_dir, tmp_dir=tmp_dir)
+            self.assertTrue(np.array_equal(image, tmp_image))
+            self.assertTrue(os.path.isfile(os.path.join(tmp_dir, 'cube_0_ssa.fits')))
+
+    def test_ssa_accumulator(self):
+        with tempfile.TemporaryDirectory() as in_dir:
+            files = []
+            for index, shift in enumerate([(0, 0), (3, -2), (-4, 1), (9, 7)]):
+                file = f"cube_{index}.fits"
+                hdu_list = fits.HDUList([fits.PrimaryHDU(np.roll(self.cube, shift, axis=(1, 2))),
+                                         fits.ImageHDU(self.var_cube, name='VAR')])
+                hdu_list.writeto(os.path.join(in_dir, file))
+                files.append(file)
+
+            accumulator_file = os.path.join(in_dir, 'accumulator.npz')
+            ssa(files[:2], in_dir=in_dir, accumulator_file=accumulator_file)
+            for mode in ['same', 'full', 'valid']:
+                image, var = ssa(files, in_dir=in_dir, mode=mode)
+                accumulated, accumulated_var = ssa(files, in_dir=in_dir, mode=mode, accumulator_file=accumulator_file,
+                                                   outfile=os.path.join(in_dir, 'ssa.fits'))
+                self.assertTrue(np.array_equal(image, accumulated))
+                self.assertTrue(np.array_equal(var, accumulated_var))
+            self.assertEqual(fits.getheader(os.path.join(in_dir, 'ssa.fits'))['HIERARCH SPECKLEPY FILE 3'],
+                             'cube_3.fits')
+
+    def test_ssa_subpixel_accumulator(self):
+        with tempfile.TemporaryDirectory() as in_dir:
+            files = []
+            for index, shift in enumerate([(0, 0), (0.4, -2.3), (-3.7, 1.2)]):
+                file = f"cube_{index}.fits"
+                fits.writeto(os.path.join(in_dir, file), alignment.fourier_shift(self.cube, [shift] * self.shape[0]))
+                files.append(file)
+
+            image = ssa(files, in_dir=in_dir, subpixel=True)
+            accumulator_file = os.path.join(in_dir, 'accumulator.npz')
+            ssa(files[:2], in_dir=in_dir, subpixel=True, accumulator_file=accumulator_file)
+            accumulated = ssa(files, in_dir=in_dir, subpixel=True, accumulator_file=accumulator_file)
+            self.assertTrue(np.allclose(image, accumulated))
+            self.assertGreater(np.max(image), np.max(ssa(files, in_dir=in_dir)))
+
+    def test_coadd_frames_frame_shifts(self):
+        drifts = np.array([(k // 4, -(k // 5)) for k in range(self.shape[0])])
+        cube = np.array([np.roll(self.cube[0], drift, axis=(0, 1)) for drift in drifts])
+        frame_shifts = alignment.get_frame_shifts(cube, reference_image=self.cube[0])
+        self.assertTrue(np.array_equal(frame_shifts, -drifts))
+        coadded, _ = coadd_frames(cube, frame_shifts=-drifts)
+        self.assertTrue(np.allclose(coadded[:60, 4:], self.shape[0] * self.cube[0][:60, 4:]))
+        with self.assertRaises(ValueError):
+            coadd_frames(cube, frame_shifts=drifts[1:])
+
+    def test_select_frames(self):
+        quality = get_frame_quality(self.cube)
+        self.assertEqual(quality.shape, (self.shape[0],))
+        self.assertTrue(np.allclose(quality, np.max(self.cube, axis=(1, 2)) / np.sum(self.cube, axis=(1, 2))))
+        selection = select_frames(quality, fraction=0.25)
+        self.assertEqual(len(selection), 5)
+        self.assertTrue(np.min(quality[selection]) >= np.max(np.delete(quality, selection)))
+        selection = select_frames(quality, threshold=np.median(quality))
+        self.assertTrue(np.all(quality[selection] >= np.median(quality)))
+        with self.assertRaises(RuntimeError):
+            select_frames(quality, threshold=1.)
+
+    def test_coadd_frames_selection(self):
+        coadded, var_coadded, selection = coadd_frames(self.cube, var_cube=self.var_cube, selection_fraction=0.5,
+                                                       return_selection=True, memory_limit=0.05)
+        self.assertEqual(len(selection), 10)
+        expected, expected_var = coadd_frames(self.cube[selection], var_cube=self.var_cube[selection])
+        self.assertTrue(np.array_equal(coadded, expected))
+        self.assertTrue(np.array_equal(var_coadded, expected_var))
+
+    def test_ssa_selection_header(self):
+        with tempfile.TemporaryDirectory() as in_dir:
+            file = os.path.join(in_dir, 'cube.fits')
+            fits.writeto(file, self.cube)
+            out_file = os.path.join(in_dir, 'ssa.fits')
+            ssa([file], outfile=out_file, selection_fraction=0.5)
+            header = fits.getheader(out_file)
+            self.assertEqual(header['HIERARCH SPECKLEPY FILE 0 SELECTED'], 10)
+        self.assertEqual(ReconstructionFile.format_frame_indizes([7, 0, 1, 2, 4, 5, 9]), '0-2,4-5,7,9')
+
+    def test_box_slices(self):
+        box = Box([10, 54, 5, 60])
+        frame = self.cube[0]
+        self.assertTrue(np.array_equal(box(frame, update=False), frame[box.slices(frame.shape)]))
+
+
+if __name__ == "__main__":
+    unittest.main()
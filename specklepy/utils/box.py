@@ -83,10 +83,27 @@ class Box(object):
                 self.y_min = y_min
                 self.y_max = y_max
 
-            # Create index sets
-            x, y = np.meshgrid(range(y_min, y_max), range(x_min, x_max))
+            # Crop via slicing, which returns a view instead of a copy
+            return array[x_min:x_max, y_min:y_max]
 
-            return array[y, x]
+    def slices(self, shape):
+        """Return the index slices of the box within an array, without updating the box limits.
+
+        Args:
+            shape (tuple):
+                Shape of the array, that the box is applied to.
+
+        Returns:
+            slices (tuple of slice):
+                Slices along the two axes, such that `array[box.slices(array.shape)]` equals `box(array)`.
+        """
+        if self.x_min is None and self.x_max is None and self.y_min is None and self.y_max is None:
+            return slice(None), slice(None)
+        x_min = 0 if self.x_min is None else self.x_min
+        x_max = shape[1] - 1 if self.x_max is None else self.x_max
+        y_min = 0 if self.y_min is None else self.y_min
+        y_max = shape[0] - 1 if self.y_max is None else self.y_max
+        return slice(x_min, x_max), slice(y_min, y_max)
 
     @property
     def shape(self):
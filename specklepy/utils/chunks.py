@@ -0,0 +1,54 @@
+import numpy as np
+
+from specklepy.exceptions import SpecklepyTypeError, SpecklepyValueError
+
+
+def get_chunk_size(frame_shape, dtype, n_frames, memory_limit=None, n_cubes=1):
+    """Compute the number of frames that can be read at once without exceeding a memory limit.
+
+    Args:
+        frame_shape (tuple):
+            Shape of a single frame of the cube.
+        dtype (np.dtype or str):
+            Data type of the frames.
+        n_frames (int):
+            Number of frames in the cube, which is the upper limit of the chunk size.
+        memory_limit (float, optional):
+            Upper limit of memory for a chunk of frames in units of MB. All frames are read at once if not provided.
+        n_cubes (int, optional):
+            Number of cubes that are read with the same chunk size, e.g. 2 for a data and a variance cube. Default is 1.
+
+    Returns:
+        chunk_size (int):
+            Number of frames per chunk, always at least 1.
+    """
+
+    if memory_limit is None:
+        return n_frames
+    if not isinstance(memory_limit, (int, float)):
+        raise SpecklepyTypeError('get_chunk_size()', argname='memory_limit', argtype=type(memory_limit),
+                                 expected='int or float')
+    if memory_limit <= 0:
+        raise SpecklepyValueError('get_chunk_size()', argname='memory_limit', argvalue=memory_limit, expected='> 0')
+
+    frame_bytes = int(np.prod(frame_shape)) * np.dtype(dtype).itemsize * n_cubes
+    chunk_size = int(memory_limit * 1024**2 // frame_bytes)
+
+    return max(1, min(chunk_size, n_frames))
+
+
+def chunk_slices(n_frames, chunk_size):
+    """Iterate over slices that split a number of frames into consecutive chunks.
+
+    Args:
+        n_frames (int):
+            Total number of frames.
+        chunk_size (int):
+            Maximum number of frames per chunk.
+
+    Yields:
+        chunk (slice):
+            Slice of the frame indexes of the chunk.
+    """
+    for start in range(0, n_frames, chunk_size):
+        yield slice(start, min(start + chunk_size, n_frames))